@@ -0,0 +1,628 @@
+__author__ = "Andrea Galassi"
+__copyright__ = "Copyright 2018-2020 Andrea Galassi"
+__license__ = "BSD 3-clause"
+__version__ = "0.2.0"
+__email__ = "a.galassi@unibo.it"
+
+"""
+Regression checks and timings of the optimized parts of the pipeline against their previous implementations.
+"""
+
+import pandas
+import os
+import numpy as np
+import sys
+import time
+import argparse
+import resource
+import shutil
+import tempfile
+
+from tokenizer import Tokenizer, SEPARATORS, STOPWORDS, UNKNOWN, normalize
+from token_store import TokenStore
+from dataset_config import dataset_info
+from glove_loader import DIM
+
+# dataset name and versions of each corpus, as in embedder.py
+CORPORA = {"rct": ("RCT", ["neo", "glaucoma", "mixed"]),
+           "drinv": ("DrInventor", ["arg10"]),
+           "ukp": ("AAEC_v2", ["new_2R"]),
+           "cdcp": ("cdcp_ACL17", ["new_3"]),
+           "scidtb": ("scidtb_argmin_annotations", ["only_arg_v1"]),
+           "echr": ("ECHR2018", ["arg0"])}
+
+
+def legacy_tokenize(text, vocabulary, separators=None):
+    """
+    Tokenization of a text as performed by embedder.save_embeddings before the Tokenizer class.
+    Returns the list of the tokens, '' for the ones that are not recognized.
+    """
+    if separators is None:
+        separators = SEPARATORS
+
+    splits = text.split()
+    tokens = [''] * len(splits)
+
+    # initial split with common separators
+    i = 0
+    while i < len(splits):
+        word = splits[i]
+
+        # remove possible stop symbols in the end of the token
+        if len(word) > 1 and word[-1] in STOPWORDS and word[:-1] in vocabulary.keys():
+            symbol = word[-1]
+            word = word[:-1]
+            splits.insert(i + 1, symbol)
+            tokens.insert(i + 1, symbol)
+            splits[i] = word
+            tokens[i] = word
+        elif word in vocabulary.keys():
+            tokens[i] = word
+
+        i += 1
+
+    for separator in separators:
+        i = 0
+        # iterate on the whole list of split, creating new splits with the separator
+        while i < len(splits):
+            # the word is not empty and is not recognized as a token
+            if tokens[i] == '' and splits[i] != '':
+                index = 0
+                prev_index = 0
+                while index < len(splits[i]) and index >= 0:
+                    word = splits[i]
+                    index = word.find(separator, index)
+                    if index >= 0:
+                        prev_word = word[prev_index:index]
+                        next_word = word[index + len(separator):]
+                        if prev_word != '':
+                            splits.insert(i, prev_word)
+                            tokens.insert(i, '')
+                            i += 1
+
+                        # adds the separator
+                        splits[i] = separator
+                        tokens[i] = separator
+
+                        # avoids finding the same separator too many times
+                        index += len(separator)
+
+                        if next_word != '':
+                            splits.insert(i + 1, next_word)
+                            tokens.insert(i + 1, '')
+            i += 1
+
+        # recognize tokens
+        i = 0
+        while i < len(splits):
+            word = splits[i]
+            # remove possible stop symbols in the end of the token
+            if len(word) > 1 and word[-1] in STOPWORDS and word[:-1] in vocabulary.keys():
+                symbol = word[-1]
+                word = word[:-1]
+                splits.insert(i + 1, symbol)
+                tokens.insert(i + 1, symbol)
+                splits[i] = word
+                tokens[i] = word
+
+            elif word in vocabulary.keys():
+                tokens[i] = word
+
+            i += 1
+
+    return tokens
+
+
+def load_texts(dataframe_path, mode='propositions'):
+    df = pandas.read_pickle(dataframe_path)
+    if mode == 'texts':
+        df_text = df[['text_ID', 'rawtext']].drop_duplicates()
+    else:
+        df_text = df[['source_ID', 'source_proposition']].drop_duplicates()
+
+    texts = []
+    for index, (text_id, text) in df_text.iterrows():
+        texts.append((text_id, normalize(text)))
+    return texts
+
+
+def tokenization_regression(dataframe_path, vocabulary_path, mode='propositions'):
+    """
+    Compares the token ids given by Tokenizer with the ones of legacy_tokenize on a dataframe.
+
+    :param dataframe_path: path of the pickled dataframe
+    :param vocabulary_path: path of the glove.embeddings.npz file of the corpus
+    :param mode: 'texts' or 'propositions', as in embedder.save_embeddings
+    :return: the number of texts whose tokens differ
+    """
+    word_list = np.load(vocabulary_path)['vocab']
+    vocabulary = {}
+    for index in range(len(word_list)):
+        vocabulary[word_list[index]] = index + 1
+
+    texts = load_texts(dataframe_path, mode)
+
+    start_time = time.time()
+    legacy_ids = []
+    for text_id, text in texts:
+        ids = []
+        for token in legacy_tokenize(text, vocabulary):
+            if token == '':
+                ids.append(UNKNOWN)
+            else:
+                ids.append(vocabulary[token])
+        legacy_ids.append(ids)
+    legacy_time = time.time() - start_time
+
+    start_time = time.time()
+    tokenizer = Tokenizer(vocabulary)
+    new_ids = []
+    for text_id, text in texts:
+        new_ids.append(tokenizer.tokenize(text))
+    new_time = time.time() - start_time
+
+    differences = 0
+    for i in range(len(texts)):
+        if legacy_ids[i] != new_ids[i]:
+            differences += 1
+            if differences <= 10:
+                print("DIFFERENT TOKENS!")
+                print(texts[i][0])
+                print(texts[i][1])
+                print(legacy_ids[i])
+                print(new_ids[i])
+                print()
+
+    cache_info = tokenizer.cache_info()
+    print(str(time.ctime()) + "\t" + str(len(texts)) + " texts, " + str(differences) + " different")
+    print("\tlegacy: %.3f s\ttokenizer: %.3f s\tcache: %d hits, %d misses" %
+          (legacy_time, new_time, cache_info.hits, cache_info.misses))
+    return differences
+
+
+def tokenization_routine(corpus, size, mode='propositions'):
+    if size == 300:
+        embed_name = "glove300"
+    elif size == 25:
+        embed_name = "glove25"
+    else:
+        raise Exception("Wrong embedding size")
+
+    dataset_name, versions = CORPORA[corpus]
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+
+    differences = 0
+    for version in versions:
+        print(str(time.ctime()) + "\tTokenization of " + dataset_name + " " + version)
+        dataframe_path = os.path.join(dataset_path, 'pickles', version, 'total.pkl')
+        if not os.path.exists(dataframe_path):
+            print("Dataframe not found: " + dataframe_path)
+            continue
+        if corpus == "echr":
+            vocabulary_path = os.path.join(dataset_path, 'glove', 'glove.embeddings.npz')
+        else:
+            vocabulary_path = os.path.join(dataset_path, "resources", embed_name, 'glove.embeddings.npz')
+        differences += tokenization_regression(dataframe_path, vocabulary_path, mode)
+    return differences
+
+
+def export_legacy_embeddings(store_path, legacy_path, embedding_matrix=None):
+    """
+    Writes the sequences of a token store as one .npz file for each ID, as embedder.save_embeddings did before the
+    token store, so that they can be read by legacy_load_dataset.
+    :param embedding_matrix: if given, the files contain the vectors of the tokens instead of their ids
+    """
+    store = TokenStore(store_path, mmap=False)
+    if not os.path.exists(legacy_path):
+        os.makedirs(legacy_path)
+    for ID in store.ids():
+        if embedding_matrix is None:
+            embeddings = np.array(store[ID], dtype=int)
+        else:
+            embeddings = np.array(embedding_matrix[np.array(store[ID], dtype=np.int64)], dtype=np.float32)
+        np.savez(os.path.join(legacy_path, ID + '.npz'), embeddings)
+    return len(store)
+
+
+def legacy_load_dataset(dataset_split='total', dataset_name='cdcp_ACL17', dataset_version='new_2',
+                 feature_type='embeddings', min_text_len=0, min_prop_len=0, distance=5,
+                 distance_train_limit=-1, embed_name="glove300", embed_path=None):
+    """
+    training.load_dataset as it was before the optimizations: row by row, reading one .npz file for each proposition.
+    With 'embeddings' the files must contain the vectors, and the distance must be positive.
+    :param embed_path: folder of the .npz files, if it is not the one of the dataset (see export_legacy_embeddings)
+    """
+
+    if distance < 0:
+        distance = 0
+
+    if feature_type == 'bow':
+        pad = 0
+        dtype = np.uint16
+        ndim = 2
+    elif feature_type == 'embeddings':
+        pad = np.zeros(DIM)
+        dtype = np.float32
+        ndim = 3
+
+    max_prop_len = min_prop_len
+    max_text_len = min_text_len
+
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+    dataframe_path = os.path.join(dataset_path, 'pickles', dataset_version, dataset_split + '.pkl')
+    if embed_path is None:
+        embed_path = os.path.join(dataset_path, "embeddings", embed_name, dataset_version)
+
+    df = pandas.read_pickle(dataframe_path)
+
+    categorical_prop = dataset_info[dataset_name]["categorical_prop"]
+    categorical_link = dataset_info[dataset_name]["categorical_link"]
+
+    dataset = {}
+
+    for split in ('train', 'validation', 'test'):
+        dataset[split] = {}
+        dataset[split]['source_props'] = []
+        dataset[split]['target_props'] = []
+        dataset[split]['links'] = []
+        dataset[split]['relations_type'] = []
+        dataset[split]['sources_type'] = []
+        dataset[split]['targets_type'] = []
+
+        if distance > 0:
+            dataset[split]['distance'] = []
+            dataset[split]['difference'] = []
+
+        dataset[split]['s_id'] = []
+        dataset[split]['t_id'] = []
+
+    for index, row in df.iterrows():
+
+        s_index = int(row['source_ID'].split('_')[-1])
+        t_index = int(row['target_ID'].split('_')[-1])
+
+        difference = t_index - s_index
+
+        split = row['set']
+
+        # in case this is a train tuple, that the limitation on the distance is active and that the distance between
+        # the two components is greater than the distance allowed, skip this row
+        if split == "train" and distance_train_limit > 0 and abs(difference) > distance_train_limit:
+            continue
+
+        text_ID = row['text_ID']
+        source_ID = row['source_ID']
+        target_ID = row['target_ID']
+        split = row['set']
+
+
+        if row['source_to_target']:
+            dataset[split]['links'].append([1, 0])
+        else:
+            dataset[split]['links'].append([0, 1])
+        """
+        else:
+            if split == 'train':
+                n = random.random()
+                if n < 0.2:
+                    continue
+            dataset[split]['links'].append([0, 1])
+        """
+
+        dataset[split]['sources_type'].append(categorical_prop[row['source_type']])
+        dataset[split]['targets_type'].append(categorical_prop[row['target_type']])
+
+
+        dataset[split]['relations_type'].append(categorical_link[row['relation_type']])
+
+        dataset[split]['s_id'].append(row['source_ID'])
+        dataset[split]['t_id'].append(row['target_ID'])
+
+
+        if distance > 0:
+            difference_array = [0] * distance * 2
+            if difference > distance:
+                difference_array[-distance:] = [1] * distance
+            elif difference < -distance:
+                difference_array[:distance] = [1] * distance
+            elif difference > 0:
+                difference_array[-distance: distance + difference] = [1] * difference
+            elif difference < 0:
+                difference_array[distance + difference: distance] = [1] * -difference
+            dataset[split]['distance'].append(difference_array)
+            dataset[split]['difference'].append(difference)
+
+        file_path = os.path.join(embed_path, source_ID + '.npz')
+        embeddings = np.load(file_path)['arr_0']
+        embed_length = len(embeddings)
+        if embed_length > max_prop_len:
+            max_prop_len = embed_length
+        dataset[split]['source_props'].append(embeddings)
+
+        file_path = os.path.join(embed_path, target_ID + '.npz')
+        embeddings = np.load(file_path)['arr_0']
+        embed_length = len(embeddings)
+        if embed_length > max_prop_len:
+            max_prop_len = embed_length
+        dataset[split]['target_props'].append(embeddings)
+
+    print(str(time.ctime()) + '\t\tPADDING...')
+
+    sys.stdout.flush()
+
+    for split in ('train', 'validation', 'test'):
+
+        dataset[split]['distance'] = np.array(dataset[split]['distance'], dtype=np.int8)
+
+        print(str(time.ctime()) + '\t\t\tPADDING ' + split)
+
+
+        texts = dataset[split]['source_props']
+        for j in range(len(texts)):
+            text = texts[j]
+            embeddings = []
+            diff = max_prop_len - len(text)
+            for i in range(diff):
+                embeddings.append(pad)
+            for embedding in text:
+                embeddings.append(embedding)
+            texts[j] = embeddings
+        dataset[split]['source_props'] = np.array(texts, ndmin=ndim, dtype=dtype)
+
+        texts = dataset[split]['target_props']
+        for j in range(len(texts)):
+            text = texts[j]
+            embeddings = []
+            diff = max_prop_len - len(text)
+            for i in range(diff):
+                embeddings.append(pad)
+            for embedding in text:
+                embeddings.append(embedding)
+            texts[j] = embeddings
+        dataset[split]['target_props'] = np.array(texts, ndmin=ndim, dtype=dtype)
+
+
+    return dataset, max_text_len, max_prop_len
+
+
+def compare_datasets(expected, actual, path="dataset"):
+    """
+    Returns the list of the differences between two results of load_dataset
+    """
+    differences = []
+    if isinstance(expected, dict):
+        if sorted(expected.keys()) != sorted(actual.keys()):
+            differences.append(path + ": keys " + str(sorted(expected.keys())) + " != " + str(sorted(actual.keys())))
+        for key in expected.keys():
+            if key in actual:
+                differences.extend(compare_datasets(expected[key], actual[key], path + "[" + repr(key) + "]"))
+    elif isinstance(expected, np.ndarray):
+        if (not isinstance(actual, np.ndarray) or expected.dtype != actual.dtype or expected.shape != actual.shape
+                or not np.array_equal(expected, actual)):
+            differences.append(path + ": different arrays")
+    elif isinstance(expected, (list, tuple)):
+        if type(expected) != type(actual) or len(expected) != len(actual):
+            differences.append(path + ": different lists")
+        else:
+            for index in range(len(expected)):
+                differences.extend(compare_datasets(expected[index], actual[index], path + "[" + str(index) + "]"))
+                if len(differences) > 10:
+                    break
+    elif expected != actual:
+        differences.append(path + ": " + str(expected) + " != " + str(actual))
+    return differences
+
+
+def load_dataset_benchmark(corpus, size, feature_type='bow', distance=5):
+    """
+    Compares the time and the result of training.load_dataset with legacy_load_dataset on each version of a corpus.
+    The token store of each version is first exported as the .npz files read by legacy_load_dataset: with
+    'embeddings' they contain the vectors, which are compared with the ones of the embedding matrix.
+    :return: the number of versions with different results
+    """
+    # imported here because training requires tensorflow
+    import training
+
+    if distance <= 0:
+        raise Exception("The legacy load_dataset requires a positive distance")
+
+    if size == 300:
+        embed_name = "glove300"
+    elif size == 25:
+        embed_name = "glove25"
+    else:
+        raise Exception("Wrong embedding size")
+
+    dataset_name, versions = CORPORA[corpus]
+    min_prop = dataset_info[dataset_name]["min_prop"]
+    min_text = dataset_info[dataset_name]["min_text"]
+
+    failures = 0
+    for version in versions:
+        print(str(time.ctime()) + "\tLoading " + dataset_name + " " + version)
+        dataframe_path = os.path.join(os.getcwd(), 'Datasets', dataset_name, 'pickles', version, 'total.pkl')
+        if not os.path.exists(dataframe_path):
+            print("Dataframe not found: " + dataframe_path)
+            continue
+
+        arguments = {'dataset_name': dataset_name, 'dataset_version': version, 'feature_type': feature_type,
+                     'min_text_len': min_text, 'min_prop_len': min_prop, 'distance': distance,
+                     'embed_name': embed_name}
+
+        embed_path = os.path.join(os.getcwd(), 'Datasets', dataset_name, "embeddings", embed_name, version)
+        embedding_matrix = None
+        if feature_type == 'embeddings':
+            embedding_matrix = training.load_embedding_matrix(dataset_name, version, embed_name)
+        legacy_path = tempfile.mkdtemp(prefix='legacy_embeddings_')
+        export_legacy_embeddings(embed_path, legacy_path, embedding_matrix)
+
+        start_time = time.time()
+        expected = legacy_load_dataset(embed_path=legacy_path, **arguments)
+        legacy_time = time.time() - start_time
+        shutil.rmtree(legacy_path)
+
+        start_time = time.time()
+        actual = training.load_dataset(prune_candidates=False, **arguments)
+        new_time = time.time() - start_time
+
+        # the pairs pruned by the candidate window are not in the legacy results, whose labels are one-hot lists
+        for split in ('train', 'validation', 'test'):
+            del actual[0][split]['pruned_links']
+            del actual[0][split]['pruned_relations']
+            for field in ('links', 'relations_type', 'sources_type', 'targets_type'):
+                expected[0][split][field] = np.argmax(np.array(expected[0][split][field], ndmin=2),
+                                                      axis=-1).astype(np.int8)
+            if embedding_matrix is not None:
+                for field in ('source_props', 'target_props'):
+                    actual[0][split][field] = embedding_matrix[np.array(actual[0][split][field], dtype=np.int64)]
+
+        differences = compare_datasets(list(expected), list(actual))
+        for difference in differences[:10]:
+            print("\t" + difference)
+        if len(differences) > 0:
+            failures += 1
+
+        print(str(time.ctime()) + "\t" + str(len(differences)) + " differences")
+        print("\tlegacy: %.3f s\tcolumnar: %.3f s" % (legacy_time, new_time))
+    return failures
+
+
+def validation_benchmark(corpus, epochs=5000, documents=100, max_propositions=12, window=500, seed=0):
+    """
+    Long run of the evaluator of the true_validation loop of training.perform_training on a synthetic split with
+    the classes of a corpus: the peak resident memory and the time of each evaluation must not grow with the epochs,
+    and the buffers of the evaluator must be the ones allocated by the first evaluation.
+    The scores of the last evaluation are compared with the ones of a new evaluator.
+    :param epochs: number of evaluations
+    :param documents: number of documents of the split, each with all the pairs of its propositions
+    :param max_propositions: maximum number of propositions of a document
+    :param window: number of epochs over which the time of an evaluation is averaged
+    :return: 1 if the memory or the time grow or the scores differ, 0 otherwise
+    """
+    # imported here because training_utils requires tensorflow
+    from training_utils import PairEvaluator
+
+    dataset_name = CORPORA[corpus][0]
+    output_units = dataset_info[dataset_name]["output_units"]
+    positive_link_labels = dataset_info[dataset_name]["link_as_sum"][0]
+    not_a_relation_label = int(np.argmax(dataset_info[dataset_name]["categorical_link"][None]))
+
+    random_state = np.random.RandomState(seed)
+    s_ids = []
+    t_ids = []
+    sources = []
+    targets = []
+    for document in range(documents):
+        n_propositions = random_state.randint(1, max_propositions + 1)
+        classes = random_state.randint(0, output_units[2], n_propositions)
+        for source in range(n_propositions):
+            for target in range(n_propositions):
+                s_ids.append(str(document) + "_" + str(source))
+                t_ids.append(str(document) + "_" + str(target))
+                sources.append(classes[source])
+                targets.append(classes[target])
+    n_pairs = len(s_ids)
+    truth = [random_state.randint(0, output_units[0], n_pairs).astype(np.int8),
+             random_state.randint(0, output_units[1], n_pairs).astype(np.int8),
+             np.array(sources, dtype=np.int8),
+             np.array(targets, dtype=np.int8)]
+    pruned_links = np.ones(n_pairs // 10, dtype=np.int8)
+    pruned_relations = np.full(n_pairs // 10, not_a_relation_label, dtype=np.int8)
+
+    # a few sets of predictions, reused so that only the evaluation is measured
+    predictions = []
+    for n in range(10):
+        predictions.append([random_state.rand(n_pairs, units).astype(np.float32) for units in output_units])
+
+    print(str(time.ctime()) + "\t" + dataset_name + ": " + str(epochs) + " evaluations of " + str(n_pairs) + " pairs")
+
+    evaluator = PairEvaluator(s_ids, t_ids, truth, positive_link_labels, pruned_links, pruned_relations,
+                              not_a_relation_label)
+
+    window = min(window, epochs // 2)
+    times = np.zeros(epochs)
+    memory = np.zeros(epochs)
+    buffers = None
+    for epoch in range(epochs):
+        start_time = time.time()
+        scores = evaluator.evaluate(predictions[epoch % len(predictions)])
+        times[epoch] = time.time() - start_time
+        memory[epoch] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if buffers is None:
+            buffers = [evaluator.prop_scores, evaluator.link_prediction, evaluator.relation_prediction]
+
+    expected = PairEvaluator(s_ids, t_ids, truth, positive_link_labels, pruned_links, pruned_relations,
+                             not_a_relation_label).evaluate(predictions[(epochs - 1) % len(predictions)])
+
+    first_time = np.mean(times[:window])
+    last_time = np.mean(times[-window:])
+    # ru_maxrss is in KB on Linux
+    memory_growth = (memory[-1] - memory[window - 1]) / 1024
+
+    print("\tfirst %d epochs: %.3f ms\tlast %d epochs: %.3f ms" % (window, first_time * 1000,
+                                                                  window, last_time * 1000))
+    print("\tpeak memory growth after the first %d epochs: %.1f MB" % (window, memory_growth))
+
+    failures = 0
+    if last_time > 1.5 * first_time:
+        print("\tThe time of an evaluation grows with the epochs")
+        failures = 1
+    if memory_growth > 1:
+        print("\tThe memory grows with the epochs")
+        failures = 1
+    if any(buffer is not current for buffer, current in zip(buffers, [evaluator.prop_scores,
+                                                                       evaluator.link_prediction,
+                                                                       evaluator.relation_prediction])):
+        print("\tThe buffers of the evaluator are allocated again")
+        failures = 1
+    for key in expected.keys():
+        if not np.allclose(expected[key], scores[key]):
+            print("\tDifferent scores after " + str(epochs) + " epochs: " + key)
+            failures = 1
+    return failures
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compares the optimized pipeline with the previous implementations")
+
+    parser.add_argument('-c', '--corpus',
+                        choices=["rct", "drinv", "cdcp", "echr", "ukp", "scidtb", "all"],
+                        help="Corpus", default="all")
+    parser.add_argument('-s', '--size', help="embedding size",
+                        choices=[25, 300],
+                        type=int, default=300)
+    parser.add_argument('-m', '--mode', help="texts to be tokenized",
+                        choices=["texts", "propositions"],
+                        default="propositions")
+    parser.add_argument('-b', '--benchmark', help="part of the pipeline to be checked",
+                        choices=["tokenization", "load_dataset", "validation"],
+                        default="tokenization")
+    parser.add_argument('-e', '--epochs', help="number of evaluations of the validation benchmark",
+                        type=int, default=5000)
+    parser.add_argument('-f', '--feature_type', help="feature type for load_dataset",
+                        choices=["bow", "embeddings"],
+                        default="bow")
+
+    args = parser.parse_args()
+
+    if args.corpus == "all":
+        corpora = sorted(CORPORA.keys())
+    else:
+        corpora = [args.corpus]
+
+    differences = 0
+    for corpus in corpora:
+        if args.benchmark == "tokenization":
+            differences += tokenization_routine(corpus, args.size, args.mode)
+        elif args.benchmark == "load_dataset":
+            differences += load_dataset_benchmark(corpus, args.size, args.feature_type)
+        elif args.benchmark == "validation":
+            differences += validation_benchmark(corpus, args.epochs)
+
+    if differences > 0:
+        print("REGRESSION: " + str(differences) + " differences")
+        # the exit status makes the benchmarks usable as checks
+        sys.exit(1)
+    else:
+        print("No differences")
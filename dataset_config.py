@@ -6,12 +6,18 @@ __email__ = "a.galassi@unibo.it"
 
 """
 output_units : (link classifier, relation classifier, source classifier, target classifier)
+max_candidate_distance : the pairs whose components are farther apart are not given to the network, in all the splits,
+                         and are evaluated as non-links (None to keep all the pairs)
+min_candidate_overlap : the pairs outside the window are kept anyway if the sets of tokens of their components have at
+                        least this Jaccard similarity (None to prune them all)
 """
 
 dataset_info = {"AAEC_v2": {"output_units": (2, 5, 3, 3),
                             "min_text": 168,
                             "min_prop": 72,
                             "link_as_sum": [[0, 2], [1, 3, 4]],
+                            "max_candidate_distance": None,
+                            "min_candidate_overlap": None,
                             "categorical_prop": {'Premise': [1, 0, 0, ],
                                                  'Claim': [0, 1, 0, ],
                                                  'MajorClaim': [0, 0, 1],
@@ -47,6 +53,8 @@ dataset_info = {"AAEC_v2": {"output_units": (2, 5, 3, 3),
                              "min_text": 168,  # NO
                              "min_prop": 95,
                              "link_as_sum": [[0, 2], [1, 3, 4, 5, 6, 7]],
+                             "max_candidate_distance": 10,  # same window as DrInventor, the creator drops farther links the same way
+                             "min_candidate_overlap": 0.5,
                              "categorical_prop": {'premise': [1, 0],
                                                   'claim': [0, 1],
                                                   },
@@ -74,6 +82,8 @@ dataset_info = {"AAEC_v2": {"output_units": (2, 5, 3, 3),
                                "min_text": 552,
                                "min_prop": 153,
                                "link_as_sum": [[0, 2], [1, 3, 4]],
+                               "max_candidate_distance": None,
+                               "min_candidate_overlap": None,
                                "categorical_prop": {'policy': [1, 0, 0, 0, 0],
                                                     'fact': [0, 1, 0, 0, 0],
                                                     'testimony': [0, 0, 1, 0, 0],
@@ -110,6 +120,8 @@ dataset_info = {"AAEC_v2": {"output_units": (2, 5, 3, 3),
                         "min_text": 2,  # wrong, never measured
                         "min_prop": 181,
                         "link_as_sum": [[0, 2], [1, 3, 4]],
+                        "max_candidate_distance": 5,  # width of the distance features of its training
+                        "min_candidate_overlap": 0.5,
                         "categorical_prop": {'Premise': [1, 0, ],
                                              'Claim': [0, 1, ]
                                              },
@@ -145,6 +157,8 @@ dataset_info = {"AAEC_v2": {"output_units": (2, 5, 3, 3),
                                               "min_text": 2,  # wrong, never measured
                                               "min_prop": 95,
                                               "link_as_sum": [[0, 2], [1, 3, 4]],
+                                              "max_candidate_distance": None,
+                                              "min_candidate_overlap": None,
                                               "categorical_prop": {'proposal': [1, 0, 0, 0, 0, 0],
                                                                    'assertion': [0, 1, 0, 0, 0, 0],
                                                                    'result': [0, 0, 1, 0, 0, 0],
@@ -190,6 +204,8 @@ dataset_info = {"AAEC_v2": {"output_units": (2, 5, 3, 3),
                                "min_text": 2,  # wrong, never measured
                                "min_prop": 106,
                                "link_as_sum": [[0, 2, 4], [1, 3, 5]],
+                               "max_candidate_distance": 10,  # window of the arg10 dataframe
+                               "min_candidate_overlap": 0.5,
                                "categorical_prop": {'own_claim': [1, 0, 0, ],
                                                     'background_claim': [0, 1, 0],
                                                     'data': [0, 0, 1],
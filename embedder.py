@@ -9,24 +9,124 @@ import pandas
 import os
 import numpy as np
 import pickle
+import time
+import json
+import hashlib
 import argparse
-import range as range
+import multiprocessing
 
-from glove_loader import SEPARATORS, STOPWORDS, REPLACINGS
+from tokenizer import Tokenizer, UNKNOWN, SEPARATORS, REPLACINGS, STOPWORDS, normalize
+from token_store import TokenStore, TokenStoreWriter
 
-def save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode='texts', type='bow'):
+
+# number of texts embedded by a process at once
+EMBED_BATCH = 500
+# file of the embeddings folder with the hashes of the embedded texts
+MANIFEST_FILE = 'manifest.json'
+
+# read-only state of the embedding processes, set by init_embedding_worker
+worker_state = {}
+
+
+def init_embedding_worker(vocabulary):
+    """
+    Prepares the tokenizer of a process. With the fork start method the vocabulary is shared with the parent process
+    instead of being copied.
+    """
+    worker_state['tokenizer'] = Tokenizer(vocabulary)
+
+
+def embed_batch(batch):
+    """
+    Embeds a batch of (ID, text) pairs.
+    Returns the list of (ID, embeddings, tokens) and the hits and misses of the tokenizer cache.
+    The tokens are returned only for the texts with unrecognized tokens, otherwise they are None.
+    """
+    tokenizer = worker_state['tokenizer']
+
+    cache_info = tokenizer.cache_info()
+    hits = cache_info.hits
+    misses = cache_info.misses
+
+    results = []
+    for text_id, text in batch:
+        tokens = tokenizer.tokenize(text)
+
+        embeddings = []
+        recognized = True
+        for token in tokens:
+            if token == UNKNOWN:
+                recognized = False
+            else:
+                embeddings.append(token)
+
+        embeddings = np.array(embeddings, dtype=int)
+        if recognized:
+            tokens = None
+        results.append((text_id, embeddings, tokens))
+
+    cache_info = tokenizer.cache_info()
+    return results, cache_info.hits - hits, cache_info.misses - misses
+
+
+def vocabulary_fingerprint(word_list):
+    """
+    Hash of everything, apart from the text, that determines the token ids of a text
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(json.dumps([SEPARATORS, REPLACINGS, STOPWORDS]).encode('utf-8'))
+    fingerprint.update('\n'.join([str(word) for word in word_list]).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def load_manifest(embeddings_path):
+    """
+    Returns the manifest of an embeddings folder, None if it does not exist
+    """
+    manifest_path = os.path.join(embeddings_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(embeddings_path, manifest):
+    if not os.path.exists(embeddings_path):
+        os.makedirs(embeddings_path)
+    manifest_path = os.path.join(embeddings_path, MANIFEST_FILE)
+    temporary_path = manifest_path + '.tmp'
+    with open(temporary_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=0, sort_keys=True)
+    os.replace(temporary_path, manifest_path)
+
+
+def save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode='texts', processes=1, incremental=True):
+    """
+    Tokenizes and embeds the texts or the propositions of a dataframe, saving them in the token store of
+    embeddings_path.
+    The texts are divided in batches, which are embedded by a pool of processes. The store sorts the sequences by ID,
+    so the result does not depend on the number of processes.
+    Only the token ids are saved, for both the feature types of training.load_dataset: with 'embeddings' the vectors
+    are gathered from the embedding matrix during the training.
+    The hashes of the embedded texts are saved in the manifest of the folder, along with a fingerprint of the
+    vocabulary: only the new or changed texts are embedded again, and the ones that are no longer in the dataframe are
+    removed from the store.
+
+    :param processes: number of processes used for the embedding
+    :param incremental: if False, all the texts are embedded again
+    """
     df = pandas.read_pickle(dataframe_path)
     vocabulary_list = np.load(vocabulary_path)
-    embed_list = vocabulary_list['embeds']
     word_list = vocabulary_list['vocab']
 
+    # the 0 index must be left empty for padding
     vocabulary = {}
     for index in range(len(word_list)):
-        if type == 'embeddings':
-            vocabulary[word_list[index]] = embed_list[index]
-        elif type == 'bow':
-            # the 0 index must be left empty for padding
-            vocabulary[word_list[index]] = index + 1
+        vocabulary[word_list[index]] = index + 1
 
     df_text = []
     if mode == 'texts':
@@ -34,125 +134,99 @@ def save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode='text
     elif mode == 'propositions':
         df_text = df[['source_ID', 'source_proposition']].drop_duplicates()
 
-    separators = SEPARATORS
-
+    texts = []
     for index, (text_id, text) in df_text.iterrows():
+        texts.append((text_id, normalize(text)))
 
-        for old in REPLACINGS.keys():
-            text = text.replace(old, REPLACINGS[old])
-
-        splits = text.split()
-        tokens = ['']*len(splits)
-
-        # initial split with common separators
-        i = 0
-        while i < len(splits):
-            word = splits[i]
-
-            # remove possible stop symbols in the end of the token
-            if len(word) > 1 and word[-1] in STOPWORDS and word[:-1] in vocabulary.keys():
-                symbol = word[-1]
-                word = word[:-1]
-                splits.insert(i + 1, symbol)
-                tokens.insert(i + 1, symbol)
-                splits[i] = word
-                tokens[i] = word
-                tokens[i] = word
-            elif word in vocabulary.keys():
-                tokens[i] = word
-
-            i += 1
-
-
-        for separator in separators:
-            i = 0
-            # iterate on the whole list of split, creating new splits with the separator
-            while i < len(splits):
-                # the word is not empty and is not recognized as a token
-                if tokens[i] == '' and splits[i] != '':
-                    index = 0
-                    prev_index = 0
-                    while index < len(splits[i]) and index >= 0:
-                        word = splits[i]
-                        index = word.find(separator, index)
-                        if index >= 0:
-                            prev_word = word[prev_index:index]
-                            next_word = word[index+len(separator):]
-                            if prev_word != '':
-                                splits.insert(i, prev_word)
-                                token = ''
-                                tokens.insert(i, token)
-                                i += 1
-
-                            # adds the separator
-                            splits[i] = separator
-                            tokens[i] = separator
-
-                            # avoids finding the same separator too many times
-                            index += len(separator)
-
-                            if next_word != '':
-                                splits.insert(i+1, next_word)
-                                token = ''
-                                tokens.insert(i+1, token)
-                i += 1
-
-            # recognize tokens
-            i = 0
-            while i < len(splits):
-                word = splits[i]
-                # remove possible stop symbols in the end of the token
-                if len(word) > 1 and word[-1] in STOPWORDS and word[:-1] in vocabulary.keys():
-                    symbol = word[-1]
-                    word = word[:-1]
-                    splits.insert(i + 1, symbol)
-                    tokens.insert(i + 1, symbol)
-                    splits[i] = word
-                    tokens[i] = word
-                    tokens[i] = word
-
-                elif word in vocabulary.keys():
-                    tokens[i] = word
-
-                i += 1
+    text_by_id = dict(texts)
 
-        embeddings = []
-        for token in tokens:
-            if token == '':
+    fingerprint = vocabulary_fingerprint(word_list)
+    old_store = TokenStore(embeddings_path)
+    manifest = load_manifest(embeddings_path)
+    if (not incremental or manifest is None or manifest['vocabulary'] != fingerprint or manifest['mode'] != mode
+            or not old_store.packed):
+        manifest = {'vocabulary': fingerprint, 'mode': mode, 'texts': {}}
+    old_hashes = manifest['texts']
+
+    # only the new and changed texts are embedded
+    hashes = {}
+    to_embed = []
+    global MAX
+    for text_id, text in texts:
+        ID = str(text_id)
+        hashes[ID] = text_hash(text)
+        if ID in old_hashes and old_hashes[ID] == hashes[ID] and ID in old_store:
+            MAX = max(MAX, len(old_store[ID]))
+        else:
+            to_embed.append((text_id, text))
+    stale = []
+    for ID in old_store.ids():
+        if ID not in hashes:
+            stale.append(ID)
+    del old_store
+
+    print(str(time.ctime()) + "\t" + str(len(texts)) + " " + mode + ": " + str(len(to_embed)) + " to embed, " +
+          str(len(texts) - len(to_embed)) + " unchanged, " + str(len(stale)) + " removed")
+
+    batches = []
+    for begin in range(0, len(to_embed), EMBED_BATCH):
+        batches.append(to_embed[begin:begin + EMBED_BATCH])
+
+    starttime = time.time()
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=init_embedding_worker,
+                                    initargs=(vocabulary,))
+        results = pool.imap(embed_batch, batches)
+    else:
+        pool = None
+        init_embedding_worker(vocabulary)
+        results = map(embed_batch, batches)
+
+    # the sequences are written only by this process
+    store = TokenStoreWriter(embeddings_path)
+    for ID in stale:
+        store.remove(ID)
+    done = 0
+    hits = 0
+    misses = 0
+    for batch_results, batch_hits, batch_misses in results:
+        hits += batch_hits
+        misses += batch_misses
+        for text_id, embeddings, tokens in batch_results:
+            if tokens is not None:
                 print("TOKEN NOT RECOGNIZED!")
                 print(text_id)
-                print(text)
+                print(text_by_id[text_id])
                 print(tokens)
                 print()
-            else:
-                embeddings.append(vocabulary[token])
-
-        array_type = np.float32
-        if type == 'bow':
-            array_type = int
 
-        embeddings = np.array(embeddings, dtype=array_type)
+            store.add(text_id, embeddings)
 
-        if mode == 'texts':
-            name = str(text_id) + ".npz"
-        elif mode == 'propositions':
-            name = str(text_id) + ".npz"
+            length = len(embeddings)
+            if length > MAX:
+                MAX = length
 
-        if not os.path.exists(embeddings_path):
-            os.makedirs(embeddings_path)
+        done += len(batch_results)
+        print("\t" + str(done) + "/" + str(len(to_embed)) + " " + mode)
 
-        document_path = os.path.join(embeddings_path, name)
-        np.savez(document_path, embeddings)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        global MAX
-        max = len(embeddings)
-        if max > MAX:
-            MAX = max
+    if len(to_embed) > 0 or len(stale) > 0:
+        store.close()
+    manifest['texts'] = hashes
+    save_manifest(embeddings_path, manifest)
 
+    seconds = time.time() - starttime
+    print(str(time.ctime()) + "\tEmbedded " + str(len(to_embed)) + " " + mode + " in " + str(round(seconds, 1)) +
+          " seconds: " + str(int(len(to_embed) / max(seconds, 1e-6))) + " " + mode + "/sec")
+    print("Tokenizer cache: " + str(hits) + " hits, " + str(misses) + " misses")
     print("Finished")
 
 
-def RCT_routine(size):
+def RCT_routine(size, processes=1):
     if size == 300:
         embed_name = "glove300"
     elif size == 25:
@@ -164,7 +238,6 @@ def RCT_routine(size):
     MAX = 0
 
     dataset_name = "RCT"
-    type = "bow"
     mode = "propositions"
 
     dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
@@ -176,11 +249,11 @@ def RCT_routine(size):
         # load glove vocabulary and embeddings
         vocabulary_path = os.path.join(dataset_path, "resources", embed_name, 'glove.embeddings.npz')
 
-        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, type)
+        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, processes)
     print("MAX = " + str(MAX))
 
 
-def DrInventor_routine(size):
+def DrInventor_routine(size, processes=1):
     if size == 300:
         embed_name = "glove300"
     elif size == 25:
@@ -193,7 +266,6 @@ def DrInventor_routine(size):
     MAX = 0
 
     dataset_name = "DrInventor"
-    type = "bow"
     mode = "propositions"
 
     dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
@@ -205,12 +277,12 @@ def DrInventor_routine(size):
         # load glove vocabulary and embeddings
         vocabulary_path = os.path.join(dataset_path, "resources", embed_name, 'glove.embeddings.npz')
 
-        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, type)
+        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, processes)
     print("MAX = " + str(MAX))
 
 
 
-def UKP_routine(size):
+def UKP_routine(size, processes=1):
     if size == 300:
         embed_name = "glove300"
     elif size == 25:
@@ -223,7 +295,6 @@ def UKP_routine(size):
     MAX = 0
 
     dataset_name = 'AAEC_v2'
-    type = "bow"
     mode = "propositions"
 
     dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
@@ -235,11 +306,11 @@ def UKP_routine(size):
         # load glove vocabulary and embeddings
         vocabulary_path = os.path.join(dataset_path, "resources", embed_name, 'glove.embeddings.npz')
 
-        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, type)
+        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, processes)
     print("MAX = " + str(MAX))
 
 
-def cdcp_routine(size):
+def cdcp_routine(size, processes=1):
     if size == 300:
         embed_name = "glove300"
     elif size == 25:
@@ -252,7 +323,6 @@ def cdcp_routine(size):
     MAX = 0
 
     dataset_name = "cdcp_ACL17"
-    type = "bow"
     mode = "propositions"
 
     dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
@@ -264,11 +334,11 @@ def cdcp_routine(size):
         # load glove vocabulary and embeddings
         vocabulary_path = os.path.join(dataset_path, "resources", embed_name, 'glove.embeddings.npz')
 
-        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, type)
+        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, processes)
     print("MAX = " + str(MAX))
 
 
-def scidtb_routine(size):
+def scidtb_routine(size, processes=1):
     if size == 300:
         embed_name = "glove300"
     elif size == 25:
@@ -281,7 +351,6 @@ def scidtb_routine(size):
     MAX = 0
 
     dataset_name = "scidtb_argmin_annotations"
-    type = "bow"
     mode = "propositions"
 
     dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
@@ -293,16 +362,15 @@ def scidtb_routine(size):
         # load glove vocabulary and embeddings
         vocabulary_path = os.path.join(dataset_path, "resources", embed_name, 'glove.embeddings.npz')
 
-        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, type)
+        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, processes)
     print("MAX = " + str(MAX))
 
 
-def ECHR_routine():
+def ECHR_routine(processes=1):
     global MAX
     MAX = 0
 
     dataset_name = 'ECHR2018'
-    type = "bow"
     mode = "propositions"
 
     dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
@@ -310,11 +378,11 @@ def ECHR_routine():
 
         dataframe_path = os.path.join(dataset_path, 'pickles', version, 'total.pkl')
 
-        embeddings_path = os.path.join(dataset_path, type, version)
+        embeddings_path = os.path.join(dataset_path, 'bow', version)
         # load glove vocabulary and embeddings
         vocabulary_path = os.path.join(dataset_path, 'glove', 'glove.embeddings.npz')
 
-        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, type)
+        save_embeddings(dataframe_path, vocabulary_path, embeddings_path, mode, processes)
     print("MAX = " + str(MAX))
 
 
@@ -328,22 +396,25 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--size', help="embedding size",
                         choices=[25, 300],
                         type=int, default=300)
+    parser.add_argument('-p', '--processes', help="Number of processes used to embed the texts",
+                        type=int, default=multiprocessing.cpu_count())
 
     args = parser.parse_args()
 
     corpus = args.corpus
     size = args.size
+    processes = args.processes
 
     if corpus.lower() == "rct":
-        RCT_routine(size)
+        RCT_routine(size, processes)
     elif corpus.lower() == "cdcp":
-        cdcp_routine(size)
+        cdcp_routine(size, processes)
     elif corpus.lower() == "drinv":
-        DrInventor_routine(size)
+        DrInventor_routine(size, processes)
     elif corpus.lower() == "ukp":
-        UKP_routine(size)
+        UKP_routine(size, processes)
     elif corpus.lower() == "scidtb":
-        scidtb_routine(size)
+        scidtb_routine(size, processes)
     else:
         print("Datset not yet supported")
 
@@ -15,7 +15,7 @@ import krippendorff
 
 from keras.utils.vis_utils import plot_model
 from tensorflow.keras.models import load_model, model_from_json
-from training_utils import get_avgF1
+from training_utils import get_avgF1, make_feed, predict_pairs, add_pruned_pairs, read_checkpoint
 from sklearn.metrics import f1_score, confusion_matrix, precision_recall_fscore_support, classification_report
 from glove_loader import DIM
 from scipy import stats
@@ -33,7 +33,7 @@ MAXITERATIONS = 20
 
 def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='bow', retrocompatibility=False, distance=5,
                        ensemble=None, ensemble_top_n=1.00, ensemble_top_criterion="link", token_wise=False, error_analysis=False,
-                       visualize_attention=False, embed_name="glove300"):
+                       visualize_attention=False, embed_name="glove300", bucketing=False, shared_dataset=False):
     return_value = 0
 
     # name of the network
@@ -64,7 +64,14 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
                                                                 distance=distance,
                                                                 min_text_len=min_text,
                                                                 min_prop_len=min_prop,
-                                                                embed_name=embed_name)
+                                                                embed_name=embed_name,
+                                                                use_cache=True,
+                                                                shared=shared_dataset)
+
+    # with 'embeddings' the propositions are token ids, whose vectors are gathered batch by batch
+    embedding_matrix = None
+    if feature_type == 'embeddings':
+        embedding_matrix = training.load_embedding_matrix(dataset_name, dataset_version, embed_name, mmap=True)
 
 
     # for token-wise evaluation, memorize the number of tokens in each proposition
@@ -96,7 +103,7 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
         X_target_train = dataset[split]['target_props']
         del dataset[split]['target_props']
         Y_links_train = np.array(dataset[split]['links'])
-        Y_rtype_train = np.array(dataset[split]['relations_type'], dtype=np.float32)
+        Y_rtype_train = np.array(dataset[split]['relations_type'])
         Y_stype_train = np.array(dataset[split]['sources_type'])
         Y_ttype_train = np.array(dataset[split]['targets_type'])
 
@@ -223,6 +230,7 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
     # used to compute the F1 score for the relations
     relations_labels = this_ds_info["link_as_sum"][0]
     not_a_link_labels = this_ds_info["link_as_sum"][1]
+    not_a_relation_label = int(np.argmax(this_ds_info["categorical_link"][None]))
 
 
     fmeasure_0 = get_avgF1([0])
@@ -510,7 +518,8 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
             difference_norm = [0] * (distance*2 + 1)
             differences = dataset[split]['difference']
 
-            for index in range(len(correct_predictions_link)):
+            # the pairs dropped by the candidate pruning are at the end and have no difference
+            for index in range(min(len(correct_predictions_link), len(differences))):
                 difference = differences[index]
                 if difference > distance:
                     difference = distance
@@ -552,26 +561,43 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
         print("Evaluating networks: " + str(iteration+1) + "/" + str(iterations+1))
         sys.stdout.flush()
 
-        # explore all the possible epochs to fine the last one (the first one found)
-        last_epoch = MAXEPOCHS
         last_path = ""
 
-        for epoch in range(last_epoch, 0, -1):
-            if save_weights_only:
-                netpath = os.path.join(netfolder, netname + "_" + str(iteration) + '_weights.%03d.h5' % epoch)
-            else:
-                netpath = os.path.join(netfolder, netname + "_" + str(iteration) + '_completemodel.%03d.h5' % epoch)
-
+        # the best network is listed in the manifest written by the training
+        entry = read_checkpoint(netfolder, netname + "_" + str(iteration))
+        if entry is not None:
+            netpath = os.path.join(netfolder, entry['path'])
             if os.path.exists(netpath):
                 last_path = netpath
 
                 print(str(time.ctime()) + "\tLOADING NETWORK: " + last_path)
 
-                if save_weights_only:
+                if entry['weights_only']:
                     model.load_weights(last_path)
                 else:
                     model = load_model(last_path, custom_objects=custom_objects)
-                break
+
+        # networks trained before the manifest: explore all the possible epochs to find the last one (the first found)
+        if last_path == "":
+            last_epoch = MAXEPOCHS
+
+            for epoch in range(last_epoch, 0, -1):
+                if save_weights_only:
+                    netpath = os.path.join(netfolder, netname + "_" + str(iteration) + '_weights.%03d.h5' % epoch)
+                else:
+                    netpath = os.path.join(netfolder, netname + "_" + str(iteration) +
+                                           '_completemodel.%03d.h5' % epoch)
+
+                if os.path.exists(netpath):
+                    last_path = netpath
+
+                    print(str(time.ctime()) + "\tLOADING NETWORK: " + last_path)
+
+                    if save_weights_only:
+                        model.load_weights(last_path)
+                    else:
+                        model = load_model(last_path, custom_objects=custom_objects)
+                    break
 
 
         if X == None:
@@ -669,7 +695,15 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
             # ax0 = samples
             # ax1 = classes
 
-            Y_pred = model.predict(X[split])
+            # the batches are padded to their longest proposition only if the network accepts any length
+            split_bucketing = bucketing and model.input_shape[0][1] is None
+            length_multiple = 1
+            for layer in model.layers:
+                if layer.name == 'prop_pooling':
+                    length_multiple = layer.pool_size[0]
+
+            Y_pred = predict_pairs(model, make_feed(X[split], embedding_matrix=embedding_matrix,
+                                                    bucketing=split_bucketing, length_multiple=length_multiple))
 
             # every proposition is evaluated multiple times. all these evaluation must be merged together.
             # merging is performed choosing the class that has received the highest probability score summing all the cases
@@ -707,7 +741,7 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
                 t_test_scores[tid].append(Y[split][3][index])
 
             Y_pred_prop_real_list = []
-            Y_test_prop_real_list = []
+            Y_test_prop_real = []
 
             if len(components_id_list[split]) == 0:
                 for p_id in sorted(t_pred_scores.keys()):
@@ -716,7 +750,9 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
             # merges sources and targets
             for p_id in sorted(t_pred_scores.keys()):
                 Y_pred_prop_real_list.append(np.concatenate([s_pred_scores[p_id], t_pred_scores[p_id]]))
-                Y_test_prop_real_list.append(np.concatenate([s_test_scores[p_id], t_test_scores[p_id]]))
+                # the true class is the most frequent among the pairs (all of them have the same one)
+                labels = np.concatenate([s_test_scores[p_id], t_test_scores[p_id]])
+                Y_test_prop_real.append(np.argmax(np.bincount(labels)))
 
             # 3 dim
             # ax0: ids
@@ -724,31 +760,27 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
             # ax2: classes
             # value: score associated to the class
             Y_pred_prop_real_list = np.array(Y_pred_prop_real_list)
-            Y_test_prop_real_list = np.array(Y_test_prop_real_list)
 
             Y_pred_prop_real = []
-            Y_test_prop_real = []
             # for each id, sum the prediction scores for each class across the samples
             for index in range(len(Y_pred_prop_real_list)):
                 Y_pred_prop_real.append(np.sum(Y_pred_prop_real_list[index], axis=-2))
-                Y_test_prop_real.append(np.sum(Y_test_prop_real_list[index], axis=-2))
 
             # 2 dim: ids, classes; value: score for each class
             Y_pred_scores_prop_real = np.array(Y_pred_prop_real)
-            Y_test_scores_prop_real = np.array(Y_test_prop_real)
 
 
             # select the class that has received the highest probability
             Y_pred_prop_real = np.argmax(Y_pred_scores_prop_real, axis=-1)
-            Y_test_prop_real = np.argmax(Y_test_scores_prop_real, axis=-1)
+            Y_test_prop_real = np.array(Y_test_prop_real)
 
             # --- end of the evaluation of the single propositions scores
 
             Y_pred_links = np.argmax(Y_pred[0], axis=-1)
-            Y_test_links = np.argmax(Y[split][0], axis=-1)
+            Y_test_links = np.asarray(Y[split][0])
 
             Y_pred_rel = np.argmax(Y_pred[1], axis=-1)
-            Y_test_rel = np.argmax(Y[split][1], axis=-1)
+            Y_test_rel = np.asarray(Y[split][1])
 
 
             # If a comparison with a sequence tagging method is needed, it is necessary to split components into tokens
@@ -802,6 +834,14 @@ def perform_evaluation(netfolder, dataset_name, dataset_version, feature_type='b
                 Y_pred_scores_links = np.delete(Y_pred_scores_links, reflexive, axis=0)
                 Y_pred_scores_rel = np.delete(Y_pred_scores_rel, reflexive, axis=0)
 
+            # the pairs dropped by the candidate pruning are predicted as non-links
+            Y_test_links, Y_pred_links, Y_pred_scores_links = add_pruned_pairs(Y_test_links, Y_pred_links,
+                                                                               dataset[split]['pruned_links'], 1,
+                                                                               Y_pred_scores_links)
+            Y_test_rel, Y_pred_rel, Y_pred_scores_rel = add_pruned_pairs(Y_test_rel, Y_pred_rel,
+                                                                         dataset[split]['pruned_relations'],
+                                                                         not_a_relation_label, Y_pred_scores_rel)
+
             # Merge all the not-link labels in the first of them
             for label in not_a_link_labels:
                 Y_test_rel = np.where(Y_test_rel == label, not_a_link_labels[-1], Y_test_rel)
@@ -1117,7 +1157,8 @@ def regenerate_network(netname="cdcp7net2018", dataset_name='cdcp_ACL17', datase
                                                            min_prop_len=min_prop,
                                                            distance=distance_num,
                                                            distance_train_limit=distance_train_limit,
-                                                                    embed_name="glove300")
+                                                                    embed_name="glove300",
+                                                                    use_cache=True)
         print(str(time.ctime()) + "\tDATASET LOADED...")
         sys.stdout.flush()
 
@@ -1129,7 +1170,7 @@ def regenerate_network(netname="cdcp7net2018", dataset_name='cdcp_ACL17', datase
         X_target_train = dataset[split]['target_props']
         del dataset[split]['target_props']
         Y_links_train = np.array(dataset[split]['links'])
-        Y_rtype_train = np.array(dataset[split]['relations_type'], dtype=np.float32)
+        Y_rtype_train = np.array(dataset[split]['relations_type'])
         Y_stype_train = np.array(dataset[split]['sources_type'])
         Y_ttype_train = np.array(dataset[split]['targets_type'])
 
@@ -1196,18 +1237,7 @@ def regenerate_network(netname="cdcp7net2018", dataset_name='cdcp_ACL17', datase
 
         bow = None
         if feature_type == 'bow':
-            dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
-            vocabulary_path = os.path.join(dataset_path, 'resources', "glove300", dataset_version,
-                                           'glove.embeddings.npz')
-            if not os.path.exists(vocabulary_path):
-                vocabulary_path = os.path.join(dataset_path, 'resources', "glove300", 'glove.embeddings.npz')
-            vocabulary_list = np.load(vocabulary_path)
-            embed_list = vocabulary_list['embeds']
-            word_list = vocabulary_list['vocab']
-
-            bow = np.zeros((len(word_list) + 1, DIM))
-            for index in range(len(word_list)):
-                bow[index + 1] = embed_list[index]
+            bow = training.load_embedding_matrix(dataset_name, dataset_version, "glove300")
             print(str(time.ctime()) + "\t\t\tEMBEDDINGS LOADED...")
 
         realname = netname
@@ -1275,31 +1305,39 @@ def regenerate_network(netname="cdcp7net2018", dataset_name='cdcp_ACL17', datase
         print("Evaluating networks: " + str(iteration+1) + "/" + str(iterations+1))
         sys.stdout.flush()
 
-        # explore all the possible epochs to fine the last one (the first one found)
-        last_epoch = MAXEPOCHS
         last_path = ""
 
-        for epoch in range(last_epoch, 0, -1):
-            netpath = os.path.join(netfolder, netname + "_" + str(iteration) + '_weights.%03d.h5' % epoch)
+        # the best network is listed in the manifest written by the training
+        entry = read_checkpoint(netfolder, netname + "_" + str(iteration))
+        if entry is not None and os.path.exists(os.path.join(netfolder, entry['path'])):
+            last_path = os.path.join(netfolder, entry['path'])
 
-            print(netpath)
+        # networks trained before the manifest: explore all the possible epochs to find the last one (the first found)
+        if last_path == "":
+            last_epoch = MAXEPOCHS
 
-            if os.path.exists(netpath):
-                last_path = netpath
+            for epoch in range(last_epoch, 0, -1):
+                netpath = os.path.join(netfolder, netname + "_" + str(iteration) + '_weights.%03d.h5' % epoch)
 
-                print(str(time.ctime()) + "\tLOADING NETWORK: " + last_path)
+                if os.path.exists(netpath):
+                    last_path = netpath
+                    break
 
-                if save_weights_only:
-                    model.load_weights(last_path)
+        if last_path != "":
 
-                    print(" YEEEESSSSSSSSSSSSS")
+            print(str(time.ctime()) + "\tLOADING NETWORK: " + last_path)
 
-                    model_name = netname + '_modelv2.json'
-                    json_model = model.to_json()
-                    with open(os.path.join(save_dir, model_name), 'w') as outfile:
-                        json.dump(json_model, outfile)
+            if save_weights_only:
+                model.load_weights(last_path)
 
-                    exit()
+                print(" YEEEESSSSSSSSSSSSS")
+
+                model_name = netname + '_modelv2.json'
+                json_model = model.to_json()
+                with open(os.path.join(save_dir, model_name), 'w') as outfile:
+                    json.dump(json_model, outfile)
+
+                exit()
     exit()
 
 
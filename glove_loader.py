@@ -1,446 +1,911 @@
-__author__ = "Andrea Galassi"
-__copyright__ = "Copyright 2018-2020 Andrea Galassi"
-__license__ = "BSD 3-clause"
-__version__ = "0.2.0"
-__email__ = "a.galassi@unibo.it"
-
-
-import pandas
-import os
-import numpy as np
-import re
-import argparse
-
-DIM = 300
-SEPARATORS = ['(', ')', '[', ']', '{', '}', '...', '_', '--', '|',
-              ';', ':',
-              "±", "·", "≥", "≤", "≈", '=', "<", ">", "£", "$", "€",
-              '!!!', '???', '?!?', '!?!', '?!', '!?', '??', '!!',
-              '!', '?',
-              '/', '"', '%', '$', '*', '#', '+',
-              ',', '.',
-              "'s", "'ve", "'ll", "'re", "'d",
-              '-', "'",
-              "∂", "∆", "∇"]
-
-REPLACINGS = {"’": "'",
-              "‘": "'",
-              "“": '"',
-              "”": '"',
-              "''": '"',
-              "—": '-',
-              "−": '-',
-              "–": '-',
-              "⁄": '/'}
-
-STOPWORDS = ['.', ',', ':', ';']
-
-def load_glove(vocabulary_source_path):
-
-    print("Loading Glove")
-    f = open(vocabulary_source_path, 'r', encoding="utf-8")
-    model = {}
-
-    for line in f:
-        splits = line.split(' ')
-        n_splits = len(splits)
-        word = ""
-        n = 0
-        while (n_splits - n) > DIM:
-            word += " " + splits[n]
-            n += 1
-        word = word[1:]
-        # embedding = np.array([float(val) for val in splitLine[1:]])
-        # model[word] = embedding
-        model[word] = line
-
-    print("Glove loaded")
-    return model
-
-
-
-def vocabulary_creator(model, vocabulary_destination_path, dataframe_path):
-
-
-
-    df = pandas.read_pickle(dataframe_path)
-
-    propositions = df['source_proposition'].drop_duplicates()
-
-
-    print(len(propositions))
-
-    documents = []
-    # replace different versions of the same character
-    for proposition in propositions:
-        for old in REPLACINGS.keys():
-            proposition = proposition.replace(old, REPLACINGS[old])
-        documents.append(proposition)
-
-
-    if not os.path.exists(vocabulary_destination_path):
-        os.makedirs(vocabulary_destination_path)
-    orphans_path = os.path.join(vocabulary_destination_path, 'glove.orphans.txt')
-    embeddings_path = os.path.join(vocabulary_destination_path, 'glove.embeddings.txt')
-    npz_path = os.path.join(vocabulary_destination_path, 'glove.embeddings.npz')
-    vocabulary_path = os.path.join(vocabulary_destination_path, 'glove.vocabulary.txt')
-    logfile_path = os.path.join(vocabulary_destination_path, 'glove.log.txt')
-    logfile = open(logfile_path, 'w')
-    logfile.write('Sep\tVoc_size\tOrphans\n')
-
-    print("Splitting")
-
-    vocabulary, orphans = document_tokenizer_and_embedder(documents, model, logfile)
-
-
-    logfile.close()
-    if '' in orphans:
-        orphans.remove('')
-
-
-    # print vocabulary file
-    vocabulary_file = open(vocabulary_path, 'w')
-    for word in sorted(vocabulary.keys()):
-        vocabulary_file.write(word)
-        vocabulary_file.write('\n')
-    vocabulary_file.close()
-
-    # print orphans file
-    orphans_file = open(orphans_path, 'w')
-    for word in sorted(orphans):
-        orphans_file.write(word)
-        orphans_file.write("\n")
-    orphans_file.close()
-
-    print("handling orphans")
-
-    # create random embeddings for orphans
-    for word in sorted(orphans):
-        embedding = np.random.rand(DIM) - 0.5
-        line = word + " "
-        for value in embedding:
-            line += ("%.5g " % value) + " "
-        line += '\n'
-        vocabulary[word] = line
-
-    print("Saving")
-
-    # save embeddings
-    embeddings = []
-    vocabulary_list = []
-    embeddings_file = open(embeddings_path, 'w')
-    for word in sorted(vocabulary.keys()):
-        line = vocabulary[word]
-        embeddings_file.write(line)
-        splits = line.split()
-        embedding = splits[-DIM:]
-        embedding = np.array(embedding, dtype=np.float32)
-        embeddings.append(embedding)
-        vocabulary_list.append(word)
-    embeddings_file.close()
-
-    print(vocabulary_list[0])
-
-    np.savez(npz_path, vocab=vocabulary_list, embeds=embeddings)
-
-    print('Finished')
-
-
-def print_vocabulary_and_orphans(vocabulary, vocabulary_path, orphans, orphans_path):
-    voc_file = open(vocabulary_path,'w')
-    for word in sorted(vocabulary.keys()):
-        voc_file.write(vocabulary[word])
-    voc_file.close()
-    orphans_file = open(orphans_path, 'w')
-    for word in sorted(orphans):
-        orphans_file.write(word)
-        orphans_file.write("\n")
-    orphans_file.close()
-
-
-def document_tokenizer_and_embedder(documents, model,
-                                    logfile=None, vocabulary={}, separators=None, not_vocab_separators=None):
-    """
-        Split the documents in tokens.
-        The splitting is progressive using a series of separators,
-        when a token match a key in model, it is inserted in the vocabulary.
-        At the end of the process, the token that still do not match the model are returned as "orphans".
-
-        Parameters
-        ----------
-        documents : an iterable object composed by str
-            A list or a set of documents to be splitted.
-        model : dict
-            A dictionary with all the possible tokens as key
-        logfile : file, optional
-            File where to print the log of the tokenization process
-        vocabulary : dict, optional
-            The dictionary to be filled with the tokens found in the document splitting.
-            If it is not provided, a empty dictionary is initialized.
-        separators : list of str
-            String to be used as splitting tokens.
-            They will be inserted in the vocabulary if they are not in the next param
-        not_vocab_separators : list of str
-            Separators that will not be added to the vocabulary.
-
-        Returns
-        ----------
-        orphans : list of str
-            Token that do not match the model
-        vocabulary : dict
-            The keys are the tokens found during the splitting, the values come from the model
-    """
-
-    # punctuation and other special espressions
-    if separators == None:
-        separators = SEPARATORS
-    # tried but not present in glove: '\'t', 'e-'
-
-    orphans = set()
-    for composed_word in documents:
-        words = composed_word.split()
-        #words = filter(None, re.split("[" + separator + "]+", composed_word))
-        # remove stop symbols at the end of the tokens
-        for word in words:
-            if len(word) > 1 and word[-1] in STOPWORDS:
-                word2 = word[:-1]
-                if word2 in model.keys():
-                    word = word2
-
-            if word in model.keys():
-                vocabulary[word] = model[word]
-                # print("Found word: " + word)
-            else:
-                orphans.add(word)
-                # print("Word not found: " + word)
-
-
-    if not logfile == None:
-        logfile.write("Tab, space, newline" + '\t' +
-                      str(len(vocabulary.keys())) + '\t' +
-                      str(len(orphans)) + '\n')
-
-    for separator in separators:
-
-        # print("Separator: " + separator)
-        orphans, vocabulary = regular_split(orphans, vocabulary, model, separator)
-
-        if separator not in model.keys():
-            orphans.add(separator)
-        else:
-            vocabulary[separator] = model[separator]
-        # print("Orphans: " + str(len(orphans)))
-
-        if not logfile == None:
-            logfile.write(separator + '\t' +
-                          str(len(vocabulary.keys())) + '\t' +
-                          str(len(orphans)) + '\n')
-
-    return vocabulary, orphans
-
-
-def regular_split(old_orphans, vocabulary, model, separator):
-    orphans = set()
-    for composed_word in old_orphans:
-        words = composed_word.split(separator)
-        #words = filter(None, re.split("[" + separator + "]+", composed_word))
-        for word in words:
-            if word in model.keys():
-                vocabulary[word] = model[word]
-                # print("Found word: " + word)
-            else:
-                orphans.add(word)
-                # print("Word not found: " + word)
-    return orphans, vocabulary
-
-
-def DrInventor_routine():
-    if size == 300:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.840B.300d.txt')
-        embed_name = "glove300"
-    elif size == 25:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.twitter.27B.25d.txt')
-        embed_name = "glove25"
-    else:
-        raise Exception("Wrong embedding size")
-    global DIM
-    DIM = size
-
-    dataset_name = 'DrInventor'
-    dataset_version = 'arg10'
-
-    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
-    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
-    dataframe_path = os.path.join(pickles_path, 'total.pkl')
-    glove_path = os.path.join(dataset_path, "resources", embed_name)
-
-    model = load_glove(vocabulary_source_path)
-
-    m1 = model.copy()
-
-    vocabulary_creator(m1, glove_path, dataframe_path)
-
-
-def ECHR_routine():
-    vocabulary_source_path = os.path.join(os.getcwd(), 'glove.840B.300d.txt')
-
-    dataset_name = 'ECHR2018'
-    dataset_version = 'arg0'
-
-    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
-    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
-    dataframe_path = os.path.join(pickles_path, 'total.pkl')
-    glove_path = os.path.join(dataset_path, 'glove')
-
-    model = load_glove(vocabulary_source_path)
-
-    m1 = model.copy()
-
-    vocabulary_creator(m1, glove_path, dataframe_path)
-
-
-
-def scidtb_routine(size):
-    if size == 300:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.840B.300d.txt')
-        embed_name = "glove300"
-    elif size == 25:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.twitter.27B.25d.txt')
-        embed_name = "glove25"
-    else:
-        raise Exception("Wrong embedding size")
-    global DIM
-    DIM = size
-
-    dataset_name = 'scidtb_argmin_annotations'
-    dataset_version = 'only_arg_v1'
-
-    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
-    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
-    dataframe_path = os.path.join(pickles_path, 'total.pkl')
-    glove_path = os.path.join(dataset_path, "resources", embed_name)
-
-
-    model = load_glove(vocabulary_source_path)
-
-    m1 = model.copy()
-
-    vocabulary_creator(m1, glove_path, dataframe_path)
-
-
-def RCT_routine(size):
-    if size == 300:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.840B.300d.txt')
-        embed_name = "glove300"
-    elif size == 25:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.twitter.27B.25d.txt')
-        embed_name = "glove25"
-    else:
-        raise Exception("Wrong embedding size")
-    global DIM
-    DIM = size
-
-    dataset_name = 'RCT'
-
-    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
-    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles'))
-    dataframe_path = os.path.join(pickles_path, 'total.pkl')
-    glove_path = os.path.join(dataset_path, "resources", embed_name)
-
-
-    model = load_glove(vocabulary_source_path)
-
-    m1 = model.copy()
-
-    vocabulary_creator(m1, glove_path, dataframe_path)
-
-
-def cdcp_routine():
-    if size == 300:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.840B.300d.txt')
-        embed_name = "glove300"
-    elif size == 25:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.twitter.27B.25d.txt')
-        embed_name = "glove25"
-    else:
-        raise Exception("Wrong embedding size")
-    global DIM
-    DIM = size
-
-    dataset_name = 'cdcp_ACL17'
-    dataset_version = 'new_3'
-
-    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
-    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
-    dataframe_path = os.path.join(pickles_path, 'total.pkl')
-    glove_path = os.path.join(dataset_path, "resources", embed_name)
-
-
-    model = load_glove(vocabulary_source_path)
-
-    m1 = model.copy()
-
-    vocabulary_creator(m1, glove_path, dataframe_path)
-
-
-
-def UKP_routine():
-    if size == 300:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.840B.300d.txt')
-        embed_name = "glove300"
-    elif size == 25:
-        vocabulary_source_path = os.path.join(os.getcwd(), "resources", 'glove.twitter.27B.25d.txt')
-        embed_name = "glove25"
-    else:
-        raise Exception("Wrong embedding size")
-    global DIM
-    DIM = size
-
-    dataset_name = 'AAEC_v2'
-    dataset_version = 'new_2R'
-
-    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
-    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
-    dataframe_path = os.path.join(pickles_path, 'total.pkl')
-    glove_path = os.path.join(dataset_path, "resources", embed_name)
-
-
-    model = load_glove(vocabulary_source_path)
-
-    m1 = model.copy()
-
-    vocabulary_creator(m1, glove_path, dataframe_path)
-
-
-
-
-if __name__ == '__main__':
-
-
-    parser = argparse.ArgumentParser(description="Loads glove embeddings related to the dataset")
-
-    parser.add_argument('-c', '--corpus',
-                        choices=["rct", "drinv", "cdcp", "echr", "ukp", "scidtb"],
-                        help="Corpus", default="cdcp")
-    parser.add_argument('-s', '--size', help="embedding size",
-                        choices=[25, 300],
-                        type=int, default=300)
-
-
-    args = parser.parse_args()
-
-    corpus = args.corpus
-    size = args.size
-
-    if corpus.lower() == "rct":
-        RCT_routine(size)
-    elif corpus.lower() == "cdcp":
-        cdcp_routine(size)
-    elif corpus.lower() == "drinv":
-        DrInventor_routine(size)
-    elif corpus.lower() == "ukp":
-        UKP_routine(size)
-    elif corpus.lower() == "scidtb":
-        scidtb_routine(size)
-    else:
+__author__ = "Andrea Galassi"
+__copyright__ = "Copyright 2018-2020 Andrea Galassi"
+__license__ = "BSD 3-clause"
+__version__ = "0.2.0"
+__email__ = "a.galassi@unibo.it"
+
+
+import pandas
+import os
+import numpy as np
+import re
+import io
+import mmap
+import time
+import argparse
+import multiprocessing
+
+from tokenizer import (SEPARATORS, REPLACINGS, STOPWORDS, normalize,
+                       compile_separators, find_separators)
+
+DIM = 300
+
+# files of the binary store created by convert_glove
+STORE_VECTORS = 'vectors.npy'
+STORE_WORDS = 'words.bin'
+STORE_OFFSETS = 'offsets.npy'
+# number of rows copied at once while the store is written
+STORE_CHUNK = 100000
+# number of lines whose values are converted to float at once
+PARSE_BATCH = 10000
+# chunks of the GloVe file for each parsing process
+CHUNKS_PER_PROCESS = 4
+
+
+def load_glove(vocabulary_source_path):
+
+    print("Loading Glove")
+    f = open(vocabulary_source_path, 'r', encoding="utf-8")
+    model = {}
+
+    for line in f:
+        splits = line.split(' ')
+        n_splits = len(splits)
+        word = ""
+        n = 0
+        while (n_splits - n) > DIM:
+            word += " " + splits[n]
+            n += 1
+        word = word[1:]
+        # embedding = np.array([float(val) for val in splitLine[1:]])
+        # model[word] = embedding
+        model[word] = line
+
+    print("Glove loaded")
+    return model
+
+
+def parse_glove_line(line, dim=None):
+    """
+    Splits a line of the GloVe file into its key and its values.
+    The key is computed as in load_glove, the values as in vocabulary_creator.
+
+    Parameters
+    ----------
+    line : str
+        A line of the GloVe file
+    dim : int, optional
+        Size of the embeddings, DIM if not provided
+
+    Returns
+    ----------
+    word : str
+        The key of the line, it may contain spaces
+    values : list of str
+        The last dim values of the line
+    """
+    if dim is None:
+        dim = DIM
+    # everything before the last dim space-separated fields, as the while loop of load_glove
+    splits = line.rsplit(' ', dim)
+    if len(splits) > dim:
+        word = splits[0]
+    else:
+        word = ''
+    values = line.split()[-dim:]
+    return word, values
+
+
+def get_store_path(vocabulary_source_path):
+    """
+    Returns the path of the binary store associated to a GloVe text file
+    """
+    return os.path.splitext(vocabulary_source_path)[0] + '.store'
+
+
+def find_chunks(vocabulary_source_path, chunks):
+    """
+    Splits a file into byte ranges that begin and end at line boundaries
+
+    Returns
+    ----------
+    ranges : list of (int, int)
+        Beginning and end of each chunk, empty chunks are discarded
+    """
+    size = os.path.getsize(vocabulary_source_path)
+    boundaries = [0]
+    with open(vocabulary_source_path, 'rb') as f:
+        for index in range(1, chunks):
+            f.seek(max(int(size * index / chunks), boundaries[-1]))
+            # move to the beginning of the next line
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+
+    ranges = []
+    for index in range(len(boundaries) - 1):
+        if boundaries[index + 1] > boundaries[index]:
+            ranges.append((boundaries[index], boundaries[index + 1]))
+    return ranges
+
+
+def parse_glove_chunk(arguments):
+    """
+    Parses a chunk of the GloVe file, writing its vectors as raw float32 values.
+    The float conversion is performed on batches of lines at once.
+
+    Parameters
+    ----------
+    arguments : tuple
+        Path of the GloVe file, beginning and end of the chunk (in bytes), path of the raw output file,
+        size of the embeddings
+
+    Returns
+    ----------
+    words : list of str
+        The keys of the vectors, in the order in which they have been written
+    lines : int
+        Number of lines parsed
+    seconds : float
+        Time spent
+    """
+    vocabulary_source_path, begin, end, part_path, dim = arguments
+    starttime = time.time()
+
+    with open(vocabulary_source_path, 'rb') as f:
+        f.seek(begin)
+        text = f.read(end - begin).decode('utf-8')
+
+    words = []
+    values = []
+    lines = 0
+    with open(part_path, 'wb') as part:
+        # same newline handling of the text mode used by load_glove
+        for line in io.StringIO(text, newline=None):
+            lines += 1
+            word, line_values = parse_glove_line(line, dim)
+            if len(line_values) < dim:
+                print("Skipping malformed line: " + word)
+                continue
+            words.append(word)
+            values.extend(line_values)
+            if len(values) >= PARSE_BATCH * dim:
+                part.write(np.array(values, dtype=np.float32).tobytes())
+                values = []
+        if len(values) > 0:
+            part.write(np.array(values, dtype=np.float32).tobytes())
+
+    return words, lines, time.time() - starttime
+
+
+def convert_glove(vocabulary_source_path, store_path=None, processes=1):
+    """
+    Converts a GloVe text file into a binary store that can be opened with GloveStore.
+    The store is a folder with a float32 matrix of the vectors, sorted by word, and an index of the words.
+    It needs to be done only once for each GloVe file.
+    The file is split into chunks at line boundaries, which are parsed by a pool of processes.
+
+    Parameters
+    ----------
+    vocabulary_source_path : str
+        Path of the GloVe text file
+    store_path : str, optional
+        Folder of the store. If it is not provided, the one given by get_store_path is used.
+    processes : int, optional
+        Number of processes used for the parsing
+
+    Returns
+    ----------
+    store_path : str
+        Folder of the store
+    """
+    if store_path is None:
+        store_path = get_store_path(vocabulary_source_path)
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+
+    print(str(time.ctime()) + "\tConverting Glove")
+    starttime = time.time()
+
+    ranges = find_chunks(vocabulary_source_path, max(processes, 1) * CHUNKS_PER_PROCESS)
+    tasks = []
+    for index in range(len(ranges)):
+        begin, end = ranges[index]
+        part_path = os.path.join(store_path, 'vectors.' + str(index) + '.part')
+        tasks.append((vocabulary_source_path, begin, end, part_path, DIM))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(parse_glove_chunk, tasks)
+    else:
+        pool = None
+        results = map(parse_glove_chunk, tasks)
+
+    words = []
+    lines = 0
+    for index, (chunk_words, chunk_lines, seconds) in enumerate(results):
+        words.extend(chunk_words)
+        lines += chunk_lines
+        print("\tChunk " + str(index + 1) + "/" + str(len(tasks)) + ": " + str(chunk_lines) + " lines, " +
+              str(int(chunk_lines / max(seconds, 1e-6))) + " lines/sec")
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    seconds = time.time() - starttime
+    print(str(time.ctime()) + "\tParsed " + str(lines) + " lines in " + str(round(seconds, 1)) + " seconds: " +
+          str(int(lines / max(seconds, 1e-6))) + " lines/sec")
+
+    write_store(store_path, words, [task[3] for task in tasks])
+    print(str(time.ctime()) + "\tGlove converted")
+    return store_path
+
+
+def write_store(store_path, words, part_paths):
+    """
+    Creates the files of the binary store from the raw vectors.
+
+    Parameters
+    ----------
+    store_path : str
+        Folder of the store
+    words : list of str
+        The keys of the vectors, in the order in which they appear in the parts
+    part_paths : list of str
+        Files with the raw float32 vectors, DIM values per word. They are deleted once the store is written.
+    """
+
+    # as in the dictionary created by load_glove, a duplicated key keeps its last vector
+    rows = {}
+    for row, word in enumerate(words):
+        rows[word] = row
+    sorted_words = sorted(rows.keys())
+    order = np.fromiter((rows[word] for word in sorted_words), dtype=np.int64, count=len(sorted_words))
+
+    parts = []
+    starts = [0]
+    for part_path in part_paths:
+        part = np.memmap(part_path, dtype=np.float32, mode='r')
+        part = part.reshape((-1, DIM))
+        parts.append(part)
+        starts.append(starts[-1] + len(part))
+    starts = np.array(starts, dtype=np.int64)
+
+    vectors = np.lib.format.open_memmap(os.path.join(store_path, STORE_VECTORS), mode='w+',
+                                        dtype=np.float32, shape=(len(order), DIM))
+    for begin in range(0, len(order), STORE_CHUNK):
+        chunk = order[begin:begin + STORE_CHUNK]
+        chunk_parts = np.searchsorted(starts, chunk, side='right') - 1
+        destination = vectors[begin:begin + len(chunk)]
+        for index in range(len(parts)):
+            mask = chunk_parts == index
+            if np.any(mask):
+                destination[mask] = parts[index][chunk[mask] - starts[index]]
+    vectors.flush()
+    del vectors
+    del parts
+
+    encoded = [word.encode('utf-8') for word in sorted_words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(word) for word in encoded])
+    np.save(os.path.join(store_path, STORE_OFFSETS), offsets)
+    with open(os.path.join(store_path, STORE_WORDS), 'wb') as words_file:
+        words_file.write(b''.join(encoded))
+
+    for part_path in part_paths:
+        os.remove(part_path)
+
+
+class GloveStore(object):
+    """
+    Read-only access to a GloVe binary store created by convert_glove.
+    It can be used in place of the dictionary returned by load_glove: the values are the embeddings (float32 arrays)
+    instead of the text lines. The vectors are memory-mapped and the words are found with a binary search on the
+    index, so only the words that are looked up are kept in memory.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.vectors = np.load(os.path.join(store_path, STORE_VECTORS), mmap_mode='r')
+        self.offsets = np.load(os.path.join(store_path, STORE_OFFSETS), mmap_mode='r')
+        words_path = os.path.join(store_path, STORE_WORDS)
+        if os.path.getsize(words_path) > 0:
+            with open(words_path, 'rb') as words_file:
+                self.words = mmap.mmap(words_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.words = b''
+        # rows of the words already looked up, -1 if the word is not in the store
+        self._rows = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _key(self, row):
+        return self.words[int(self.offsets[row]):int(self.offsets[row + 1])]
+
+    def row(self, word):
+        """
+        Returns the row of the word in the vectors matrix, -1 if the word is not in the store
+        """
+        if word in self._rows:
+            return self._rows[word]
+
+        # the words are sorted by code point, which is the same order of their utf-8 encoding
+        key = word.encode('utf-8')
+        low = 0
+        high = len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        row = -1
+        if low < len(self) and self._key(low) == key:
+            row = low
+        self._rows[word] = row
+        return row
+
+    def __contains__(self, word):
+        return self.row(word) >= 0
+
+    def __getitem__(self, word):
+        row = self.row(word)
+        if row < 0:
+            raise KeyError(word)
+        return np.array(self.vectors[row], dtype=np.float32)
+
+    def get(self, word, default=None):
+        if word in self:
+            return self[word]
+        return default
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self._key(row).decode('utf-8')
+
+    def keys(self):
+        # membership tests such as "word in model.keys()" are answered by the store itself
+        return self
+
+    def copy(self):
+        # the store is read-only, so it can be shared
+        return self
+
+
+def load_model(vocabulary_source_path):
+    """
+    Loads the GloVe model, using the binary store if it has been created with convert_glove
+    and the text file otherwise.
+    """
+    store_path = get_store_path(vocabulary_source_path)
+    if os.path.exists(os.path.join(store_path, STORE_VECTORS)):
+        print("Opening Glove store")
+        return GloveStore(store_path)
+    return load_glove(vocabulary_source_path)
+
+
+def get_vocabulary_source_path(size):
+    """
+    Path of the GloVe text file of an embedding size, in the resources folder
+    """
+    if size == 300:
+        return os.path.join(os.getcwd(), "resources", 'glove.840B.300d.txt')
+    elif size == 25:
+        return os.path.join(os.getcwd(), "resources", 'glove.twitter.27B.25d.txt')
+    else:
+        raise Exception("Wrong embedding size")
+
+
+def load_glove_filtered(vocabulary_source_path, candidates):
+    """
+    Scans the GloVe file once and keeps only the lines whose key is among the candidates.
+    The result has the same format of the dictionary returned by load_glove, but its size depends on the corpus.
+
+    Parameters
+    ----------
+    vocabulary_source_path : str
+        Path of the GloVe text file
+    candidates : set of str
+        The keys to be kept, usually computed with candidate_tokens
+
+    Returns
+    ----------
+    model : dict
+        The keys are the candidates found in the file, the values are their lines
+    """
+
+    print("Streaming Glove")
+    model = {}
+    lines = 0
+    with open(vocabulary_source_path, 'r', encoding="utf-8") as f:
+        for line in f:
+            lines += 1
+            # same key of load_glove: everything before the last DIM space-separated fields
+            splits = line.rsplit(' ', DIM)
+            if len(splits) > DIM:
+                word = splits[0]
+            else:
+                word = ''
+            if word in candidates:
+                model[word] = line
+
+    print("Glove streamed: " + str(len(model)) + " of " + str(lines) + " lines kept")
+    return model
+
+
+def load_documents(dataframe_path):
+    """
+    Loads the propositions of a dataframe, replacing the different versions of the same character
+    """
+    df = pandas.read_pickle(dataframe_path)
+
+    propositions = df['source_proposition'].drop_duplicates()
+
+
+    print(len(propositions))
+
+    documents = []
+    # replace different versions of the same character
+    for proposition in propositions:
+        documents.append(normalize(proposition))
+
+    return documents
+
+
+def candidate_tokens(documents, separators=None):
+    """
+    Computes every token that document_tokenizer_and_embedder may look up in the model while splitting the documents.
+    All the words are split with all the separators, regardless of whether they are in the model, so the result is a
+    superset of the tokens that are actually looked up.
+
+    Parameters
+    ----------
+    documents : an iterable object composed by str
+        The documents to be splitted
+    separators : list of str, optional
+        String to be used as splitting tokens, SEPARATORS if not provided
+
+    Returns
+    ----------
+    candidates : set of str
+    """
+    if separators is None:
+        separators = SEPARATORS
+
+    pieces = set()
+    for document in documents:
+        for word in document.split():
+            pieces.add(word)
+            # stop symbols at the end of the tokens
+            if len(word) > 1 and word[-1] in STOPWORDS:
+                pieces.add(word[:-1])
+
+    candidates = set(pieces)
+    for separator in separators:
+        new_pieces = set()
+        for piece in pieces:
+            if separator in piece:
+                new_pieces.update(piece.split(separator))
+            else:
+                new_pieces.add(piece)
+        # the separators that are not in the model become orphans and are splitted by the following separators
+        new_pieces.add(separator)
+        pieces = new_pieces
+        candidates.update(pieces)
+
+    return candidates
+
+
+def create_vocabulary(vocabulary_source_path, vocabulary_destination_path, dataframe_path, streaming=False):
+    """
+    Creates the vocabulary of a corpus.
+    In streaming mode, only the GloVe lines that may be used by the corpus are loaded, so the memory required
+    depends on the corpus instead of on the GloVe file.
+    """
+    if streaming:
+        documents = load_documents(dataframe_path)
+        candidates = candidate_tokens(documents)
+        print("Candidate tokens: " + str(len(candidates)))
+        model = load_glove_filtered(vocabulary_source_path, candidates)
+    else:
+        model = load_model(vocabulary_source_path)
+        model = model.copy()
+
+    vocabulary_creator(model, vocabulary_destination_path, dataframe_path)
+
+
+def vocabulary_creator(model, vocabulary_destination_path, dataframe_path):
+
+    documents = load_documents(dataframe_path)
+
+
+    if not os.path.exists(vocabulary_destination_path):
+        os.makedirs(vocabulary_destination_path)
+    orphans_path = os.path.join(vocabulary_destination_path, 'glove.orphans.txt')
+    embeddings_path = os.path.join(vocabulary_destination_path, 'glove.embeddings.txt')
+    npz_path = os.path.join(vocabulary_destination_path, 'glove.embeddings.npz')
+    vocabulary_path = os.path.join(vocabulary_destination_path, 'glove.vocabulary.txt')
+    logfile_path = os.path.join(vocabulary_destination_path, 'glove.log.txt')
+    logfile = open(logfile_path, 'w')
+    logfile.write('Sep\tVoc_size\tOrphans\n')
+
+    print("Splitting")
+
+    vocabulary, orphans = document_tokenizer_and_embedder(documents, model, logfile)
+
+
+    logfile.close()
+    if '' in orphans:
+        orphans.remove('')
+
+
+    # print vocabulary file
+    vocabulary_file = open(vocabulary_path, 'w')
+    for word in sorted(vocabulary.keys()):
+        vocabulary_file.write(word)
+        vocabulary_file.write('\n')
+    vocabulary_file.close()
+
+    # print orphans file
+    orphans_file = open(orphans_path, 'w')
+    for word in sorted(orphans):
+        orphans_file.write(word)
+        orphans_file.write("\n")
+    orphans_file.close()
+
+    print("handling orphans")
+
+    # create random embeddings for orphans
+    for word in sorted(orphans):
+        embedding = np.random.rand(DIM) - 0.5
+        line = word + " "
+        for value in embedding:
+            line += ("%.5g " % value) + " "
+        line += '\n'
+        vocabulary[word] = line
+
+    print("Saving")
+
+    # save embeddings
+    embeddings = []
+    vocabulary_list = []
+    embeddings_file = open(embeddings_path, 'w')
+    for word in sorted(vocabulary.keys()):
+        value = vocabulary[word]
+        if isinstance(value, str):
+            # text line of the GloVe file
+            line = value
+            splits = line.split()
+            embedding = splits[-DIM:]
+            embedding = np.array(embedding, dtype=np.float32)
+        else:
+            # vector of a GloveStore
+            embedding = np.array(value, dtype=np.float32)
+            line = word + " " + " ".join(["%.5g" % component for component in embedding]) + "\n"
+        embeddings_file.write(line)
+        embeddings.append(embedding)
+        vocabulary_list.append(word)
+    embeddings_file.close()
+
+    print(vocabulary_list[0])
+
+    np.savez(npz_path, vocab=vocabulary_list, embeds=embeddings)
+
+    print('Finished')
+
+
+def print_vocabulary_and_orphans(vocabulary, vocabulary_path, orphans, orphans_path):
+    voc_file = open(vocabulary_path,'w')
+    for word in sorted(vocabulary.keys()):
+        voc_file.write(vocabulary[word])
+    voc_file.close()
+    orphans_file = open(orphans_path, 'w')
+    for word in sorted(orphans):
+        orphans_file.write(word)
+        orphans_file.write("\n")
+    orphans_file.close()
+
+
+def document_tokenizer_and_embedder(documents, model,
+                                    logfile=None, vocabulary={}, separators=None, not_vocab_separators=None):
+    """
+        Split the documents in tokens.
+        The splitting is progressive using a series of separators,
+        when a token match a key in model, it is inserted in the vocabulary.
+        At the end of the process, the token that still do not match the model are returned as "orphans".
+
+        Each distinct word is scanned only once: instead of splitting all the orphans with each separator, the
+        first separator (in order of priority) that splits an orphan is found directly, and the steps in which the
+        orphan exists are recorded. The statistics of each step are then computed from these intervals, so they are
+        the same of the progressive splitting.
+
+        Parameters
+        ----------
+        documents : an iterable object composed by str
+            A list or a set of documents to be splitted.
+        model : dict or GloveStore
+            A dictionary with all the possible tokens as key
+        logfile : file, optional
+            File where to print the log of the tokenization process
+        vocabulary : dict, optional
+            The dictionary to be filled with the tokens found in the document splitting.
+            If it is not provided, a empty dictionary is initialized.
+        separators : list of str
+            String to be used as splitting tokens.
+            They will be inserted in the vocabulary if they are not in the next param
+        not_vocab_separators : list of str
+            Separators that will not be added to the vocabulary.
+
+        Returns
+        ----------
+        orphans : list of str
+            Token that do not match the model
+        vocabulary : dict
+            The keys are the tokens found during the splitting, the values come from the model
+    """
+
+    # punctuation and other special espressions
+    if separators == None:
+        separators = SEPARATORS
+    # tried but not present in glove: '\'t', 'e-'
+
+    pattern, table = compile_separators(separators)
+    # step 0 is the whitespace splitting, step i + 1 follows the splitting with separators[i]
+    last_step = len(separators)
+
+    # answers of the model, so that each token is looked up only once
+    known = {}
+
+    def in_model(word):
+        answer = known.get(word)
+        if answer is None:
+            answer = word in model
+            known[word] = answer
+        return answer
+
+    # first step in which each token is found in the model
+    found = {}
+    # steps in which each orphan has been created
+    births = {}
+    pending = []
+
+    def add_token(word, step):
+        if in_model(word):
+            if word not in found or step < found[word]:
+                found[word] = step
+        else:
+            if word not in births:
+                births[word] = set()
+            if step not in births[word]:
+                births[word].add(step)
+                pending.append((word, step))
+
+    seen = set()
+    for composed_word in documents:
+        words = composed_word.split()
+        # remove stop symbols at the end of the tokens
+        for word in words:
+            if word in seen:
+                continue
+            seen.add(word)
+            if len(word) > 1 and word[-1] in STOPWORDS:
+                word2 = word[:-1]
+                if in_model(word2):
+                    word = word2
+            add_token(word, 0)
+
+    for index in range(len(separators)):
+        add_token(separators[index], index + 1)
+
+    # steps (first, last) during which each orphan exists
+    intervals = {}
+    contained = {}
+    while len(pending) > 0:
+        word, step = pending.pop()
+
+        if word not in contained:
+            contained[word] = find_separators(word, separators, pattern, table)
+
+        # the first separator applied after the creation of the orphan that splits it
+        split_index = -1
+        for index in contained[word]:
+            if index >= step:
+                split_index = index
+                break
+
+        if word not in intervals:
+            intervals[word] = []
+        if split_index < 0:
+            intervals[word].append((step, last_step))
+        else:
+            intervals[word].append((step, split_index))
+            for piece in word.split(separators[split_index]):
+                add_token(piece, split_index + 1)
+
+    # number of orphans and of new tokens in each step
+    orphans_delta = [0] * (last_step + 2)
+    vocabulary_delta = [0] * (last_step + 2)
+    orphans = set()
+    for word in intervals.keys():
+        end = -1
+        for first, last in sorted(intervals[word]):
+            first = max(first, end + 1)
+            if last >= first:
+                orphans_delta[first] += 1
+                orphans_delta[last + 1] -= 1
+                end = last
+        if end == last_step:
+            orphans.add(word)
+
+    vocabulary_size = len(vocabulary.keys())
+    for word in found.keys():
+        if word not in vocabulary:
+            vocabulary_delta[found[word]] += 1
+        vocabulary[word] = model[word]
+
+    if not logfile == None:
+        names = ["Tab, space, newline"] + list(separators)
+        orphans_size = 0
+        for step in range(last_step + 1):
+            vocabulary_size += vocabulary_delta[step]
+            orphans_size += orphans_delta[step]
+            logfile.write(names[step] + '\t' +
+                          str(vocabulary_size) + '\t' +
+                          str(orphans_size) + '\n')
+
+    return vocabulary, orphans
+
+
+def regular_split(old_orphans, vocabulary, model, separator):
+    orphans = set()
+    for composed_word in old_orphans:
+        words = composed_word.split(separator)
+        #words = filter(None, re.split("[" + separator + "]+", composed_word))
+        for word in words:
+            if word in model.keys():
+                vocabulary[word] = model[word]
+                # print("Found word: " + word)
+            else:
+                orphans.add(word)
+                # print("Word not found: " + word)
+    return orphans, vocabulary
+
+
+def DrInventor_routine(size, streaming=False):
+    vocabulary_source_path = get_vocabulary_source_path(size)
+    embed_name = "glove" + str(size)
+    global DIM
+    DIM = size
+
+    dataset_name = 'DrInventor'
+    dataset_version = 'arg10'
+
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
+    dataframe_path = os.path.join(pickles_path, 'total.pkl')
+    glove_path = os.path.join(dataset_path, "resources", embed_name)
+
+    create_vocabulary(vocabulary_source_path, glove_path, dataframe_path, streaming)
+
+
+def ECHR_routine(streaming=False):
+    vocabulary_source_path = os.path.join(os.getcwd(), 'glove.840B.300d.txt')
+
+    dataset_name = 'ECHR2018'
+    dataset_version = 'arg0'
+
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
+    dataframe_path = os.path.join(pickles_path, 'total.pkl')
+    glove_path = os.path.join(dataset_path, 'glove')
+
+    create_vocabulary(vocabulary_source_path, glove_path, dataframe_path, streaming)
+
+
+
+def scidtb_routine(size, streaming=False):
+    vocabulary_source_path = get_vocabulary_source_path(size)
+    embed_name = "glove" + str(size)
+    global DIM
+    DIM = size
+
+    dataset_name = 'scidtb_argmin_annotations'
+    dataset_version = 'only_arg_v1'
+
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
+    dataframe_path = os.path.join(pickles_path, 'total.pkl')
+    glove_path = os.path.join(dataset_path, "resources", embed_name)
+
+
+    create_vocabulary(vocabulary_source_path, glove_path, dataframe_path, streaming)
+
+
+def RCT_routine(size, streaming=False):
+    vocabulary_source_path = get_vocabulary_source_path(size)
+    embed_name = "glove" + str(size)
+    global DIM
+    DIM = size
+
+    dataset_name = 'RCT'
+
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles'))
+    dataframe_path = os.path.join(pickles_path, 'total.pkl')
+    glove_path = os.path.join(dataset_path, "resources", embed_name)
+
+
+    create_vocabulary(vocabulary_source_path, glove_path, dataframe_path, streaming)
+
+
+def cdcp_routine(size, streaming=False):
+    vocabulary_source_path = get_vocabulary_source_path(size)
+    embed_name = "glove" + str(size)
+    global DIM
+    DIM = size
+
+    dataset_name = 'cdcp_ACL17'
+    dataset_version = 'new_3'
+
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
+    dataframe_path = os.path.join(pickles_path, 'total.pkl')
+    glove_path = os.path.join(dataset_path, "resources", embed_name)
+
+
+    create_vocabulary(vocabulary_source_path, glove_path, dataframe_path, streaming)
+
+
+
+def UKP_routine(size, streaming=False):
+    vocabulary_source_path = get_vocabulary_source_path(size)
+    embed_name = "glove" + str(size)
+    global DIM
+    DIM = size
+
+    dataset_name = 'AAEC_v2'
+    dataset_version = 'new_2R'
+
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+    pickles_path = os.path.join(os.path.join(dataset_path, 'pickles', dataset_version))
+    dataframe_path = os.path.join(pickles_path, 'total.pkl')
+    glove_path = os.path.join(dataset_path, "resources", embed_name)
+
+
+    create_vocabulary(vocabulary_source_path, glove_path, dataframe_path, streaming)
+
+
+
+
+if __name__ == '__main__':
+
+
+    parser = argparse.ArgumentParser(description="Loads glove embeddings related to the dataset")
+
+    parser.add_argument('-c', '--corpus',
+                        choices=["rct", "drinv", "cdcp", "echr", "ukp", "scidtb"],
+                        help="Corpus", default="cdcp")
+    parser.add_argument('-s', '--size', help="embedding size",
+                        choices=[25, 300],
+                        type=int, default=300)
+    parser.add_argument('-b', '--binary', help="Convert the GloVe file into a binary store and exit",
+                        action="store_true")
+    parser.add_argument('-p', '--processes', help="Number of processes used to convert the GloVe file",
+                        type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--streaming', help="Scan the GloVe file keeping only the tokens of the corpus",
+                        action="store_true")
+
+
+    args = parser.parse_args()
+
+    corpus = args.corpus
+    size = args.size
+    streaming = args.streaming
+
+    if args.binary:
+        DIM = size
+        convert_glove(get_vocabulary_source_path(size), processes=args.processes)
+    elif corpus.lower() == "rct":
+        RCT_routine(size, streaming)
+    elif corpus.lower() == "cdcp":
+        cdcp_routine(size, streaming)
+    elif corpus.lower() == "drinv":
+        DrInventor_routine(size, streaming)
+    elif corpus.lower() == "ukp":
+        UKP_routine(size, streaming)
+    elif corpus.lower() == "scidtb":
+        scidtb_routine(size, streaming)
+    else:
         print("Datset not yet supported")
\ No newline at end of file
@@ -1147,7 +1147,7 @@ def build_net_11(bow,
                 layer of keras, the input is supposed in BoW form.
                 If it is None, the input is supposed to already contain pre-trained embeddings.
     :param text_length: The temporal length of the text input
-    :param propos_length: The temporal length of the proposition input
+    :param propos_length: The temporal length of the proposition input, None if it changes from batch to batch
     :param regularizer_weight: Regularization weight
     :param dropout_embedder: Dropout used in the embedder
     :param dropout_resnet: Dropout used in the residual network
@@ -1350,12 +1350,18 @@ def build_net_11(bow,
     print("target query")
     print(target_query.shape)
 
-    time_shape = (source_keys.shape)[1]
-    space_shape = (source_keys.shape)[2]
+    # the sizes as ints, or None for the unknown ones (shape returns Dimension objects)
+    time_shape = K.int_shape(source_keys)[1]
+    space_shape = K.int_shape(source_keys)[2]
 
     # repeat the query and sum
-    source_query = RepeatVector(time_shape, name='repeat_query_source')(source_query)
-    target_query = RepeatVector(time_shape, name='repeat_query_target')(target_query)
+    # if the length of the propositions is not fixed, the query is broadcasted over the time axis by the addition
+    if time_shape is None:
+        source_query = Reshape(target_shape=(1, space_shape), name='repeat_query_source')(source_query)
+        target_query = Reshape(target_shape=(1, space_shape), name='repeat_query_target')(target_query)
+    else:
+        source_query = RepeatVector(time_shape, name='repeat_query_source')(source_query)
+        target_query = RepeatVector(time_shape, name='repeat_query_target')(target_query)
     print("repeat target query")
     print(target_query.shape)
     source_score = Add(name='att_addition_source')([source_query, source_keys])
@@ -1406,9 +1412,12 @@ def build_net_11(bow,
     print(target_weight.shape)
 
     # weighted sum
-    source_weight = Reshape(target_shape=(source_weight.shape[-1], 1), name='att_weights_reshape_source')(
+    weight_length = K.int_shape(source_weight)[-1]
+    if weight_length is None:
+        weight_length = -1
+    source_weight = Reshape(target_shape=(weight_length, 1), name='att_weights_reshape_source')(
         source_weight)
-    target_weight = Reshape(target_shape=(target_weight.shape[-1], 1), name='att_weights_reshape_target')(
+    target_weight = Reshape(target_shape=(weight_length, 1), name='att_weights_reshape_target')(
         target_weight)
     print("target weights (reshape)")
     print(target_weight.shape)
@@ -1527,7 +1536,7 @@ def build_net_7(bow,
     :param bow: If it is different from None, it is the matrix with the pre-trained embeddings used by the Embedding
                 layer of keras, the input is supposed in BoW form.
                 If it is None, the input is supposed to already contain pre-trained embeddings.
-    :param propos_length: The temporal length of the proposition input
+    :param propos_length: The temporal length of the proposition input, None if it changes from batch to batch
     :param regularizer_weight: Regularization weight
     :param dropout_embedder: Dropout used in the embedder
     :param dropout_resnet: Dropout used in the residual network
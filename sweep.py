@@ -0,0 +1,368 @@
+__author__ = "Andrea Galassi"
+__copyright__ = "Copyright 2018-2020 Andrea Galassi"
+__license__ = "BSD 3-clause"
+__version__ = "0.2.0"
+__email__ = "a.galassi@unibo.it"
+
+"""
+Hyper-parameter sweeps over training.perform_training.
+The trials of a sweep are taken from a grid or sampled at random from a search space, and they are trained by a pool
+of processes. With successive halving, the trials whose validation score is not in the best 1/eta of the ones that
+reached the same epoch are stopped. The trials and the validation score of each of their epochs are stored in a
+SQLite database, which can be queried while the sweep is running.
+"""
+
+import os
+import sys
+import time
+import json
+import sqlite3
+import argparse
+import inspect
+import itertools
+import traceback
+import multiprocessing
+import numpy as np
+
+DATABASE_FILE = 'sweeps.sqlite'
+
+# dataset name and version of each corpus, as in the routines of training.py
+CORPORA = {"rct": ("RCT", "neo"),
+           "drinv": ("DrInventor", "arg10"),
+           "ukp": ("AAEC_v2", "new_2R"),
+           "cdcp": ("cdcp_ACL17", "new_3"),
+           "scidtb": ("scidtb_argmin_annotations", "only_arg_v1"),
+           "echr": ("ECHR2018", "arg0")}
+
+# arguments of perform_training shared by the trials of the command line sweeps
+BASE_ARGUMENTS = {'save_weights_only': True,
+                  'epochs': 10000,
+                  'patience': 100,
+                  'network': 11,
+                  'monitor': "links",
+                  'true_validation': True,
+                  'distance': 5,
+                  'iterations': 1,
+                  'single_LSTM': True,
+                  'merge': None,
+                  'clean_previous_networks': True}
+
+# a list is a choice among its values, a couple (low, high) is a uniform range (of integers, if they are integers),
+# a triple ('log', low, high) is a log-uniform range
+SEARCH_SPACE = {'lr_alfa': ('log', 0.0005, 0.01),
+                'res_scale': [15, 30, 60],
+                'embedder_layers': [2, 3, 4],
+                'batch_size': [200, 500],
+                'dropout_resnet': [0.1, 0.3, 0.5],
+                'dropout_embedder': [0.1, 0.3, 0.5],
+                'dropout_final': [0.0, 0.1]}
+
+
+def connect(database_path):
+    """
+    Opens the database of the sweeps, creating its tables if they do not exist
+    """
+    connection = sqlite3.connect(database_path, timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS trials ("
+                       "sweep TEXT, number INTEGER, name TEXT, arguments TEXT, status TEXT, score REAL, "
+                       "best_epoch INTEGER, last_epoch INTEGER, validation TEXT, test TEXT, train_time REAL, "
+                       "PRIMARY KEY (sweep, number))")
+    connection.execute("CREATE TABLE IF NOT EXISTS epochs ("
+                       "sweep TEXT, number INTEGER, epoch INTEGER, score REAL, best REAL, "
+                       "PRIMARY KEY (sweep, number, epoch))")
+    connection.commit()
+    return connection
+
+
+def grid_trials(space):
+    """
+    All the combinations of the values of the search space, whose entries must be lists
+    """
+    names = sorted(space.keys())
+    for name in names:
+        if not isinstance(space[name], list):
+            raise Exception("The grid search requires a list of values for " + name)
+    trials = []
+    for values in itertools.product(*[space[name] for name in names]):
+        trials.append(dict(zip(names, values)))
+    return trials
+
+
+def sample_value(values, random_state):
+    if isinstance(values, list):
+        return values[random_state.randint(len(values))]
+    if len(values) == 3 and values[0] == 'log':
+        return float(np.exp(random_state.uniform(np.log(values[1]), np.log(values[2]))))
+    low, high = values
+    if isinstance(low, int) and isinstance(high, int):
+        return int(random_state.randint(low, high + 1))
+    return float(random_state.uniform(low, high))
+
+
+def random_trials(space, trials_number, seed=0):
+    """
+    Combinations of values sampled from the search space
+    """
+    random_state = np.random.RandomState(seed)
+    names = sorted(space.keys())
+    trials = []
+    for n in range(trials_number):
+        trial = {}
+        for name in names:
+            value = sample_value(space[name], random_state)
+            # numpy types are not serializable
+            if isinstance(value, np.generic):
+                value = value.item()
+            trial[name] = value
+        trials.append(trial)
+    return trials
+
+
+class EpochRecorder:
+    """
+    Epoch callback of perform_training that stores the validation score of each epoch of a trial.
+    With successive halving, at the epochs min_epochs * eta^k the trial is stopped if its best score is not in the
+    best 1/eta of the ones of the trials that reached the same epoch (asynchronously, as soon as there are eta of them).
+    """
+
+    def __init__(self, database_path, sweep, number, min_epochs=None, eta=3):
+        """
+        :param min_epochs: epoch of the first comparison, None to never stop the trial
+        :param eta: the fraction of trials kept at each comparison is 1/eta
+        """
+        self.database_path = database_path
+        self.sweep = sweep
+        self.number = number
+        self.min_epochs = min_epochs
+        self.eta = eta
+        self.best = None
+        self.best_epoch = 0
+        self.stopped = False
+
+    def is_rung(self, epoch):
+        if self.min_epochs is None or epoch < self.min_epochs or epoch % self.min_epochs != 0:
+            return False
+        rung = epoch // self.min_epochs
+        while rung % self.eta == 0:
+            rung = rung // self.eta
+        return rung == 1
+
+    def __call__(self, epoch, score):
+        score = float(score)
+        if self.best is None or score > self.best:
+            self.best = score
+            self.best_epoch = epoch
+
+        connection = connect(self.database_path)
+        connection.execute("INSERT OR REPLACE INTO epochs VALUES (?, ?, ?, ?, ?)",
+                           (self.sweep, self.number, epoch, score, self.best))
+        connection.commit()
+
+        if self.is_rung(epoch):
+            scores = [row[0] for row in connection.execute("SELECT best FROM epochs WHERE sweep = ? AND epoch = ?",
+                                                           (self.sweep, epoch))]
+            if len(scores) >= self.eta:
+                better = np.sum(np.array(scores) > self.best)
+                if better >= max(1, len(scores) // self.eta):
+                    self.stopped = True
+        connection.close()
+        return self.stopped
+
+
+def run_trial(task):
+    """
+    Trains a trial in a process of the pool and stores its results
+    """
+    # imported here because training requires tensorflow
+    import training
+
+    database_path, sweep, number, arguments, min_epochs, eta = task
+
+    recorder = EpochRecorder(database_path, sweep, number, min_epochs, eta)
+    arguments = dict(arguments)
+    arguments['epoch_callback'] = recorder
+
+    connection = connect(database_path)
+    connection.execute("UPDATE trials SET status = 'running' WHERE sweep = ? AND number = ?", (sweep, number))
+    connection.commit()
+    connection.close()
+
+    status = 'failed'
+    validation = None
+    test = None
+    train_time = None
+    try:
+        final_scores, train_times = training.perform_training(**arguments)
+        if len(train_times) > 0:
+            validation = json.dumps([float(value) for value in final_scores['validation'][0]])
+            test = json.dumps([float(value) for value in final_scores['test'][0]])
+            train_time = float(train_times[0])
+        if recorder.stopped:
+            status = 'stopped'
+        else:
+            status = 'completed'
+    except Exception:
+        traceback.print_exc()
+
+    connection = connect(database_path)
+    connection.execute("UPDATE trials SET status = ?, score = ?, best_epoch = ?, last_epoch = ?, validation = ?, "
+                       "test = ?, train_time = ? WHERE sweep = ? AND number = ?",
+                       (status, recorder.best, recorder.best_epoch,
+                        connection.execute("SELECT MAX(epoch) FROM epochs WHERE sweep = ? AND number = ?",
+                                           (sweep, number)).fetchone()[0],
+                        validation, test, train_time, sweep, number))
+    connection.commit()
+    connection.close()
+
+    print(str(time.ctime()) + "\tTRIAL " + sweep + " " + str(number) + " " + status.upper() + ": " + str(recorder.best))
+    sys.stdout.flush()
+    return number, status, recorder.best
+
+
+def run_sweep(sweep, base_arguments, space, method='random', trials_number=20, processes=1,
+              threads_per_trial=None, min_epochs=10, eta=3, seed=0, database_path=None):
+    """
+    Trains the trials of a sweep, skipping the ones already completed or stopped by a previous run with the same name.
+    :param sweep: name of the sweep, also used as prefix of the names of the networks
+    :param base_arguments: the arguments of perform_training shared by the trials
+    :param space: the search space, see SEARCH_SPACE
+    :param method: 'grid' for all the combinations of the space, 'random' for trials_number random combinations,
+                   'asha' for random combinations with successive halving
+    :param processes: number of trials trained at the same time
+    :param threads_per_trial: number of threads of each trial, by default the cores are divided among the processes
+    :param min_epochs: epoch of the first comparison of successive halving
+    :param eta: with successive halving, the fraction of trials kept at each comparison is 1/eta
+    :param database_path: the SQLite database of the results, DATABASE_FILE in network_models by default
+    :return: list with the number, the status and the best validation score of each trained trial
+    """
+    # imported here because training requires tensorflow
+    import training
+
+    if database_path is None:
+        save_dir = os.path.join(os.getcwd(), 'network_models')
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+        database_path = os.path.join(save_dir, DATABASE_FILE)
+
+    if method == 'grid':
+        trials = grid_trials(space)
+    elif method == 'random' or method == 'asha':
+        trials = random_trials(space, trials_number, seed)
+    else:
+        raise Exception("Unknown sweep method: " + str(method))
+
+    halving_epochs = None
+    if method == 'asha':
+        halving_epochs = min_epochs
+
+    # the defaults of perform_training, so that the datasets of the trials can be prepared
+    defaults = {}
+    for parameter in inspect.signature(training.perform_training).parameters.values():
+        defaults[parameter.name] = parameter.default
+
+    connection = connect(database_path)
+    tasks = []
+    datasets = {}
+    for number in range(len(trials)):
+        arguments = dict(defaults)
+        arguments.update(base_arguments)
+        arguments.update(trials[number])
+        arguments['name'] = sweep + "_" + str(number)
+        # the trials share the dataset cache
+        arguments['use_cache'] = True
+
+        row = connection.execute("SELECT status FROM trials WHERE sweep = ? AND number = ?",
+                                 (sweep, number)).fetchone()
+        if row is not None and row[0] in ('completed', 'stopped'):
+            continue
+        # a trial interrupted by a previous run is trained again from the beginning
+        arguments['overwrite'] = row is not None
+        connection.execute("DELETE FROM epochs WHERE sweep = ? AND number = ?", (sweep, number))
+        connection.execute("INSERT OR REPLACE INTO trials (sweep, number, name, arguments, status) "
+                           "VALUES (?, ?, ?, ?, 'pending')",
+                           (sweep, number, arguments['name'], json.dumps(trials[number], sort_keys=True)))
+
+        datasets[json.dumps(training.dataset_arguments(arguments), sort_keys=True)] = arguments
+        tasks.append((database_path, sweep, number, arguments, halving_epochs, eta))
+    connection.commit()
+    connection.close()
+
+    print(str(time.ctime()) + "\tSWEEP " + sweep + ": " + str(len(tasks)) + " trials to train, " +
+          str(len(trials) - len(tasks)) + " already trained")
+    if len(tasks) == 0:
+        return []
+
+    for arguments in datasets.values():
+        training.prepare_dataset_cache(arguments)
+
+    processes = min(processes, len(tasks))
+    threads = threads_per_trial
+    if threads is None:
+        threads = max(1, multiprocessing.cpu_count() // processes)
+
+    # TensorFlow can not be used after a fork, so each trial is trained in a new process
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(processes, initializer=training.init_training_worker, initargs=(threads,),
+                        maxtasksperchild=1)
+    results = list(pool.imap_unordered(run_trial, tasks, chunksize=1))
+    pool.close()
+    pool.join()
+
+    return results
+
+
+def best_trials(sweep, count=10, database_path=None):
+    """
+    The trials of a sweep with the best validation score
+    :return: list with the number, the status, the score, the best epoch and the hyper-parameters of each trial
+    """
+    if database_path is None:
+        database_path = os.path.join(os.getcwd(), 'network_models', DATABASE_FILE)
+    connection = connect(database_path)
+    rows = connection.execute("SELECT number, status, score, best_epoch, arguments FROM trials "
+                              "WHERE sweep = ? AND score IS NOT NULL ORDER BY score DESC LIMIT ?",
+                              (sweep, count)).fetchall()
+    connection.close()
+    return [(number, status, score, best_epoch, json.loads(arguments))
+            for number, status, score, best_epoch, arguments in rows]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Hyper-parameter sweep over the training procedure")
+    parser.add_argument('-c', '--corpus',
+                        choices=["rct", "drinv", "cdcp", "echr", "ukp", "scidtb"],
+                        help="corpus", default="cdcp")
+    parser.add_argument('-n', '--name', help="name of the sweep", default=None)
+    parser.add_argument('-m', '--method', help="search method",
+                        choices=["grid", "random", "asha"], default="asha")
+    parser.add_argument('-t', '--trials', help="number of trials of the random searches", type=int, default=20)
+    parser.add_argument('-p', '--processes', help="number of trials trained at the same time", type=int, default=1)
+    parser.add_argument('-e', '--min_epochs', help="epoch of the first comparison of successive halving",
+                        type=int, default=10)
+    parser.add_argument('-r', '--report', help="print the best trials of the sweep instead of training",
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    dataset_name, dataset_version = CORPORA[args.corpus]
+    sweep_name = args.name
+    if sweep_name is None:
+        sweep_name = args.corpus + "_" + args.method
+
+    if args.report:
+        for number, status, score, best_epoch, hyperparameters in best_trials(sweep_name):
+            print(str(number) + "\t" + status + "\t" + str(round(score, 5)) + "\t" + str(best_epoch) + "\t" +
+                  json.dumps(hyperparameters, sort_keys=True))
+    else:
+        base = dict(BASE_ARGUMENTS)
+        base['dataset_name'] = dataset_name
+        base['dataset_version'] = dataset_version
+        space = SEARCH_SPACE
+        if args.method == 'grid':
+            space = {}
+            for parameter, values in SEARCH_SPACE.items():
+                if isinstance(values, list):
+                    space[parameter] = values
+        run_sweep(sweep_name, base, space, method=args.method, trials_number=args.trials,
+                  processes=args.processes, min_epochs=args.min_epochs)
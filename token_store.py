@@ -0,0 +1,257 @@
+__author__ = "Andrea Galassi"
+__copyright__ = "Copyright 2018-2020 Andrea Galassi"
+__license__ = "BSD 3-clause"
+__version__ = "0.2.0"
+__email__ = "a.galassi@unibo.it"
+
+"""
+Packed storage of the token sequences created by embedder.py.
+All the sequences of a folder are concatenated in a single array, with an array of offsets and the list of the IDs,
+instead of having one .npz file for each text or proposition.
+"""
+
+import os
+import time
+import shutil
+import argparse
+import numpy as np
+
+TOKENS_FILE = 'tokens.npy'
+OFFSETS_FILE = 'offsets.npy'
+IDS_FILE = 'ids.npy'
+# link to the folder of the current version of the packed arrays, which is replaced with a single rename
+PACKED_LINK = 'packed'
+
+
+def packed_path(store_path):
+    """
+    Folder of the packed arrays of a store: the current version, or the store itself if it was packed before the
+    versions were introduced
+    """
+    link_path = os.path.join(store_path, PACKED_LINK)
+    if os.path.exists(os.path.join(link_path, TOKENS_FILE)):
+        # resolved once, so that all the arrays are read from the same version
+        return os.path.realpath(link_path)
+    return store_path
+
+
+def is_packed(store_path):
+    return os.path.exists(os.path.join(packed_path(store_path), TOKENS_FILE))
+
+
+class TokenStore:
+    """
+    Read access to the sequences of a folder, by ID.
+    If the folder has not been packed yet, the sequences are read from the .npz files.
+    """
+
+    def __init__(self, store_path, mmap=True):
+        """
+        :param store_path: folder of the sequences
+        :param mmap: whether the packed arrays are memory-mapped instead of read in memory
+        """
+        self.store_path = store_path
+        self.packed = is_packed(store_path)
+
+        if self.packed:
+            mmap_mode = None
+            if mmap:
+                mmap_mode = 'r'
+            arrays_path = packed_path(store_path)
+            self.tokens = np.load(os.path.join(arrays_path, TOKENS_FILE), mmap_mode=mmap_mode)
+            self.offsets = np.load(os.path.join(arrays_path, OFFSETS_FILE))
+            ids = np.load(os.path.join(arrays_path, IDS_FILE))
+            if len(self.offsets) != len(ids) + 1 or self.offsets[-1] != len(self.tokens):
+                raise Exception("The packed store " + arrays_path + " is corrupted: " + str(len(ids)) + " IDs, " +
+                                str(len(self.offsets)) + " offsets up to " + str(self.offsets[-1]) + ", " +
+                                str(len(self.tokens)) + " tokens")
+            self.index = {}
+            for row in range(len(ids)):
+                self.index[str(ids[row])] = row
+        else:
+            self.tokens = None
+            self.offsets = None
+            self.index = {}
+            if os.path.exists(store_path):
+                for file_name in os.listdir(store_path):
+                    if file_name.endswith('.npz'):
+                        self.index[file_name[:-len('.npz')]] = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, ID):
+        return str(ID) in self.index
+
+    def __getitem__(self, ID):
+        ID = str(ID)
+        if ID not in self.index:
+            raise KeyError(ID)
+        if self.packed:
+            row = self.index[ID]
+            return self.tokens[self.offsets[row]:self.offsets[row + 1]]
+        return np.load(os.path.join(self.store_path, ID + '.npz'))['arr_0']
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def rows(self, ids):
+        """
+        Rows of the given IDs in the packed arrays: the tokens of a row are tokens[offsets[row]:offsets[row + 1]]
+        """
+        if not self.packed:
+            raise Exception("The folder " + self.store_path + " has not been packed")
+        rows = np.zeros(len(ids), dtype=np.int64)
+        for n in range(len(ids)):
+            ID = str(ids[n])
+            if ID not in self.index:
+                raise KeyError(ID)
+            rows[n] = self.index[ID]
+        return rows
+
+    def ids(self):
+        return sorted(self.index.keys())
+
+    def keys(self):
+        return self.ids()
+
+
+class TokenStoreWriter:
+    """
+    Collects the sequences of a folder and packs them when closed.
+    The sequences already present in the folder are kept, unless they are replaced or removed.
+    The rows are sorted by ID, so the result does not depend on the order of the insertions.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.sequences = {}
+        self.removed = set()
+
+    def add(self, ID, sequence):
+        ID = str(ID)
+        self.sequences[ID] = np.asarray(sequence)
+        self.removed.discard(ID)
+
+    def remove(self, ID):
+        ID = str(ID)
+        self.sequences.pop(ID, None)
+        self.removed.add(ID)
+
+    def close(self):
+        if not os.path.exists(self.store_path):
+            os.makedirs(self.store_path)
+
+        sequences = {}
+        old_store = TokenStore(self.store_path, mmap=False)
+        for ID in old_store.ids():
+            if ID not in self.sequences and ID not in self.removed:
+                sequences[ID] = np.asarray(old_store[ID])
+        sequences.update(self.sequences)
+
+        write_store(self.store_path, sequences)
+
+
+def write_store(store_path, sequences):
+    """
+    Writes a packed store.
+
+    :param store_path: folder of the store
+    :param sequences: dictionary from each ID to its sequence
+    """
+    ids = sorted(sequences.keys())
+
+    # shape of each token and dtype, taken from the first non empty sequence
+    token_shape = ()
+    dtype = None
+    for ID in ids:
+        sequence = sequences[ID]
+        if dtype is None:
+            dtype = sequence.dtype
+        if len(sequence) > 0:
+            token_shape = sequence.shape[1:]
+            dtype = sequence.dtype
+            break
+    if dtype is None:
+        dtype = np.int64
+
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    for row in range(len(ids)):
+        offsets[row + 1] = offsets[row] + len(sequences[ids[row]])
+
+    tokens = np.zeros((offsets[-1],) + token_shape, dtype=dtype)
+    for row in range(len(ids)):
+        sequence = sequences[ids[row]]
+        if len(sequence) > 0:
+            tokens[offsets[row]:offsets[row + 1]] = sequence
+
+    # the arrays are written in a new folder, which replaces the current version only when complete, by replacing the
+    # link with a single rename: a crash leaves either the old version or the new one
+    version_name = PACKED_LINK + '.' + str(int(time.time() * 1000000)) + '.' + str(os.getpid())
+    os.makedirs(os.path.join(store_path, version_name))
+    for file_name, array in [(TOKENS_FILE, tokens), (OFFSETS_FILE, offsets), (IDS_FILE, np.array(ids, dtype=str))]:
+        with open(os.path.join(store_path, version_name, file_name), 'wb') as f:
+            np.save(f, array)
+
+    link_path = os.path.join(store_path, PACKED_LINK)
+    previous_name = None
+    if os.path.islink(link_path):
+        previous_name = os.readlink(link_path)
+    temporary_link = link_path + '.link' + str(os.getpid())
+    if os.path.lexists(temporary_link):
+        os.remove(temporary_link)
+    os.symlink(version_name, temporary_link)
+    os.replace(temporary_link, link_path)
+
+    # the version that has just been replaced is kept, because a reader may have resolved the link before the rename
+    # and still be opening its arrays: only the older versions, the ones left by interrupted writes, and the arrays of
+    # the stores packed before the versions were introduced are removed (the latter once they are not the previous
+    # version anymore)
+    for file_name in os.listdir(store_path):
+        file_path = os.path.join(store_path, file_name)
+        if file_name.startswith(PACKED_LINK + '.') and file_name not in (version_name, previous_name) and \
+                os.path.isdir(file_path) and not os.path.islink(file_path):
+            shutil.rmtree(file_path, ignore_errors=True)
+        elif file_name.startswith(PACKED_LINK + '.link') and os.path.islink(file_path):
+            os.remove(file_path)
+        elif file_name in (TOKENS_FILE, OFFSETS_FILE, IDS_FILE) and previous_name is not None:
+            os.remove(file_path)
+
+
+def convert_npz_directory(store_path, remove=False):
+    """
+    Packs the .npz files of a folder created by the previous versions of embedder.py
+
+    :param store_path: folder with one .npz file for each sequence
+    :param remove: whether the .npz files are deleted after the conversion
+    :return: the number of sequences
+    """
+    old_store = TokenStore(store_path, mmap=False)
+    if old_store.packed:
+        print("Already packed: " + store_path)
+        return len(old_store)
+
+    sequences = {}
+    for ID in old_store.ids():
+        sequences[ID] = old_store[ID]
+    write_store(store_path, sequences)
+
+    if remove:
+        for ID in sequences.keys():
+            os.remove(os.path.join(store_path, ID + '.npz'))
+
+    print(str(time.ctime()) + "\tPacked " + str(len(sequences)) + " sequences in " + store_path)
+    return len(sequences)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Packs the .npz files of embedding folders")
+
+    parser.add_argument('paths', nargs='+', help="Folders of .npz files, e.g. Datasets/cdcp_ACL17/embeddings/glove300/new_3")
+    parser.add_argument('-r', '--remove', help="Delete the .npz files after the conversion", action="store_true")
+
+    args = parser.parse_args()
+
+    for path in args.paths:
+        convert_npz_directory(path, args.remove)
@@ -0,0 +1,192 @@
+__author__ = "Andrea Galassi"
+__copyright__ = "Copyright 2018-2020 Andrea Galassi"
+__license__ = "BSD 3-clause"
+__version__ = "0.2.0"
+__email__ = "a.galassi@unibo.it"
+
+"""
+Tokenization shared by glove_loader.py (creation of the vocabulary) and embedder.py (creation of the embeddings).
+"""
+
+import re
+import functools
+
+SEPARATORS = ['(', ')', '[', ']', '{', '}', '...', '_', '--', '|',
+              ';', ':',
+              "±", "·", "≥", "≤", "≈", '=', "<", ">", "£", "$", "€",
+              '!!!', '???', '?!?', '!?!', '?!', '!?', '??', '!!',
+              '!', '?',
+              '/', '"', '%', '$', '*', '#', '+',
+              ',', '.',
+              "'s", "'ve", "'ll", "'re", "'d",
+              '-', "'",
+              "∂", "∆", "∇"]
+
+REPLACINGS = {"’": "'",
+              "‘": "'",
+              "“": '"',
+              "”": '"',
+              "''": '"',
+              "—": '-',
+              "−": '-',
+              "–": '-',
+              "⁄": '/'}
+
+STOPWORDS = ['.', ',', ':', ';']
+
+# maximum number of words whose tokens are kept in memory by a Tokenizer
+CACHE_SIZE = 2 ** 20
+# id of the tokens that are not in the vocabulary
+UNKNOWN = -1
+
+
+def normalize(text):
+    """
+    Replaces the different versions of the same character
+    """
+    for old in REPLACINGS.keys():
+        text = text.replace(old, REPLACINGS[old])
+    return text
+
+
+def compile_separators(separators):
+    """
+    Compiles the separators for the single-pass splitting.
+
+    Parameters
+    ----------
+    separators : list of str
+        Splitting strings, in order of priority
+
+    Returns
+    ----------
+    pattern : re.Pattern
+        Regular expression that matches the first character of any separator
+    table : dict
+        For each first character, the indexes of the separators that begin with it, in order of priority
+    """
+    table = {}
+    for index in range(len(separators)):
+        separator = separators[index]
+        if separator[0] not in table:
+            table[separator[0]] = []
+        table[separator[0]].append(index)
+    pattern = re.compile('[' + ''.join([re.escape(char) for char in sorted(table.keys())]) + ']')
+    return pattern, table
+
+
+def find_separators(word, separators, pattern, table):
+    """
+    Returns the sorted indexes of the separators contained in the word.
+    The word is scanned once: only the separators that begin with one of its characters are checked.
+    """
+    indexes = set()
+    for char in set(pattern.findall(word)):
+        for index in table[char]:
+            if separators[index] in word:
+                indexes.add(index)
+    return sorted(indexes)
+
+
+class Tokenizer:
+    """
+    Splits the texts in the tokens of a vocabulary, as done by embedder.py.
+    The texts are splitted on whitespaces, then each word is progressively splitted with the separators,
+    until its pieces are recognized as tokens. The stop symbols at the end of the pieces are removed when the rest of
+    the piece is in the vocabulary.
+    Since each word is splitted independently from the others, the tokens of the last words are kept in a LRU cache.
+    """
+
+    def __init__(self, vocabulary, separators=None, cache_size=CACHE_SIZE):
+        """
+        :param vocabulary: dictionary from each token to its id
+        :param separators: list of the splitting strings, SEPARATORS if not provided
+        :param cache_size: maximum number of words kept in the cache, None for no limit
+        """
+        if separators is None:
+            separators = SEPARATORS
+        self.vocabulary = vocabulary
+        self.separators = separators
+        self._pattern, self._table = compile_separators(separators)
+        self._cached_split = functools.lru_cache(maxsize=cache_size)(self._split_word)
+
+    def tokenize_word(self, word):
+        """
+        Returns the ids of the tokens of a single word, UNKNOWN for the pieces that are not recognized
+        :param word: a string without whitespaces
+        :return: tuple of int
+        """
+        return self._cached_split(word)
+
+    def tokenize(self, text):
+        """
+        Returns the ids of the tokens of a text, UNKNOWN for the pieces that are not recognized
+        :param text: the text, whose characters have already been normalized
+        :return: list of int
+        """
+        ids = []
+        for word in text.split():
+            ids.extend(self._cached_split(word))
+        return ids
+
+    def cache_info(self):
+        """
+        Returns the hits, misses, maxsize and currsize of the cache
+        """
+        return self._cached_split.cache_info()
+
+    def cache_clear(self):
+        self._cached_split.cache_clear()
+
+    def _split_word(self, word):
+        tokens = []
+        contained = find_separators(word, self.separators, self._pattern, self._table)
+        self._expand(word, False, 0, contained, tokens)
+
+        ids = []
+        for token in tokens:
+            if token == '':
+                ids.append(UNKNOWN)
+            else:
+                ids.append(self.vocabulary[token])
+        return tuple(ids)
+
+    def _expand(self, word, recognized, step, contained, tokens):
+        """
+        Appends to tokens the final tokens of a piece of word, '' for the pieces that are not recognized.
+        Step 0 is the whitespace splitting, step i + 1 follows the splitting with separators[i]: the piece has been
+        created in the given step and has not been recognized yet in it.
+        A piece can only change when a stop symbol is removed, which depends only on the piece, or when it is splitted
+        by one of the separators that it contains, so the steps in which nothing happens are skipped.
+        """
+        if step > len(self.separators):
+            if recognized:
+                tokens.append(word)
+            else:
+                tokens.append('')
+            return
+
+        # remove possible stop symbols in the end of the token
+        if len(word) > 1 and word[-1] in STOPWORDS and word[:-1] in self.vocabulary:
+            self._expand(word[:-1], True, step + 1, [], tokens)
+            tokens.append(word[-1])
+            return
+
+        if recognized or word in self.vocabulary:
+            tokens.append(word)
+            return
+
+        # the first separator that splits the piece
+        for position in range(len(contained)):
+            index = contained[position]
+            separator = self.separators[index]
+            if index >= step and separator in word:
+                pieces = word.split(separator)
+                for n in range(len(pieces)):
+                    if n > 0:
+                        self._expand(separator, True, index + 1, [], tokens)
+                    if pieces[n] != '':
+                        self._expand(pieces[n], False, index + 1, contained[position + 1:], tokens)
+                return
+
+        tokens.append('')
@@ -13,21 +13,34 @@ import pandas
 import numpy as np
 import sys
 import time
+import shutil
+import hashlib
 import evaluate_net
 import json
 import tensorflow as tf
 import argparse
+import inspect
+import contextlib
+import multiprocessing
 
 from dataset_config import dataset_info
 from networks import (build_net_7, build_not_res_net_7, create_crop_fn, create_sum_fn, create_average_fn,
                       create_count_nonpadding_fn, create_elementwise_division_fn, create_padding_mask_fn,
                       create_mutiply_negative_elements_fn, build_net_11,)
-from tensorflow.keras.callbacks import Callback, LearningRateScheduler, ModelCheckpoint, EarlyStopping, CSVLogger
+from tensorflow.keras.callbacks import Callback, LearningRateScheduler, EarlyStopping, CSVLogger
 from tensorflow.keras.optimizers import RMSprop, Adam
 from tensorflow.keras.models import load_model, model_from_json
-from training_utils import TimingCallback, create_lr_annealing_function, get_avgF1
+from training_utils import (TimingCallback, create_lr_annealing_function, get_avgF1, make_feed, predict_pairs,
+                            add_pruned_pairs, PairEvaluator, BestWeightsCheckpoint, read_checkpoint)
 from glove_loader import DIM
+from token_store import TokenStore, TOKENS_FILE, OFFSETS_FILE, IDS_FILE, is_packed, packed_path
 from sklearn.metrics import f1_score
+
+# the dataset cache is locked only where it is possible
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 from tensorflow.keras import backend as K
 
 DEBUG = False
@@ -39,21 +52,373 @@ config.gpu_options.per_process_gpu_memory_fraction = 0.8
 config.gpu_options.allow_growth = True
 K.set_session(tf.Session(config=config))
 
+def label_ids(column, categorical):
+    """
+    Class ids of a column of the dataframe, according to the one-hot encodings of dataset_config
+    :param column: pandas Series of the class names (None for the lack of relation)
+    :param categorical: dictionary from each class name to its one-hot encoding
+    :return: int8 array with the class id of each element of the column
+    """
+    missing = np.asarray(column.isna())
+    codes, uniques = pandas.factorize(column)
+
+    table = []
+    for name in uniques:
+        table.append(np.argmax(categorical[name]))
+    if np.any(missing):
+        codes[missing] = len(table)
+        table.append(np.argmax(categorical[None]))
+    table = np.array(table, dtype=np.int8)
+
+    return table[codes]
+
+
+def distance_encoding(difference, distance):
+    """
+    Encoding of the distance between two components: 2 * distance values, which are 1 between the middle and the
+    middle plus the difference, saturated at -distance and distance
+    :param difference: array with the difference between the index of the target and the one of the source
+    :param distance: maximum distance that is encoded
+    :return: matrix with one row for each element of difference
+    """
+    difference = np.clip(difference, -distance, distance)[:, None]
+    positions = np.arange(2 * distance)[None, :]
+    positive = (positions >= distance) & (positions < distance + difference)
+    negative = (positions >= distance + difference) & (positions < distance)
+    return (positive | negative).astype(int)
+
+
+def pad_propositions(texts, max_prop_len, pad, dtype, ndim):
+    """
+    Pads the propositions on the left, up to max_prop_len, and stacks them in an array.
+    The array is allocated once and filled slice by slice. If a token id does not fit in dtype (e.g. a vocabulary
+    with more than 65535 words and uint16), uint32 is used instead.
+    """
+    if len(texts) == 0:
+        return np.array(texts, ndmin=ndim, dtype=dtype)
+
+    token_shape = ()
+    maximum = 0
+    for text in texts:
+        if len(text) > 0:
+            token_shape = np.shape(text)[1:]
+            maximum = max(maximum, np.max(text))
+
+    if np.issubdtype(dtype, np.integer) and maximum > np.iinfo(dtype).max:
+        if maximum > np.iinfo(np.uint32).max:
+            raise Exception("Token id " + str(maximum) + " does not fit in uint32")
+        print(str(time.ctime()) + "\t\t\tTOKEN ID " + str(maximum) + " DOES NOT FIT IN " + np.dtype(dtype).name +
+              ": USING uint32")
+        dtype = np.uint32
+
+    padded = np.full((len(texts), max_prop_len) + token_shape, pad, dtype=dtype)
+    for j in range(len(texts)):
+        length = len(texts[j])
+        if length > 0:
+            padded[j, max_prop_len - length:] = texts[j]
+    return padded
+
+
+def sample_negatives(candidates, difference, negative_ratio, stratified=False, seed=0):
+    """
+    Subsampling of the pairs without relation.
+    :param candidates: boolean array, True for the pairs that can be dropped
+    :param difference: array with the difference between the index of the target and the one of the source
+    :param negative_ratio: fraction of the candidates that is kept, or dictionary from the absolute difference to the
+                           fraction kept for that difference (the candidates whose difference is not in it are all kept)
+    :param stratified: if True, exactly round(fraction * n) of the n candidates of each difference are kept, otherwise
+                       each candidate is kept with probability fraction
+    :param seed: seed of the random choices
+    :return: boolean array, False for the dropped pairs
+    """
+    random_state = np.random.RandomState(seed)
+    distances = np.abs(difference)
+    keep = np.ones(len(candidates), dtype=bool)
+
+    if isinstance(negative_ratio, dict):
+        ratios = negative_ratio
+    else:
+        ratios = {}
+        for value in np.unique(distances[candidates]):
+            ratios[value] = negative_ratio
+
+    for value in sorted(ratios.keys()):
+        rows = np.flatnonzero(candidates & (distances == value))
+        if stratified:
+            kept = int(round(ratios[value] * len(rows)))
+            dropped = random_state.permutation(rows)[kept:]
+        else:
+            dropped = rows[random_state.random_sample(len(rows)) >= ratios[value]]
+        keep[dropped] = False
+    return keep
+
+
+def candidate_overlap(store, source_ids, target_ids):
+    """
+    Cheap pre-score of the candidate pairs: the Jaccard similarity of the sets of tokens of their propositions.
+    :param store: TokenStore of the propositions
+    :param source_ids: IDs of the source propositions
+    :param target_ids: IDs of the target propositions
+    :return: float32 array with the score of each pair
+    """
+    token_sets = {}
+    overlap = np.zeros(len(source_ids), dtype=np.float32)
+    for n in range(len(source_ids)):
+        pair_sets = []
+        for ID in (source_ids[n], target_ids[n]):
+            if ID not in token_sets:
+                token_sets[ID] = set(np.asarray(store[ID]).tolist())
+            pair_sets.append(token_sets[ID])
+        union = len(pair_sets[0] | pair_sets[1])
+        if union > 0:
+            overlap[n] = len(pair_sets[0] & pair_sets[1]) / union
+    return overlap
+
+
+# version of the format of the dataset cache, to be increased when load_dataset changes its results
+CACHE_VERSION = 3
+CACHE_META = 'meta.json'
+# fields of the splits that are returned as lists instead of arrays when the cache is loaded
+CACHE_LIST_FIELDS = ('s_id', 't_id', 'difference')
+# folder of the datasets shared by the processes of a node, in the format of the cache (see load_dataset)
+SHARED_DATASETS_PATH = os.path.join('/dev/shm', 'StructurePrediction18')
+
+
+def source_fingerprint(dataframe_path, embed_path, dataset_name, embed_name, dataset_version):
+    """
+    Fingerprint of the files from which a dataset is loaded: the dataframe, the token store, the configuration and the
+    embeddings of the vocabulary, whose rows are the token ids of the store
+    """
+    files = [dataframe_path]
+    resources_path = os.path.join(os.getcwd(), 'Datasets', dataset_name, 'resources', embed_name)
+    files.append(os.path.join(resources_path, dataset_version, 'glove.embeddings.npz'))
+    files.append(os.path.join(resources_path, 'glove.embeddings.npz'))
+    for file_name in [TOKENS_FILE, OFFSETS_FILE, IDS_FILE]:
+        files.append(os.path.join(packed_path(embed_path), file_name))
+    if not is_packed(embed_path) and os.path.exists(embed_path):
+        for file_name in sorted(os.listdir(embed_path)):
+            files.append(os.path.join(embed_path, file_name))
+
+    fingerprint = []
+    for file_path in files:
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            fingerprint.append([file_path, stat.st_size, stat.st_mtime_ns])
+    fingerprint.append(repr(dataset_info[dataset_name]))
+    return fingerprint
+
+
+@contextlib.contextmanager
+def cache_lock(cache_path, exclusive=True):
+    """
+    Lock of a cache folder, held in shared mode while it is read and in exclusive mode while it is written, so that the
+    processes that need the same dataset at the same time create it once
+    """
+    parent_path = os.path.dirname(cache_path)
+    if not os.path.isdir(parent_path):
+        os.makedirs(parent_path, exist_ok=True)
+    with open(cache_path + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            if exclusive:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+        yield
+
+
+def save_dataset_cache(cache_path, dataset, max_text_len, max_prop_len, meta):
+    """
+    Saves the result of load_dataset as .npy files, which are written in a temporary folder and then moved.
+    It must be called holding the exclusive cache_lock of the folder.
+    """
+    temporary_path = cache_path + '.tmp' + str(os.getpid())
+    if os.path.exists(temporary_path):
+        shutil.rmtree(temporary_path)
+    os.makedirs(temporary_path)
+
+    fields = {}
+    for key in dataset.keys():
+        if key in ('train', 'validation', 'test'):
+            for field in dataset[key].keys():
+                file_name = key + '.' + field + '.npy'
+                np.save(os.path.join(temporary_path, file_name), np.asarray(dataset[key][field]))
+                fields[file_name] = [key, field]
+        else:
+            file_name = key + '.npy'
+            np.save(os.path.join(temporary_path, file_name), np.asarray(dataset[key]))
+            fields[file_name] = [key]
+
+    meta = dict(meta)
+    meta['fields'] = fields
+    meta['max_text_len'] = int(max_text_len)
+    meta['max_prop_len'] = int(max_prop_len)
+    with open(os.path.join(temporary_path, CACHE_META), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=0)
+
+    # a folder can not replace a non empty one: the old cache is moved away first, and the processes that have
+    # memory-mapped its files keep them until they close them
+    if os.path.exists(cache_path):
+        old_path = temporary_path + '.old'
+        os.replace(cache_path, old_path)
+        os.replace(temporary_path, cache_path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(temporary_path, cache_path)
+
+
+def load_dataset_cache(cache_path, meta):
+    """
+    Loads a dataset saved by save_dataset_cache, memory-mapping the arrays.
+    Returns None if the cache does not exist or has been created with different parameters or sources.
+    """
+    meta_path = os.path.join(cache_path, CACHE_META)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as meta_file:
+        saved_meta = json.load(meta_file)
+    for key in meta.keys():
+        if saved_meta.get(key) != meta[key]:
+            return None
+
+    dataset = {}
+    for file_name in sorted(saved_meta['fields'].keys()):
+        path = saved_meta['fields'][file_name]
+        array = np.load(os.path.join(cache_path, file_name), mmap_mode='r')
+        if len(path) == 1:
+            if path[0] == 'proposition_ids':
+                array = array.tolist()
+            dataset[path[0]] = array
+        else:
+            if path[1] in CACHE_LIST_FIELDS:
+                array = array.tolist()
+            if path[0] not in dataset:
+                dataset[path[0]] = {}
+            dataset[path[0]][path[1]] = array
+    return dataset, saved_meta['max_text_len'], saved_meta['max_prop_len']
+
+
 def load_dataset(dataset_split='total', dataset_name='cdcp_ACL17', dataset_version='new_2',
                  feature_type='embeddings', min_text_len=0, min_prop_len=0, distance=5,
-                 distance_train_limit=-1, embed_name="glove300"):
+                 distance_train_limit=-1, embed_name="glove300", deduplicate=False, use_cache=False, streaming=False,
+                 negative_ratio=None, stratified=False, sampling_seed=0, prune_candidates=True, shared=False):
+    """
+    Loads the pairs of propositions of a dataset, divided in train, validation and test.
+    The columns of the dataframe are processed all at once, instead of row by row.
+    The labels ('links', 'relations_type', 'sources_type', 'targets_type') are int8 arrays of class ids, numbered as
+    the one-hot encodings of dataset_info; the links have class 0 and the lack of link class 1.
+
+    If deduplicate is True, the padded propositions are not copied in each pair: dataset['propositions'] contains
+    each proposition once (their IDs are in dataset['proposition_ids']), and each split has the int32 arrays
+    'source_idx' and 'target_idx' with the rows of the propositions of each pair, instead of 'source_props' and
+    'target_props'.
+
+    If streaming is True, the propositions are not read: each split has the arrays 'source_rows' and 'target_rows'
+    with the rows of the propositions in the packed token store, from which they are read batch by batch (see
+    make_stream). The token store must have been packed. deduplicate is ignored.
+
+    If negative_ratio is given, the train pairs without relation are subsampled (see sample_negatives), while the
+    validation and test pairs are all kept.
+
+    If prune_candidates is True and the dataset has a max_candidate_distance in dataset_info, the pairs whose
+    components are farther apart are dropped from all the splits, unless their candidate_overlap reaches the
+    min_candidate_overlap of the dataset. The classes of their links and relations are kept in
+    the int arrays 'pruned_links' and 'pruned_relations' of each split, so that they are evaluated as non-links.
+
+    If use_cache is True, the result is saved in Datasets/<dataset_name>/cache as .npy files, and loaded from there
+    (memory-mapped) as long as the parameters and the source files are the same.
+
+    If shared is True, the result is published in the same format in SHARED_DATASETS_PATH, which is in shared memory:
+    the first process publishes it, and the following ones memory-map it read-only, so that all the processes of the
+    node that use the same dataset share a single copy of its arrays. The meta.json of each folder is its manifest.
+    The published datasets are removed by remove_shared_datasets.
+    """
 
     if distance < 0:
         distance = 0
 
-    if feature_type == 'bow':
+    if streaming:
+        deduplicate = False
+
+    if shared and not os.path.isdir(os.path.dirname(SHARED_DATASETS_PATH)):
+        print(str(time.ctime()) + '\t\tSHARED MEMORY NOT AVAILABLE, THE DATASET IS NOT SHARED')
+        shared = False
+
+    if use_cache or shared:
+        dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+        dataframe_path = os.path.join(dataset_path, 'pickles', dataset_version, dataset_split + '.pkl')
+        embed_path = os.path.join(dataset_path, "embeddings", embed_name, dataset_version)
+
+        parameters = [dataset_split, dataset_name, dataset_version, feature_type, min_text_len, min_prop_len, distance,
+                      distance_train_limit, embed_name, deduplicate, streaming, negative_ratio, stratified,
+                      sampling_seed, prune_candidates]
+        # the pruning depends on the configuration of the dataset
+        if prune_candidates:
+            parameters.append(dataset_info[dataset_name].get("max_candidate_distance"))
+            parameters.append(dataset_info[dataset_name].get("min_candidate_overlap"))
+        # the keys of the dictionaries would become strings in the json of the cache
+        if isinstance(negative_ratio, dict):
+            parameters[11] = [[key, negative_ratio[key]] for key in sorted(negative_ratio.keys())]
+        key = hashlib.sha1(json.dumps(parameters).encode('utf-8')).hexdigest()
+        cache_path = os.path.join(dataset_path, 'cache', key)
+        meta = {'version': CACHE_VERSION,
+                'parameters': parameters,
+                'sources': source_fingerprint(dataframe_path, embed_path, dataset_name, embed_name, dataset_version)}
+
+        if shared:
+            shared_path = os.path.join(SHARED_DATASETS_PATH, dataset_name, key)
+            with cache_lock(shared_path, exclusive=False):
+                result = load_dataset_cache(shared_path, meta)
+            if result is not None:
+                print(str(time.ctime()) + '\t\tDATASET ATTACHED FROM SHARED MEMORY ' + shared_path)
+                return result
+
+            # only one process publishes it, the others wait and attach
+            with cache_lock(shared_path):
+                result = load_dataset_cache(shared_path, meta)
+                if result is not None:
+                    print(str(time.ctime()) + '\t\tDATASET ATTACHED FROM SHARED MEMORY ' + shared_path)
+                    return result
+
+                dataset, max_text_len, max_prop_len = load_dataset(dataset_split, dataset_name, dataset_version,
+                                                                   feature_type, min_text_len, min_prop_len, distance,
+                                                                   distance_train_limit, embed_name, deduplicate,
+                                                                   use_cache=use_cache, streaming=streaming,
+                                                                   negative_ratio=negative_ratio,
+                                                                   stratified=stratified, sampling_seed=sampling_seed,
+                                                                   prune_candidates=prune_candidates)
+                save_dataset_cache(shared_path, dataset, max_text_len, max_prop_len, meta)
+                print(str(time.ctime()) + '\t\tDATASET PUBLISHED IN SHARED MEMORY ' + shared_path)
+                return load_dataset_cache(shared_path, meta)
+
+        with cache_lock(cache_path, exclusive=False):
+            result = load_dataset_cache(cache_path, meta)
+        if result is not None:
+            print(str(time.ctime()) + '\t\tDATASET LOADED FROM CACHE ' + cache_path)
+            return result
+
+        with cache_lock(cache_path):
+            # another process may have created it while this one was waiting for the lock
+            result = load_dataset_cache(cache_path, meta)
+            if result is not None:
+                print(str(time.ctime()) + '\t\tDATASET LOADED FROM CACHE ' + cache_path)
+                return result
+
+            dataset, max_text_len, max_prop_len = load_dataset(dataset_split, dataset_name, dataset_version,
+                                                               feature_type, min_text_len, min_prop_len, distance,
+                                                               distance_train_limit, embed_name, deduplicate,
+                                                               streaming=streaming, negative_ratio=negative_ratio,
+                                                               stratified=stratified, sampling_seed=sampling_seed,
+                                                               prune_candidates=prune_candidates)
+            save_dataset_cache(cache_path, dataset, max_text_len, max_prop_len, meta)
+            print(str(time.ctime()) + '\t\tDATASET SAVED IN CACHE ' + cache_path)
+            return load_dataset_cache(cache_path, meta)
+
+    # in both cases the propositions are sequences of token ids:
+    # with 'embeddings' the vectors are gathered from the embedding matrix batch by batch (see PairSequence)
+    if feature_type == 'bow' or feature_type == 'embeddings':
         pad = 0
         dtype = np.uint16
         ndim = 2
-    elif feature_type == 'embeddings':
-        pad = np.zeros(DIM)
-        dtype = np.float32
-        ndim = 3
 
     max_prop_len = min_prop_len
     max_text_len = min_text_len
@@ -63,135 +428,181 @@ def load_dataset(dataset_split='total', dataset_name='cdcp_ACL17', dataset_versi
     embed_path = os.path.join(dataset_path, "embeddings", embed_name, dataset_version)
 
     df = pandas.read_pickle(dataframe_path)
+    store = TokenStore(embed_path)
 
     categorical_prop = dataset_info[dataset_name]["categorical_prop"]
     categorical_link = dataset_info[dataset_name]["categorical_link"]
 
+    source_ids = df['source_ID'].astype(str)
+    target_ids = df['target_ID'].astype(str)
+
+    s_index = source_ids.str.rsplit('_', n=1).str[-1].astype(np.int64).values
+    t_index = target_ids.str.rsplit('_', n=1).str[-1].astype(np.int64).values
+    difference = t_index - s_index
+
+    sets = np.asarray(df['set'].astype(str))
+
+    # in case this is a train tuple, that the limitation on the distance is active and that the distance between
+    # the two components is greater than the distance allowed, skip this row
+    keep = np.ones(len(df), dtype=bool)
+    if distance_train_limit > 0:
+        keep = ~((sets == "train") & (np.abs(difference) > distance_train_limit))
+
+    # the pairs outside the window of the candidates are not given to the network
+    pruned = np.zeros(len(df), dtype=bool)
+    max_candidate_distance = dataset_info[dataset_name].get("max_candidate_distance")
+    min_candidate_overlap = dataset_info[dataset_name].get("min_candidate_overlap")
+    if prune_candidates and max_candidate_distance is not None:
+        pruned = keep & (np.abs(difference) > max_candidate_distance)
+        if min_candidate_overlap is not None:
+            # the far pairs whose propositions share enough tokens are candidates as well
+            far_rows = np.flatnonzero(pruned)
+            overlap = candidate_overlap(store, source_ids.values[far_rows], target_ids.values[far_rows])
+            pruned[far_rows[overlap >= min_candidate_overlap]] = False
+        keep = keep & ~pruned
+        print(str(time.ctime()) + '\t\tPAIRS PRUNED BY THE CANDIDATE WINDOW: ' + str(int(np.sum(pruned))) + ' OF ' +
+              str(len(df)))
+
+    if negative_ratio is not None:
+        candidates = keep & (sets == "train") & np.asarray(df['relation_type'].isna())
+        keep = keep & sample_negatives(candidates, difference, negative_ratio, stratified, sampling_seed)
+        print(str(time.ctime()) + '\t\tTRAIN PAIRS WITHOUT RELATION: ' + str(int(np.sum(candidates))) + ', KEPT ' +
+              str(int(np.sum(candidates & keep))))
+
+    # class 0 is the link, class 1 its lack
+    links = np.where(np.asarray(df['source_to_target'], dtype=bool), 0, 1).astype(np.int8)
+    sources_type = label_ids(df['source_type'], categorical_prop)
+    targets_type = label_ids(df['target_type'], categorical_prop)
+    relations_type = label_ids(df['relation_type'], categorical_link)
+
+    if distance > 0:
+        distance_array = distance_encoding(difference, distance)
+
+    # each proposition is read once from the store
+    proposition_codes, proposition_ids = pandas.factorize(pandas.concat([source_ids, target_ids], ignore_index=True))
+    source_codes = proposition_codes[:len(df)]
+    target_codes = proposition_codes[len(df):]
+    if streaming:
+        # the lengths are known from the offsets of the store, the tokens are read only when needed
+        store_rows = store.rows(proposition_ids)
+        lengths = store.offsets[store_rows + 1] - store.offsets[store_rows]
+    else:
+        propositions = []
+        lengths = np.zeros(len(proposition_ids), dtype=np.int64)
+        for code in range(len(proposition_ids)):
+            propositions.append(store[proposition_ids[code]])
+            lengths[code] = len(propositions[code])
+
     dataset = {}
+    split_rows = {}
 
     for split in ('train', 'validation', 'test'):
+        rows = np.flatnonzero(keep & (sets == split))
+        split_rows[split] = rows
+
         dataset[split] = {}
-        dataset[split]['source_props'] = []
-        dataset[split]['target_props'] = []
-        dataset[split]['links'] = []
-        dataset[split]['relations_type'] = []
-        dataset[split]['sources_type'] = []
-        dataset[split]['targets_type'] = []
+        if streaming:
+            dataset[split]['source_rows'] = store_rows[source_codes[rows]]
+            dataset[split]['target_rows'] = store_rows[target_codes[rows]]
+        elif not deduplicate:
+            dataset[split]['source_props'] = [propositions[code] for code in source_codes[rows]]
+            dataset[split]['target_props'] = [propositions[code] for code in target_codes[rows]]
+        dataset[split]['links'] = links[rows]
+        dataset[split]['relations_type'] = relations_type[rows]
+        dataset[split]['sources_type'] = sources_type[rows]
+        dataset[split]['targets_type'] = targets_type[rows]
 
         if distance > 0:
-            dataset[split]['distance'] = []
-            dataset[split]['difference'] = []
-
-        dataset[split]['s_id'] = []
-        dataset[split]['t_id'] = []
+            dataset[split]['distance'] = distance_array[rows].astype(np.int8)
+            dataset[split]['difference'] = difference[rows].tolist()
+
+        dataset[split]['s_id'] = df['source_ID'].values[rows].tolist()
+        dataset[split]['t_id'] = df['target_ID'].values[rows].tolist()
+
+        pruned_rows = np.flatnonzero(pruned & (sets == split))
+        dataset[split]['pruned_links'] = links[pruned_rows]
+        dataset[split]['pruned_relations'] = relations_type[pruned_rows]
+
+        if len(rows) > 0:
+            max_prop_len = max(max_prop_len, int(np.max(lengths[source_codes[rows]])),
+                               int(np.max(lengths[target_codes[rows]])))
+
+    if deduplicate:
+        # each proposition is stored once, the pairs refer to it through its row
+        used = np.zeros(len(proposition_ids), dtype=bool)
+        for split in ('train', 'validation', 'test'):
+            used[source_codes[split_rows[split]]] = True
+            used[target_codes[split_rows[split]]] = True
+        used = np.flatnonzero(used)
+        position = np.full(len(proposition_ids), -1, dtype=np.int32)
+        position[used] = np.arange(len(used), dtype=np.int32)
+
+        for split in ('train', 'validation', 'test'):
+            dataset[split]['source_idx'] = position[source_codes[split_rows[split]]]
+            dataset[split]['target_idx'] = position[target_codes[split_rows[split]]]
 
-    for index, row in df.iterrows():
+    print(str(time.ctime()) + '\t\tPADDING...')
 
-        s_index = int(row['source_ID'].split('_')[-1])
-        t_index = int(row['target_ID'].split('_')[-1])
+    sys.stdout.flush()
 
-        difference = t_index - s_index
+    if deduplicate:
+        dataset['proposition_ids'] = [proposition_ids[code] for code in used]
+        dataset['propositions'] = pad_propositions([propositions[code] for code in used], max_prop_len,
+                                                   pad, dtype, ndim)
 
-        split = row['set']
+    for split in ('train', 'validation', 'test'):
 
-        # in case this is a train tuple, that the limitation on the distance is active and that the distance between
-        # the two components is greater than the distance allowed, skip this row
-        if split == "train" and distance_train_limit > 0 and abs(difference) > distance_train_limit:
+        if deduplicate or streaming:
             continue
 
-        text_ID = row['text_ID']
-        source_ID = row['source_ID']
-        target_ID = row['target_ID']
-        split = row['set']
-
-
-        if row['source_to_target']:
-            dataset[split]['links'].append([1, 0])
-        else:
-            dataset[split]['links'].append([0, 1])
-        """
-        else:
-            if split == 'train':
-                n = random.random()
-                if n < 0.2:
-                    continue
-            dataset[split]['links'].append([0, 1])
-        """
-
-        dataset[split]['sources_type'].append(categorical_prop[row['source_type']])
-        dataset[split]['targets_type'].append(categorical_prop[row['target_type']])
-
-
-        dataset[split]['relations_type'].append(categorical_link[row['relation_type']])
-
-        dataset[split]['s_id'].append(row['source_ID'])
-        dataset[split]['t_id'].append(row['target_ID'])
-
+        print(str(time.ctime()) + '\t\t\tPADDING ' + split)
 
-        if distance > 0:
-            difference_array = [0] * distance * 2
-            if difference > distance:
-                difference_array[-distance:] = [1] * distance
-            elif difference < -distance:
-                difference_array[:distance] = [1] * distance
-            elif difference > 0:
-                difference_array[-distance: distance + difference] = [1] * difference
-            elif difference < 0:
-                difference_array[distance + difference: distance] = [1] * -difference
-            dataset[split]['distance'].append(difference_array)
-            dataset[split]['difference'].append(difference)
-
-        file_path = os.path.join(embed_path, source_ID + '.npz')
-        embeddings = np.load(file_path)['arr_0']
-        embed_length = len(embeddings)
-        if embed_length > max_prop_len:
-            max_prop_len = embed_length
-        dataset[split]['source_props'].append(embeddings)
-
-        file_path = os.path.join(embed_path, target_ID + '.npz')
-        embeddings = np.load(file_path)['arr_0']
-        embed_length = len(embeddings)
-        if embed_length > max_prop_len:
-            max_prop_len = embed_length
-        dataset[split]['target_props'].append(embeddings)
+        dataset[split]['source_props'] = pad_propositions(dataset[split]['source_props'], max_prop_len,
+                                                          pad, dtype, ndim)
+        dataset[split]['target_props'] = pad_propositions(dataset[split]['target_props'], max_prop_len,
+                                                          pad, dtype, ndim)
 
-    print(str(time.ctime()) + '\t\tPADDING...')
+    return dataset, max_text_len, max_prop_len
 
-    sys.stdout.flush()
 
-    for split in ('train', 'validation', 'test'):
+def remove_shared_datasets(dataset_name=None):
+    """
+    Removes the datasets published in shared memory by load_dataset, of all the corpora if dataset_name is None.
+    The processes that are using them keep their memory maps until they end.
+    """
+    path = SHARED_DATASETS_PATH
+    if dataset_name is not None:
+        path = os.path.join(path, dataset_name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+        print(str(time.ctime()) + "\tRemoved the shared datasets in " + path)
 
-        dataset[split]['distance'] = np.array(dataset[split]['distance'], dtype=np.int8)
 
-        print(str(time.ctime()) + '\t\t\tPADDING ' + split)
+def load_embedding_matrix(dataset_name, dataset_version, embed_name="glove300", mmap=False):
+    """
+    Loads the embeddings of the vocabulary of a dataset as a matrix, whose row 0 is left empty for padding.
+    If mmap is True, the matrix is saved as .npy next to the vocabulary the first time, and then memory-mapped.
+    """
+    dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
+    vocabulary_path = os.path.join(dataset_path, 'resources', embed_name, dataset_version, 'glove.embeddings.npz')
+    if not os.path.exists(vocabulary_path):
+        vocabulary_path = os.path.join(dataset_path, 'resources', embed_name, 'glove.embeddings.npz')
+    matrix_path = vocabulary_path[:-len('.npz')] + '.matrix.npy'
 
+    if mmap and os.path.exists(matrix_path) and os.path.getmtime(matrix_path) >= os.path.getmtime(vocabulary_path):
+        return np.load(matrix_path, mmap_mode='r')
 
-        texts = dataset[split]['source_props']
-        for j in range(len(texts)):
-            text = texts[j]
-            embeddings = []
-            diff = max_prop_len - len(text)
-            for i in range(diff):
-                embeddings.append(pad)
-            for embedding in text:
-                embeddings.append(embedding)
-            texts[j] = embeddings
-        dataset[split]['source_props'] = np.array(texts, ndmin=ndim, dtype=dtype)
-
-        texts = dataset[split]['target_props']
-        for j in range(len(texts)):
-            text = texts[j]
-            embeddings = []
-            diff = max_prop_len - len(text)
-            for i in range(diff):
-                embeddings.append(pad)
-            for embedding in text:
-                embeddings.append(embedding)
-            texts[j] = embeddings
-        dataset[split]['target_props'] = np.array(texts, ndmin=ndim, dtype=dtype)
+    vocabulary_list = np.load(vocabulary_path)
+    embed_list = vocabulary_list['embeds']
 
+    matrix = np.zeros((len(embed_list) + 1, DIM), dtype=np.float32)
+    matrix[1:] = embed_list
 
-    return dataset, max_text_len, max_prop_len
+    if mmap:
+        np.save(matrix_path, matrix)
+        del matrix
+        return np.load(matrix_path, mmap_mode='r')
+    return matrix
 
 
 def perform_training(name = 'try999',
@@ -240,7 +651,37 @@ def perform_training(name = 'try999',
                      clean_previous_networks=True,
                      embed_name="glove300",
                      overwrite=False,
-                     log_time=False):
+                     log_time=False,
+                     deduplicate=False,
+                     use_cache=True,
+                     bucketing=False,
+                     streaming=False,
+                     negative_ratio=None,
+                     stratified=False,
+                     sampling_seed=0,
+                     parallel_iterations=1,
+                     threads_per_iteration=None,
+                     selected_iterations=None,
+                     epoch_callback=None,
+                     shared_dataset=False,
+                     checkpoint_improvements=None,
+                     checkpoint_minutes=10):
+    """
+    Trains and evaluates the networks of all the iterations, skipping the ones already completed.
+    :param parallel_iterations: number of iterations trained at the same time, each in its own process
+    :param threads_per_iteration: number of threads of each of those processes, by default the cores are divided among
+                                  them
+    :param selected_iterations: the indexes of the iterations to train, all by default (used by those processes)
+    :param epoch_callback: function called with true_validation after the evaluation of each epoch, with the epoch and
+                           the monitored score; the training of the iteration stops when it returns True
+    :param shared_dataset: whether the dataset is published in shared memory, or attached from there if another
+                           process has already published it (see load_dataset)
+    :param checkpoint_improvements: the best weights are kept in memory and written every checkpoint_improvements
+                                    improvements, or only at the end of the training if None
+    :param checkpoint_minutes: the best weights are also written when they have not been for checkpoint_minutes minutes
+                               (None to write them only at the end of the training, when a crash loses them)
+    :return: the scores of each trained iteration on each split and the training time of each one
+    """
 
     embedding_size = int(DIM/embedding_scale)
     res_size = int(DIM/res_scale)
@@ -253,12 +694,23 @@ def perform_training(name = 'try999',
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
 
-    paramfile = open(os.path.join(save_dir, name + "_info.txt"),'w')
+    # the processes of parallel_iterations do not overwrite the information of the whole training
+    if selected_iterations is None:
+        paramfile = open(os.path.join(save_dir, name + "_info.txt"),'w')
+
+        for parameter in sorted(parameters.keys()):
+            value = parameters[parameter]
+            paramfile.write(parameter + " = " + str(value) + "\n")
+        paramfile.close()
 
-    for parameter in sorted(parameters.keys()):
-        value = parameters[parameter]
-        paramfile.write(parameter + " = " + str(value) + "\n")
-    paramfile.close()
+    if parallel_iterations > 1 and selected_iterations is None:
+        arguments = {}
+        for parameter in inspect.signature(perform_training).parameters:
+            arguments[parameter] = parameters[parameter]
+        final_scores, train_times = train_parallel_iterations(arguments)
+        save_final_evaluation(os.path.join(save_dir, name + "_eval.txt"),
+                              dataset_info[dataset_name]["evaluation_headline_short"], final_scores, train_times)
+        return final_scores, train_times
 
     output_units = ()
     min_text = 0
@@ -287,8 +739,32 @@ def perform_training(name = 'try999',
                                                        min_prop_len=min_prop,
                                                        distance=distance_num,
                                                        distance_train_limit=distance_train_limit,
-                                                       embed_name=embed_name)
+                                                       embed_name=embed_name,
+                                                       deduplicate=deduplicate,
+                                                       use_cache=use_cache,
+                                                       streaming=streaming,
+                                                       negative_ratio=negative_ratio,
+                                                       stratified=stratified,
+                                                       sampling_seed=sampling_seed,
+                                                       shared=shared_dataset)
     print(str(time.ctime()) + "\tDATASET LOADED...")
+
+    # with deduplicate, the inputs are the rows of the propositions, which are gathered batch by batch
+    propositions = None
+    if deduplicate:
+        propositions = dataset['propositions']
+        for split in ('train', 'validation', 'test'):
+            dataset[split]['source_props'] = dataset[split]['source_idx']
+            dataset[split]['target_props'] = dataset[split]['target_idx']
+
+    # with streaming, the inputs are the rows of the propositions in the token store, which are read batch by batch
+    store = None
+    if streaming:
+        store = TokenStore(os.path.join(os.getcwd(), 'Datasets', dataset_name, 'embeddings', embed_name,
+                                        dataset_version))
+        for split in ('train', 'validation', 'test'):
+            dataset[split]['source_props'] = dataset[split]['source_rows']
+            dataset[split]['target_props'] = dataset[split]['target_rows']
     sys.stdout.flush()
 
     print(str(time.ctime()) + "\tPROCESSING DATA AND MODEL...")
@@ -299,7 +775,7 @@ def perform_training(name = 'try999',
     X_target_train = dataset[split]['target_props']
     del dataset[split]['target_props']
     Y_links_train = np.array(dataset[split]['links'])
-    Y_rtype_train = np.array(dataset[split]['relations_type'], dtype=np.float32)
+    Y_rtype_train = np.array(dataset[split]['relations_type'])
     Y_stype_train = np.array(dataset[split]['sources_type'])
     Y_ttype_train = np.array(dataset[split]['targets_type'])
 
@@ -365,21 +841,36 @@ def perform_training(name = 'try999',
     print("Length: " + str(len(X3_validation[0])))
     print(str(time.ctime()) + "\t\tCREATING MODEL...")
 
+    # with bucketing, each batch is padded to its longest proposition, so the networks receive propositions of any
+    # length; with pooling, the lengths must be multiples of its size
+    propos_length = max_prop_len
+    length_multiple = 1
+    if bucketing:
+        if temporalBN:
+            raise Exception("The temporal batch normalization requires propositions of fixed length: "
+                            "it can not be used with bucketing")
+        propos_length = None
+        if str(network) in ("7", "7N", "7n") and pooling > 0:
+            length_multiple = pooling
+
     bow = None
+    # with 'embeddings' the network receives the vectors, which are gathered batch by batch from this matrix
+    embedding_matrix = None
     if feature_type == 'bow':
-        dataset_path = os.path.join(os.getcwd(), 'Datasets', dataset_name)
-        vocabulary_path = os.path.join(dataset_path, 'resources', embed_name, dataset_version,'glove.embeddings.npz')
-        if not os.path.exists(vocabulary_path):
-            vocabulary_path = os.path.join(dataset_path, 'resources', embed_name, 'glove.embeddings.npz')
-        vocabulary_list = np.load(vocabulary_path)
-        embed_list = vocabulary_list['embeds']
-        word_list = vocabulary_list['vocab']
-
-        bow = np.zeros((len(word_list) + 1, DIM))
-        for index in range(len(word_list)):
-            bow[index + 1] = embed_list[index]
+        bow = load_embedding_matrix(dataset_name, dataset_version, embed_name)
+        print(str(time.ctime()) + "\t\t\tEMBEDDINGS LOADED...")
+    elif feature_type == 'embeddings':
+        embedding_matrix = load_embedding_matrix(dataset_name, dataset_version, embed_name, mmap=True)
         print(str(time.ctime()) + "\t\t\tEMBEDDINGS LOADED...")
 
+    train_feed = make_feed(X3_train, Y_train, batch_size, embedding_matrix, shuffle=True, propositions=propositions,
+                           bucketing=bucketing, length_multiple=length_multiple, store=store,
+                           prop_length=max_prop_len)
+    if bucketing and not streaming:
+        global_ratio, bucket_ratio = train_feed['x'].padding_ratio()
+        print(str(time.ctime()) + "\t\t\tPADDING: " + str(round(global_ratio * 100, 2)) + "% OF THE TOKENS WITH " +
+              "GLOBAL PADDING, " + str(round(bucket_ratio * 100, 2)) + "% WITH BUCKETS")
+
     realname = name
 
 
@@ -395,15 +886,20 @@ def perform_training(name = 'try999',
         os.makedirs(save_dir)
 
     # CLEAR FOLDER
-    if overwrite:
+    # (the processes of parallel_iterations must not delete the networks of the other ones)
+    if overwrite and selected_iterations is None:
         filelist = [f for f in os.listdir(save_dir) if f.endswith(".h5")]
         for f in filelist:
             os.remove(os.path.join(save_dir, f))
 
     train_times = []
 
+    iteration_indexes = selected_iterations
+    if iteration_indexes is None:
+        iteration_indexes = range(iterations)
+
     # train and test iterations
-    for i in range(iterations):
+    for i in iteration_indexes:
 
         name = realname + "_" + str(i)
         model_name = realname + '_model.json'
@@ -417,7 +913,7 @@ def perform_training(name = 'try999',
         if network == 7 or network == "7":
             model = build_net_7(bow=bow,
                                 link_as_sum=link_as_sum,
-                                propos_length=max_prop_len,
+                                propos_length=propos_length,
                                 regularizer_weight=regularizer_weight,
                                 dropout_embedder=dropout_embedder,
                                 dropout_resnet=dropout_resnet,
@@ -440,7 +936,7 @@ def perform_training(name = 'try999',
                                 temporalBN=temporalBN,)
         elif network == "7N" or network == "7n":
             model = build_not_res_net_7(bow=bow,
-                                        propos_length=max_prop_len,
+                                        propos_length=propos_length,
                                         regularizer_weight=regularizer_weight,
                                         dropout_embedder=dropout_embedder,
                                         dropout_resnet=dropout_resnet,
@@ -464,7 +960,7 @@ def perform_training(name = 'try999',
         elif network == "11" or network == 11:
             model = build_net_11(bow=bow,
                                 link_as_sum=link_as_sum,
-                                 propos_length=max_prop_len,
+                                 propos_length=propos_length,
                                  regularizer_weight=regularizer_weight,
                                 dropout_embedder=dropout_embedder,
                                 dropout_resnet=dropout_resnet,
@@ -485,19 +981,20 @@ def perform_training(name = 'try999',
 
         relations_labels = dataset_info[dataset_name]["link_as_sum"][0]
         not_a_link_labels = dataset_info[dataset_name]["link_as_sum"][1]
+        not_a_relation_label = int(np.argmax(dataset_info[dataset_name]["categorical_link"][None]))
 
         # it is necessary to save all the custom functions
-        fmeasure_0 = get_avgF1([0])
-        fmeasure_1 = get_avgF1([1])
-        fmeasure_2 = get_avgF1([2])
-        fmeasure_3 = get_avgF1([3])
-        fmeasure_4 = get_avgF1([4])
-        fmeasure_0_1_2_3 = get_avgF1([0, 1, 2, 3])
-        fmeasure_0_1_2_3_4 = get_avgF1([0, 1, 2, 3, 4])
-        fmeasure_0_2 = get_avgF1([0, 2])
-        fmeasure_0_1_2 = get_avgF1([0, 1, 2])
-        fmeasure_0_1 = get_avgF1([0, 1, 2])
-        fmeasure_0_2_4 = get_avgF1([0, 2, 4])
+        fmeasure_0 = get_avgF1([0], sparse=True)
+        fmeasure_1 = get_avgF1([1], sparse=True)
+        fmeasure_2 = get_avgF1([2], sparse=True)
+        fmeasure_3 = get_avgF1([3], sparse=True)
+        fmeasure_4 = get_avgF1([4], sparse=True)
+        fmeasure_0_1_2_3 = get_avgF1([0, 1, 2, 3], sparse=True)
+        fmeasure_0_1_2_3_4 = get_avgF1([0, 1, 2, 3, 4], sparse=True)
+        fmeasure_0_2 = get_avgF1([0, 2], sparse=True)
+        fmeasure_0_1_2 = get_avgF1([0, 1, 2], sparse=True)
+        fmeasure_0_1 = get_avgF1([0, 1, 2], sparse=True)
+        fmeasure_0_2_4 = get_avgF1([0, 2, 4], sparse=True)
 
         fmeasures = [fmeasure_0, fmeasure_1, fmeasure_2, fmeasure_3, fmeasure_4, fmeasure_0_1_2_3, fmeasure_0_1_2_3_4,
                      fmeasure_0_2, fmeasure_0_1_2, fmeasure_0_1, fmeasure_0_2_4]
@@ -547,7 +1044,7 @@ def perform_training(name = 'try999',
         for weight in loss_weights:
             loss_variables.append(K.variable(weight))
 
-        model.compile(loss='categorical_crossentropy',
+        model.compile(loss='sparse_categorical_crossentropy',
                       loss_weights=loss_weights,
                       optimizer=Adam(lr=lr_function(0),
                                      beta_1=beta_1,
@@ -568,17 +1065,17 @@ def perform_training(name = 'try999',
 
 
         # PERSISTENCE CONFIGURATION
-        complete_network_name = name + '_completemodel.{epoch:03d}.h5'
         model_name = realname + '_model.json'
         json_model = model.to_json()
         with open(os.path.join(save_dir, model_name), 'w') as outfile:
             json.dump(json_model, outfile)
-        weights_name = name + '_weights.{epoch:03d}.h5'
 
-        if not save_weights_only:
-            file_path = os.path.join(save_dir, complete_network_name)
-        else:
-            file_path = os.path.join(save_dir, weights_name)
+        # the best weights are kept in memory, and their file is listed in the checkpoints.json manifest
+        checkpoint = BestWeightsCheckpoint(save_dir, name,
+                                           save_weights_only=save_weights_only,
+                                           flush_improvements=checkpoint_improvements,
+                                           flush_minutes=checkpoint_minutes,
+                                           clean_previous=clean_previous_networks)
 
         # TRAINING CONFIGURATION
 
@@ -607,46 +1104,11 @@ def perform_training(name = 'try999',
 
             # evaluation of test values
 
-            # begin of the evaluation of the single propositions scores
-            sids = dataset['validation']['s_id']
-            tids = dataset['validation']['t_id']
-
-            s_test_scores = {}
-            t_test_scores = {}
-            s_pred_scores = {}
-            t_pred_scores = {}
-
-
-            for index in range(len(sids)):
-                sid = sids[index]
-                tid = tids[index]
-
-                if sid not in s_test_scores.keys():
-                    s_test_scores[sid] = []
-                    s_pred_scores[sid] = []
-                s_test_scores[sid].append(Y_validation[2][index])
-
-                if tid not in t_test_scores.keys():
-                    t_test_scores[tid] = []
-                    t_pred_scores[tid] = []
-                t_test_scores[tid].append(Y_validation[3][index])
-
-            Y_test_prop_real_list = []
-
-            for p_id in t_test_scores.keys():
-                Y_test_prop_real_list.append(np.concatenate([s_test_scores[p_id], t_test_scores[p_id]]))
-
-            Y_test_prop_real_list = np.array(Y_test_prop_real_list)
-
-            Y_test_prop_real = []
-            for index in range(len(Y_test_prop_real_list)):
-                Y_test_prop_real.append(np.sum(Y_test_prop_real_list[index], axis=-2))
-
-            Y_test_prop_real = np.array(Y_test_prop_real)
-            Y_test_prop_real = np.argmax(Y_test_prop_real, axis=-1)
-
-            Y_test_links_or = np.argmax(Y_validation[0], axis=-1)
-            Y_test_rel_or = np.argmax(Y_validation[1], axis=-1)
+            # the propositions, their classes and the reflexive pairs are found once for all the epochs
+            evaluator = PairEvaluator(dataset['validation']['s_id'], dataset['validation']['t_id'], Y_validation,
+                                      dataset_info[dataset_name]["link_as_sum"][0],
+                                      dataset['validation']['pruned_links'], dataset['validation']['pruned_relations'],
+                                      not_a_relation_label)
 
 
             last_epoch = 0
@@ -656,6 +1118,10 @@ def perform_training(name = 'try999',
             timer = TimingCallback()
 
 
+            validation_feed = make_feed(X3_validation, None, batch_size, embedding_matrix, propositions=propositions,
+                                        bucketing=bucketing, length_multiple=length_multiple, store=store,
+                                        prop_length=max_prop_len)
+
             for epoch in range(1, epochs+1):
                 print("\nEPOCH: " + str(epoch))
                 lr_annealing_fn = create_lr_annealing_function(initial_lr=lr_alfa, k=lr_kappa, fixed_epoch=epoch)
@@ -665,10 +1131,7 @@ def perform_training(name = 'try999',
                 if log_time:
                     callbacks.append(timer)
 
-                model.fit(x=X3_train,
-                          # y=Y_links_train,
-                          y=Y_train,
-                          batch_size=batch_size,
+                model.fit(**train_feed,
                           epochs=epoch+1,
                           verbose=2,
                           callbacks=callbacks,
@@ -676,69 +1139,20 @@ def perform_training(name = 'try999',
                           )
 
                 # evaluation
-                Y_pred = model.predict(X3_validation)
-
-                Y_test_links = Y_test_links_or.copy()
-                Y_test_rel = Y_test_rel_or.copy()
+                Y_pred = predict_pairs(model, validation_feed)
 
-                for index in range(len(sids)):
-                    sid = sids[index]
-                    tid = tids[index]
+                scores = evaluator.evaluate(Y_pred)
 
-                    s_pred_scores[sid].append(Y_pred[2][index])
-                    t_pred_scores[tid].append(Y_pred[3][index])
+                score_f1_link = scores['link']
+                score_f1_rel = scores['relations']
+                score_f1_rel_AVGM = scores['relations_AVG']
+                score_prop = scores['props']
+                score_prop_AVG = scores['props_AVG']
+                score_AVG_LP = scores['AVG_LP']
+                score_AVG_all = scores['AVG_all']
 
-                Y_pred_prop_real_list = []
-
-                for p_id in t_test_scores.keys():
-                    Y_pred_prop_real_list.append(np.concatenate([s_pred_scores[p_id], t_pred_scores[p_id]]))
-
-                Y_pred_prop_real_list = np.array(Y_pred_prop_real_list)
-
-                Y_pred_prop_real = []
-                for index in range(len(Y_test_prop_real_list)):
-                    Y_pred_prop_real.append(np.sum(Y_pred_prop_real_list[index], axis=-2))
-
-                Y_pred_prop_real = np.array(Y_pred_prop_real)
-                Y_pred_prop_real = np.argmax(Y_pred_prop_real, axis=-1)
-
-                Y_pred_links = np.argmax(Y_pred[0], axis=-1)
-                Y_pred_rel = np.argmax(Y_pred[1], axis=-1)
-
-
-                # Remove all the symmetric links
-                reflexive = []
-                for index in range(len(sids)):
-                    sid = sids[index]
-                    tid = tids[index]
-                    if sid == tid:
-                        reflexive.append(index)
-                if len(reflexive) > 0:
-                    Y_test_rel = np.delete(Y_test_rel, reflexive, axis=0)
-                    Y_pred_rel = np.delete(Y_pred_rel, reflexive, axis=0)
-                    Y_test_links = np.delete(Y_test_links, reflexive, axis=0)
-                    Y_pred_links = np.delete(Y_pred_links, reflexive, axis=0)
-                    if len(Y_test_rel) != len(Y_pred_rel):
-                        print(len(Y_test_rel))
-                        print(len(Y_pred_rel))
-                    if len(Y_test_links) != len(Y_pred_links):
-                        print(len(Y_test_links))
-                        print(len(Y_pred_links))
-
-                positive_link_labels = dataset_info[dataset_name]["link_as_sum"][0]
-                negative_link_labels = dataset_info[dataset_name]["link_as_sum"][1]
-
-                score_f1_link = f1_score(Y_test_links, Y_pred_links, average=None, labels=[0])
-                score_f1_rel = f1_score(Y_test_rel, Y_pred_rel, average=None, labels=positive_link_labels)
-                score_f1_rel_AVGM = f1_score(Y_test_rel, Y_pred_rel, average='macro', labels=positive_link_labels)
-                score_prop = f1_score(Y_test_prop_real, Y_pred_prop_real, average=None)
-                score_prop_AVG = f1_score(Y_test_prop_real, Y_pred_prop_real, average='macro')
-
-                score_AVG_LP = np.mean([score_f1_link, score_prop_AVG])
-                score_AVG_all = np.mean([score_f1_link, score_prop_AVG, score_f1_rel_AVGM])
-
-                string = str(epoch) + "\t" + str(round(score_AVG_all[0], 5)) + "\t" + str(round(score_AVG_LP[0], 5))
-                string += "\t" + str(round(score_f1_link[0], 5)) + "\t" + str(round(score_f1_rel_AVGM, 5))
+                string = str(epoch) + "\t" + str(round(score_AVG_all, 5)) + "\t" + str(round(score_AVG_LP, 5))
+                string += "\t" + str(round(score_f1_link, 5)) + "\t" + str(round(score_f1_rel_AVGM, 5))
                 for score in score_f1_rel:
                     string += "\t" + str(round(score, 5))
                 string += "\t" + str(round(score_prop_AVG, 5))
@@ -752,14 +1166,11 @@ def perform_training(name = 'try999',
                 elif monitor == 'AVG_LP':
                     monitor_score = score_AVG_LP
 
+                checkpoint.update(model, epoch, monitor_score)
+
                 if monitor_score > best_score:
                     best_score = monitor_score
                     string += "\t!"
-
-                    file_path = os.path.join(save_dir, name + '_weights.%03d.h5' % epoch)
-                    # save
-                    print("Saving to " + file_path)
-                    model.save_weights(file_path)
                     waited = 0
                 else:
                     waited += 1
@@ -772,6 +1183,12 @@ def perform_training(name = 'try999',
                 val_file.flush()
                 last_epoch = epoch
 
+                if epoch_callback is not None and epoch_callback(epoch, monitor_score):
+                    print("Stopped by the epoch callback")
+                    break
+
+            checkpoint.flush(model)
+
             endtime = time.time()
 
             val_file.close()
@@ -779,15 +1196,8 @@ def perform_training(name = 'try999',
 
         else:
 
-            # save the networks each epoch
-            checkpoint = ModelCheckpoint(filepath=file_path,
-                                         # monitor='val_loss',
-                                         monitor=monitor,
-                                         verbose=1,
-                                         save_best_only=True,
-                                         save_weights_only=save_weights_only,
-                                         mode='max'
-                                         )
+            # keep the best networks
+            checkpoint.monitor = monitor
 
             # modify the lr each epoch
             lr_scheduler = LearningRateScheduler(lr_function)
@@ -810,14 +1220,22 @@ def perform_training(name = 'try999',
 
             starttime = time.time()
 
-            history = model.fit(x=X3_train,
-                                # y=Y_links_train,
-                                y=Y_train,
-                                batch_size=batch_size,
+            validation_steps = None
+            if embedding_matrix is None and propositions is None and not bucketing and not streaming:
+                validation_data = (X3_validation, Y_validation)
+            else:
+                validation_feed = make_feed(X3_validation, Y_validation, batch_size, embedding_matrix,
+                                            propositions=propositions, bucketing=bucketing,
+                                            length_multiple=length_multiple, store=store, prop_length=max_prop_len)
+                validation_data = validation_feed['x']
+                validation_steps = validation_feed.get('steps_per_epoch')
+
+            history = model.fit(**train_feed,
                                 epochs=epochs,
                                 verbose=2,
                                 # validation_data=(X_validation, Y_links_validation),
-                                validation_data=(X3_validation, Y_validation),
+                                validation_data=validation_data,
+                                validation_steps=validation_steps,
                                 callbacks=callbacks
                                 )
 
@@ -836,46 +1254,20 @@ def perform_training(name = 'try999',
 
         print(str(time.ctime()) + "\tEVALUATING MODEL")
 
-        last_path = ""
+        # load the best model, listed in the manifest
+        entry = read_checkpoint(save_dir, name)
+        if entry is None:
+            raise Exception("No network has been saved for " + name)
+        last_path = os.path.join(save_dir, entry['path'])
+        last_epoch = entry['epoch']
+        print("\n\n\tBEST EPOCH: " + str(last_epoch) + "\n")
 
-        # load the model (the last one that was saved)
-        if save_weights_only:
+        if entry['weights_only']:
             model = model_from_json(json_model, custom_objects=custom_objects)
-
-            for epoch in range(last_epoch, 0, -1):
-                netpath = os.path.join(save_dir, name + '_weights.%03d.h5' % epoch)
-                if os.path.exists(netpath):
-                    last_path = netpath
-                    last_epoch = epoch
-                    break
             model.load_weights(last_path)
-
-            print("\n\n\tCLEANING NETS BEFORE EPOCH: " + str(last_epoch) + "\n")
-            if clean_previous_networks:
-                for epoch in range(last_epoch-1, 0, -1):
-                    netpath = os.path.join(save_dir, name + '_weights.%03d.h5' % epoch)
-                    if os.path.exists(netpath):
-                        os.remove(netpath)
-
         else:
-            for epoch in range(last_epoch, 0, -1):
-                netpath = os.path.join(save_dir, name + '_completemodel.%03d.h5' % epoch)
-                if os.path.exists(netpath):
-                    last_path = netpath
-                    last_epoch = epoch
-                    break
-
             model = load_model(last_path, custom_objects=custom_objects)
 
-
-            print("\n\n\tCLEANING NETS BEFORE EPOCH: " + str(last_epoch) + "\n")
-
-            if clean_previous_networks:
-                for epoch in range(last_epoch-1, 0, -1):
-                    netpath = os.path.join(save_dir, name + '_completemodel.%03d.h5' % epoch)
-                    if os.path.exists(netpath):
-                        os.remove(netpath)
-
         print("\n\n\tLOADED NETWORK: " + last_path + "\n")
 
 
@@ -905,7 +1297,10 @@ def perform_training(name = 'try999',
             # 2 dim
             # ax0 = samples
             # ax1 = classes
-            Y_pred = model.predict(X[split])
+            Y_pred = predict_pairs(model, make_feed(X[split], None, batch_size, embedding_matrix,
+                                                    propositions=propositions, bucketing=bucketing,
+                                                    length_multiple=length_multiple, store=store,
+                                                    prop_length=max_prop_len))
 
             # begin of the evaluation of the single propositions scores
             sids = dataset[split]['s_id']
@@ -937,36 +1332,40 @@ def perform_training(name = 'try999',
                 t_test_scores[tid].append(Y[split][3][index])
 
             Y_pred_prop_real_list = []
-            Y_test_prop_real_list = []
+            Y_test_prop_real = []
 
             for p_id in t_pred_scores.keys():
                 Y_pred_prop_real_list.append(np.concatenate([s_pred_scores[p_id], t_pred_scores[p_id]]))
-                Y_test_prop_real_list.append(np.concatenate([s_test_scores[p_id], t_test_scores[p_id]]))
+                # the class of each proposition is the most frequent among its pairs (they all have the same one)
+                labels = np.concatenate([s_test_scores[p_id], t_test_scores[p_id]])
+                Y_test_prop_real.append(np.argmax(np.bincount(labels)))
 
             # 3 dim
             # ax0: ids
             # ax1: samples
             # ax2: classes
             Y_pred_prop_real_list = np.array(Y_pred_prop_real_list)
-            Y_test_prop_real_list = np.array(Y_test_prop_real_list)
 
             Y_pred_prop_real = []
-            Y_test_prop_real = []
             for index in range(len(Y_pred_prop_real_list)):
                 Y_pred_prop_real.append(np.sum(Y_pred_prop_real_list[index], axis=-2))
-                Y_test_prop_real.append(np.sum(Y_test_prop_real_list[index], axis=-2))
 
             Y_pred_prop_real = np.array(Y_pred_prop_real)
             Y_test_prop_real = np.array(Y_test_prop_real)
             Y_pred_prop_real = np.argmax(Y_pred_prop_real, axis=-1)
-            Y_test_prop_real = np.argmax(Y_test_prop_real, axis=-1)
             # end of the evaluation of the single propositions scores
 
             Y_pred_links = np.argmax(Y_pred[0], axis=-1)
-            Y_test_links = np.argmax(Y[split][0], axis=-1)
+            Y_test_links = np.asarray(Y[split][0])
 
             Y_pred_rel = np.argmax(Y_pred[1], axis=-1)
-            Y_test_rel = np.argmax(Y[split][1], axis=-1)
+            Y_test_rel = np.asarray(Y[split][1])
+
+            # the pairs dropped by the candidate pruning are predicted as non-links
+            Y_test_links, Y_pred_links, _ = add_pruned_pairs(Y_test_links, Y_pred_links,
+                                                             dataset[split]['pruned_links'], 1)
+            Y_test_rel, Y_pred_rel, _ = add_pruned_pairs(Y_test_rel, Y_pred_rel, dataset[split]['pruned_relations'],
+                                                         not_a_relation_label)
 
             # predictions computed! Computing measures!
 
@@ -1036,10 +1435,22 @@ def perform_training(name = 'try999',
 
         # END OF A ITERATION
 
+    # the final evaluation of parallel_iterations is written by the main process
+    if selected_iterations is None:
+        save_final_evaluation(os.path.join(os.getcwd(), 'network_models', dataset_name, dataset_version,
+                                           realname + "_eval.txt"), evaluation_headline, final_scores, train_times)
+
+    return final_scores, train_times
+
+
+def save_final_evaluation(eval_path, evaluation_headline, final_scores, train_times):
+    """
+    Writes the average scores of the iterations on each split and their average training time
+    :param final_scores: dictionary from each split to the list of the scores of each iteration
+    :param train_times: list of the training time of each iteration
+    """
     train_time = np.average(train_times)
-    # FINAL EVALUATION
-    testfile = open(os.path.join(os.getcwd(), 'network_models', dataset_name, dataset_version,
-                                 realname + "_eval.txt"), 'w')
+    testfile = open(eval_path, 'w')
 
     testfile.write(evaluation_headline)
     for split in ['test', 'validation', 'train']:
@@ -1058,6 +1469,117 @@ def perform_training(name = 'try999',
     testfile.close()
 
 
+def dataset_arguments(arguments):
+    """
+    The arguments of load_dataset used by perform_training with the given arguments
+    """
+    dataset_name = arguments['dataset_name']
+    return {'dataset_name': dataset_name,
+            'dataset_version': arguments['dataset_version'],
+            'dataset_split': arguments['dataset_split'],
+            'feature_type': arguments['feature_type'],
+            'min_text_len': dataset_info[dataset_name]["min_text"],
+            'min_prop_len': dataset_info[dataset_name]["min_prop"],
+            'distance': arguments['distance'],
+            'distance_train_limit': arguments['distance_train_limit'],
+            'embed_name': arguments['embed_name'],
+            'deduplicate': arguments['deduplicate'],
+            'use_cache': True,
+            'streaming': arguments['streaming'],
+            'negative_ratio': arguments['negative_ratio'],
+            'stratified': arguments['stratified'],
+            'sampling_seed': arguments['sampling_seed'],
+            'shared': arguments['shared_dataset']}
+
+
+def prepare_dataset_cache(arguments):
+    """
+    Creates the dataset cache used by perform_training with the given arguments, and publishes it in shared memory if
+    shared_dataset is True, if they do not exist yet, so that the processes started afterwards memory-map the same
+    files instead of creating them at the same time
+    """
+    print(str(time.ctime()) + "\tCREATING THE DATASET CACHE...")
+    load_dataset(**dataset_arguments(arguments))
+
+
+def init_training_worker(threads):
+    """
+    Initializes a process of parallel_iterations, limiting the threads used by TensorFlow
+    """
+    worker_config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                   inter_op_parallelism_threads=min(threads, 2))
+    worker_config.gpu_options.per_process_gpu_memory_fraction = config.gpu_options.per_process_gpu_memory_fraction
+    worker_config.gpu_options.allow_growth = True
+    K.set_session(tf.Session(config=worker_config))
+
+
+def train_iteration(arguments):
+    return perform_training(**arguments)
+
+
+def train_parallel_iterations(arguments):
+    """
+    Trains the iterations of perform_training that have not been completed yet, each in its own process.
+    The dataset cache is created before starting them, so that they all memory-map the same files.
+    :param arguments: the arguments of perform_training
+    :return: the scores of each trained iteration on each split and the training time of each one
+    """
+    name = arguments['name']
+    save_dir = os.path.join(os.getcwd(), 'network_models', arguments['dataset_name'], arguments['dataset_version'],
+                            name)
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+
+    if arguments['overwrite']:
+        filelist = [f for f in os.listdir(save_dir) if f.endswith(".h5")]
+        for f in filelist:
+            os.remove(os.path.join(save_dir, f))
+
+    # if the training of an iteration was already completed, skip it
+    pending = []
+    for i in range(arguments['iterations']):
+        log_path = os.path.join(save_dir, name + "_" + str(i) + '_training.log')
+        if arguments['overwrite'] or not os.path.isfile(log_path):
+            pending.append(i)
+
+    final_scores = {'train': [], 'test': [], 'validation': []}
+    train_times = []
+    if len(pending) == 0:
+        return final_scores, train_times
+
+    if arguments['use_cache'] or arguments['shared_dataset']:
+        prepare_dataset_cache(arguments)
+
+    processes = min(arguments['parallel_iterations'], len(pending))
+    threads = arguments['threads_per_iteration']
+    if threads is None:
+        threads = max(1, multiprocessing.cpu_count() // processes)
+
+    tasks = []
+    for i in pending:
+        task = dict(arguments)
+        task['selected_iterations'] = [i]
+        tasks.append(task)
+
+    print(str(time.ctime()) + "\tTRAINING " + str(len(pending)) + " ITERATIONS IN " + str(processes) +
+          " PROCESSES OF " + str(threads) + " THREADS")
+
+    # TensorFlow can not be used after a fork, so each iteration is trained in a new process
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(processes, initializer=init_training_worker, initargs=(threads,), maxtasksperchild=1)
+    results = pool.map(train_iteration, tasks, chunksize=1)
+    pool.close()
+    pool.join()
+
+    for worker_scores, worker_times in results:
+        for split in final_scores.keys():
+            final_scores[split].extend(worker_scores[split])
+        train_times.extend(worker_times)
+
+    return final_scores, train_times
+
+
+
 
 
 
@@ -1469,9 +1991,15 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--corpus',
                         choices=["rct", "drinv", "cdcp", "echr", "ukp", "scidtb"],
                         help="corpus", default="cdcp")
+    parser.add_argument('-r', '--remove_shared', help="remove the datasets published in shared memory and exit",
+                        action="store_true")
 
     args = parser.parse_args()
 
+    if args.remove_shared:
+        remove_shared_datasets()
+        sys.exit(0)
+
     corpus = args.corpus
 
     if corpus.lower() == "rct":
@@ -10,15 +10,24 @@ Bunch of stuff that should make the training do what it is supposed to do
 
 
 import os
+import json
 import pandas
 import numpy as np
 import sys
 import time
+import tensorflow as tf
 
-from keras.callbacks import Callback
+from tensorflow.keras.callbacks import Callback
 from keras import backend as K
+from tensorflow.keras.utils import Sequence
 from sklearn.metrics import f1_score
 
+# the checkpoints manifest is locked only where it is possible
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 class TimingCallback(Callback):
     """
     From https://github.com/keras-team/keras/issues/5105
@@ -99,6 +108,159 @@ class RealValidationCallback(Callback):
         self.log.close()
 
 
+CHECKPOINTS_FILE = 'checkpoints.json'
+
+
+def update_checkpoints(save_dir, name, entry):
+    """
+    Writes the entry of a network in the checkpoints.json manifest of a folder, or removes it if entry is None.
+    The manifest is locked because the iterations trained in parallel share it.
+    """
+    manifest_path = os.path.join(save_dir, CHECKPOINTS_FILE)
+    with open(manifest_path + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+        if entry is None:
+            manifest.pop(name, None)
+        else:
+            manifest[name] = entry
+        temporary_path = manifest_path + '.tmp' + str(os.getpid())
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(temporary_path, manifest_path)
+
+
+def read_checkpoint(save_dir, name):
+    """
+    The entry of a network in the checkpoints.json manifest of a folder, None if it is not there
+    :return: dictionary with the best epoch ('epoch'), its score ('score'), the name of the file in the folder ('path')
+             and whether it contains only the weights ('weights_only')
+    """
+    manifest_path = os.path.join(save_dir, CHECKPOINTS_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    return manifest.get(name)
+
+
+class BestWeightsCheckpoint(Callback):
+    """
+    Keeps the weights of the best epoch in memory, instead of saving a file at each improvement.
+    They are written every flush_improvements improvements, at the first epoch after flush_minutes minutes from the
+    last writing, and at the end of the training, as name_weights.<epoch>.h5 (or name_completemodel.<epoch>.h5 with
+    the complete model), and the best epoch, its score and the file are written in the checkpoints.json manifest of
+    the folder.
+    It can be used as a callback of fit, with the score of monitor in the logs, or by calling update and flush.
+    """
+
+    def __init__(self, save_dir, name, monitor=None, save_weights_only=True, flush_improvements=None,
+                 flush_minutes=10, clean_previous=True):
+        """
+        :param save_dir: the folder of the files and of the manifest
+        :param name: the name of the network
+        :param monitor: the score in the logs of fit, higher is better
+        :param save_weights_only: whether the files contain only the weights or the complete model
+        :param flush_improvements: number of improvements after which the best weights are written, None for never
+        :param flush_minutes: minutes after which the best weights are written at the next epoch, None for never (only
+                              at the end of the training, so a crash loses them)
+        :param clean_previous: whether the file of the previous best epoch is deleted when a new one is written
+        """
+        super(BestWeightsCheckpoint, self).__init__()
+        self.save_dir = save_dir
+        self.name = name
+        self.monitor = monitor
+        self.save_weights_only = save_weights_only
+        self.flush_improvements = flush_improvements
+        self.flush_minutes = flush_minutes
+        self.clean_previous = clean_previous
+
+        self.best_score = None
+        self.best_epoch = 0
+        self.best_weights = None
+        self.unsaved = 0
+        self.saved_epoch = 0
+        self.saved_path = None
+        self.saved_time = time.time()
+
+        # the entry of a previous training of the network would point to its weights until the first writing
+        update_checkpoints(save_dir, name, None)
+
+    def update(self, model, epoch, score):
+        """
+        Keeps the weights of the model if the score of the epoch is the best one
+        :return: whether the score is the best one
+        """
+        if self.best_score is not None and not score > self.best_score:
+            if self.unsaved > 0 and self.flush_minutes is not None and \
+                    time.time() - self.saved_time > self.flush_minutes * 60:
+                self.flush(model)
+            return False
+
+        self.best_score = float(score)
+        self.best_epoch = epoch
+        self.best_weights = model.get_weights()
+        self.unsaved += 1
+
+        if self.flush_improvements is not None and self.unsaved >= self.flush_improvements:
+            self.flush(model)
+        elif self.flush_minutes is not None and time.time() - self.saved_time > self.flush_minutes * 60:
+            self.flush(model)
+        return True
+
+    def flush(self, model):
+        """
+        Writes the best weights, if they have not been written yet, and the manifest
+        """
+        self.saved_time = time.time()
+        if self.best_weights is None or self.saved_epoch == self.best_epoch:
+            return
+
+        if self.save_weights_only:
+            file_name = self.name + '_weights.%03d.h5' % self.best_epoch
+        else:
+            file_name = self.name + '_completemodel.%03d.h5' % self.best_epoch
+        file_path = os.path.join(self.save_dir, file_name)
+        print("Saving epoch " + str(self.best_epoch) + " to " + file_path)
+
+        # the model keeps the weights of the current epoch
+        current_weights = model.get_weights()
+        model.set_weights(self.best_weights)
+        if self.save_weights_only:
+            model.save_weights(file_path)
+        else:
+            model.save(file_path)
+        model.set_weights(current_weights)
+
+        update_checkpoints(self.save_dir, self.name, {'epoch': self.best_epoch,
+                                                      'score': self.best_score,
+                                                      'path': file_name,
+                                                      'weights_only': self.save_weights_only})
+
+        if self.clean_previous and self.saved_path is not None and self.saved_path != file_path and \
+                os.path.exists(self.saved_path):
+            os.remove(self.saved_path)
+        self.saved_path = file_path
+        self.saved_epoch = self.best_epoch
+        self.unsaved = 0
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        score = logs.get(self.monitor)
+        if score is None:
+            print("The score " + str(self.monitor) + " is not available, the weights are not kept")
+            return
+        # the files of fit are numbered from 1
+        self.update(self.model, epoch + 1, score)
+
+    def on_train_end(self, logs=None):
+        self.flush(self.model)
+
+
 def create_lr_annealing_function(initial_lr=0.001, k=0.001, fixed_epoch=-1):
 
     def lr_annealing(epoch, lr=0):
@@ -119,6 +281,473 @@ def create_lr_annealing_function(initial_lr=0.001, k=0.001, fixed_epoch=-1):
     return lr_annealing
 
 
+class PairSequence(Sequence):
+    """
+    Batches of the pairs of propositions, in which the propositions are stored as token ids.
+    The embeddings of the tokens are gathered from the embedding matrix only when a batch is requested, so the
+    (pairs, propositions length, DIM) tensors are never created in memory.
+    If the propositions are deduplicated, the inputs contain the rows of the propositions matrix, and the propositions
+    of each batch are gathered from it in the same way.
+    """
+    def __init__(self, inputs, outputs=None, batch_size=200, embedding_matrix=None, gather=(0, 1), shuffle=False,
+                 propositions=None):
+        """
+        :param inputs: list of input arrays, all with the pairs as first dimension
+        :param outputs: list of output arrays, or None if the sequence is used for predictions
+        :param batch_size: number of pairs in each batch
+        :param embedding_matrix: matrix of the embeddings, whose row 0 is the padding (may be memory-mapped)
+        :param gather: positions of the inputs that contain token ids (or rows of the propositions)
+        :param shuffle: whether the pairs are shuffled at the end of each epoch
+        :param propositions: matrix of the padded propositions, if the inputs contain their rows
+        """
+        self.inputs = inputs
+        self.outputs = outputs
+        self.batch_size = batch_size
+        self.embedding_matrix = embedding_matrix
+        self.propositions = propositions
+        self.gather = gather
+        self.shuffle = shuffle
+        self.order = np.arange(len(inputs[0]))
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+    def __len__(self):
+        return int(np.ceil(len(self.order) / float(self.batch_size)))
+
+    def __getitem__(self, index):
+        batch = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+
+        x = []
+        for position in range(len(self.inputs)):
+            values = self.inputs[position][batch]
+            if position in self.gather:
+                if self.propositions is not None:
+                    values = self.propositions[values]
+                if self.embedding_matrix is not None:
+                    values = np.asarray(self.embedding_matrix[values], dtype=np.float32)
+            x.append(values)
+
+        if self.outputs is None:
+            return x
+
+        y = []
+        for values in self.outputs:
+            y.append(values[batch])
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+
+class BucketSequence(PairSequence):
+    """
+    Batches of pairs of propositions with similar lengths, each one padded only to its own maximum length.
+    The pairs are sorted by the length of their longest proposition (in random order among the pairs with the same
+    length, if shuffle is True) and cut in batches, whose order is shuffled at each epoch.
+    The propositions are expected to be padded on the left with token id 0, as done by load_dataset, so the batches
+    are obtained by removing the first columns. The network must accept propositions of any length.
+    The predictions are returned by keras in the order of the batches: restore_order puts them back in the order of
+    the pairs.
+    """
+    def __init__(self, inputs, outputs=None, batch_size=200, embedding_matrix=None, gather=(0, 1), shuffle=False,
+                 propositions=None, length_multiple=1):
+        """
+        :param length_multiple: the length of each batch is rounded up to a multiple of this value (e.g. the size of
+                                the pooling applied on the propositions)
+        """
+        PairSequence.__init__(self, inputs, outputs, batch_size, embedding_matrix, gather, False, propositions)
+        self.shuffle = shuffle
+        self.length_multiple = length_multiple
+
+        # length of the longest proposition of each pair
+        if propositions is not None:
+            rows_lengths = np.count_nonzero(propositions, axis=1)
+        self.lengths = np.zeros(len(inputs[0]), dtype=np.int64)
+        for position in gather:
+            if propositions is not None:
+                lengths = rows_lengths[inputs[position]]
+            else:
+                lengths = np.count_nonzero(inputs[position], axis=1)
+            self.lengths = np.maximum(self.lengths, lengths)
+        if propositions is not None:
+            self.max_length = np.shape(propositions)[1]
+        else:
+            self.max_length = np.shape(inputs[gather[0]])[1]
+
+        self.make_batches()
+
+    def make_batches(self):
+        order = np.arange(len(self.lengths))
+        if self.shuffle:
+            np.random.shuffle(order)
+        self.order = order[np.argsort(self.lengths[order], kind='stable')]
+
+        self.batches = []
+        self.batch_lengths = []
+        for start in range(0, len(self.order), self.batch_size):
+            batch = self.order[start:start + self.batch_size]
+            length = max(int(np.max(self.lengths[batch])), 1)
+            length = int(np.ceil(length / float(self.length_multiple)) * self.length_multiple)
+            self.batches.append(batch)
+            self.batch_lengths.append(min(length, self.max_length))
+
+        self.batch_order = np.arange(len(self.batches))
+        if self.shuffle:
+            np.random.shuffle(self.batch_order)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        batch_index = self.batch_order[index]
+        batch = self.batches[batch_index]
+        length = self.batch_lengths[batch_index]
+
+        x = []
+        for position in range(len(self.inputs)):
+            values = self.inputs[position][batch]
+            if position in self.gather:
+                if self.propositions is not None:
+                    values = self.propositions[values]
+                values = values[:, -length:]
+                if self.embedding_matrix is not None:
+                    values = np.asarray(self.embedding_matrix[values], dtype=np.float32)
+            x.append(values)
+
+        if self.outputs is None:
+            return x
+
+        y = []
+        for values in self.outputs:
+            y.append(values[batch])
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.make_batches()
+
+    def padding_ratio(self):
+        """
+        Returns the fraction of the token positions that are padding, with the padding to the maximum length of all
+        the propositions and with the padding of the batches
+        """
+        tokens = 0
+        for position in self.gather:
+            if self.propositions is not None:
+                tokens += np.sum(np.count_nonzero(self.propositions, axis=1)[self.inputs[position]])
+            else:
+                tokens += np.count_nonzero(self.inputs[position])
+        global_positions = len(self.gather) * len(self.order) * self.max_length
+        bucket_positions = 0
+        for batch_index in range(len(self.batches)):
+            bucket_positions += len(self.gather) * len(self.batches[batch_index]) * self.batch_lengths[batch_index]
+        if global_positions == 0:
+            return 0.0, 0.0
+        return 1 - tokens / float(global_positions), 1 - tokens / float(bucket_positions)
+
+    def restore_order(self, predictions):
+        """
+        Puts the predictions of the sequence, in the order of the batches, back in the order of the pairs
+        """
+        rows = np.concatenate([self.batches[batch_index] for batch_index in self.batch_order])
+        single = not isinstance(predictions, (list, tuple))
+        if single:
+            predictions = [predictions]
+        restored = []
+        for values in predictions:
+            values = np.asarray(values)
+            ordered = np.empty_like(values)
+            ordered[rows] = values
+            restored.append(ordered)
+        if single:
+            return restored[0]
+        return restored
+
+
+# number of pairs among which the streamed pairs are shuffled
+STREAM_SHUFFLE_BUFFER = 10000
+
+
+def make_stream(inputs, store, outputs=None, batch_size=200, prop_length=None, embedding_matrix=None, gather=(0, 1),
+                shuffle=False, shuffle_buffer=STREAM_SHUFFLE_BUFFER, length_multiple=1):
+    """
+    Streaming input pipeline, in which the propositions are read from the (memory-mapped) token store only when their
+    batch is needed. The indexes of the pairs are shuffled in a bounded buffer and batched, then the batches are read,
+    padded and, with the embedding matrix, converted in vectors by a parallel map, and prefetched.
+    The dataset is repeated forever if the outputs are given (for model.fit), otherwise it is read once, in order.
+
+    :param inputs: list of input arrays, all with the pairs as first dimension
+    :param store: packed TokenStore of the propositions
+    :param outputs: list of output arrays, or None if the stream is used for predictions
+    :param batch_size: number of pairs in each batch
+    :param prop_length: length to which the propositions are padded (on the left), None to pad each batch to its
+                        longest proposition
+    :param embedding_matrix: matrix of the embeddings, whose row 0 is the padding, None to feed the token ids
+    :param gather: positions of the inputs that contain the rows of the propositions in the store
+    :param shuffle: whether the pairs are shuffled
+    :param shuffle_buffer: number of pairs in the shuffling buffer
+    :param length_multiple: with prop_length None, the length of each batch is rounded up to a multiple of this value
+    :return: the tf.data.Dataset and the number of batches in each epoch
+    """
+    if outputs is None:
+        outputs = []
+    tokens = store.tokens
+    offsets = store.offsets
+    pairs = len(inputs[0])
+    steps = int(np.ceil(pairs / float(batch_size)))
+
+    # the class ids are streamed as they are (int8 for the labels of load_dataset), the other outputs as float32
+    output_dtypes = []
+    for values in outputs:
+        if np.issubdtype(np.asarray(values[:0]).dtype, np.integer):
+            output_dtypes.append(np.asarray(values[:0]).dtype)
+        else:
+            output_dtypes.append(np.dtype(np.float32))
+
+    def read_batch(indexes):
+        arrays = []
+        for position in range(len(inputs)):
+            values = inputs[position][indexes]
+            if position not in gather:
+                arrays.append(np.asarray(values, dtype=np.float32))
+                continue
+
+            starts = offsets[values]
+            lengths = offsets[values + 1] - starts
+            length = prop_length
+            if length is None:
+                length = max(int(np.max(lengths)), 1)
+                length = int(np.ceil(length / float(length_multiple)) * length_multiple)
+            padded = np.zeros((len(values), length), dtype=np.int32)
+            for n in range(len(values)):
+                if lengths[n] > 0:
+                    padded[n, length - lengths[n]:] = tokens[starts[n]:starts[n] + lengths[n]]
+            if embedding_matrix is not None:
+                padded = np.asarray(embedding_matrix[padded], dtype=np.float32)
+            arrays.append(padded)
+        for position in range(len(outputs)):
+            arrays.append(np.asarray(outputs[position][indexes], dtype=output_dtypes[position]))
+        return arrays
+
+    types = []
+    shapes = []
+    for position in range(len(inputs)):
+        if position in gather:
+            if embedding_matrix is None:
+                types.append(tf.int32)
+                shapes.append((None, prop_length))
+            else:
+                types.append(tf.float32)
+                shapes.append((None, prop_length, np.shape(embedding_matrix)[1]))
+        else:
+            types.append(tf.float32)
+            shapes.append((None,) + np.shape(inputs[position])[1:])
+    for position in range(len(outputs)):
+        types.append(tf.as_dtype(output_dtypes[position]))
+        shapes.append((None,) + np.shape(outputs[position])[1:])
+
+    def read_batch_op(indexes):
+        arrays = tf.numpy_function(read_batch, [indexes], types)
+        for n in range(len(arrays)):
+            arrays[n].set_shape(shapes[n])
+        x = tuple(arrays[:len(inputs)])
+        if len(outputs) == 0:
+            return x
+        return x, tuple(arrays[len(inputs):])
+
+    stream = tf.data.Dataset.range(pairs)
+    if shuffle:
+        stream = stream.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    if len(outputs) > 0:
+        stream = stream.repeat()
+    stream = stream.batch(batch_size)
+    stream = stream.map(read_batch_op, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    stream = stream.prefetch(tf.data.experimental.AUTOTUNE)
+    return stream, steps
+
+
+def make_feed(inputs, outputs=None, batch_size=None, embedding_matrix=None, shuffle=False, propositions=None,
+              bucketing=False, length_multiple=1, store=None, prop_length=None):
+    """
+    Arguments for model.fit or model.predict.
+    If the token store is given, the data are streamed from it by make_stream. If bucketing is True, the data are fed
+    through a BucketSequence. Otherwise, if the embedding matrix or the deduplicated propositions are given, the data
+    are fed through a PairSequence, and in the other cases the arrays are fed directly.
+    """
+    if batch_size is None and (bucketing or embedding_matrix is not None or propositions is not None or
+                               store is not None):
+        batch_size = 32
+
+    if store is not None:
+        if bucketing:
+            prop_length = None
+        stream, steps = make_stream(inputs, store, outputs, batch_size, prop_length, embedding_matrix,
+                                    shuffle=shuffle, length_multiple=length_multiple)
+        if outputs is None:
+            return {'x': stream, 'steps': steps}
+        return {'x': stream, 'steps_per_epoch': steps}
+
+    if bucketing:
+        return {'x': BucketSequence(inputs, outputs, batch_size, embedding_matrix, shuffle=shuffle,
+                                    propositions=propositions, length_multiple=length_multiple)}
+
+    if embedding_matrix is None and propositions is None:
+        feed = {'x': inputs}
+        if outputs is not None:
+            feed['y'] = outputs
+        if batch_size is not None:
+            feed['batch_size'] = batch_size
+        return feed
+
+    return {'x': PairSequence(inputs, outputs, batch_size, embedding_matrix, shuffle=shuffle,
+                              propositions=propositions)}
+
+
+def predict_pairs(model, feed):
+    """
+    Predictions of the model on a feed created by make_feed, in the order of the pairs
+    """
+    predictions = model.predict(**feed)
+    if isinstance(feed['x'], BucketSequence):
+        predictions = feed['x'].restore_order(predictions)
+    return predictions
+
+
+def add_pruned_pairs(truth, prediction, pruned_truth, negative_class, scores=None):
+    """
+    Appends the pairs dropped by the candidate pruning of load_dataset, which are predicted as negative_class
+    :param truth: array with the true class of each pair
+    :param prediction: array with the predicted class of each pair
+    :param pruned_truth: array with the true class of each pruned pair
+    :param negative_class: the class of the lack of link or relation
+    :param scores: matrix with the predicted score of each class for each pair, or None
+    :return: truth, prediction and scores, with the pruned pairs at the end
+    """
+    if len(pruned_truth) == 0:
+        return truth, prediction, scores
+
+    truth = np.concatenate([truth, pruned_truth])
+    prediction = np.concatenate([prediction, np.full(len(pruned_truth), negative_class)])
+    if scores is not None:
+        pruned_scores = np.zeros((len(pruned_truth), np.shape(scores)[-1]), dtype=np.asarray(scores).dtype)
+        pruned_scores[:, negative_class] = 1
+        scores = np.concatenate([scores, pruned_scores])
+    return truth, prediction, scores
+
+
+def f1_scores(truth, prediction, labels=None):
+    """
+    F1 of each class, as f1_score(truth, prediction, average=None, labels=labels) of sklearn, computed from a confusion
+    matrix built with a single bincount
+    :param truth: array with the true class of each sample
+    :param prediction: array with the predicted class of each sample
+    :param labels: the classes to score, by default the classes that appear in truth or prediction
+    :return: array with the F1 of each class, 0 for the classes that are neither true nor predicted
+    """
+    truth = np.asarray(truth, dtype=np.int64)
+    prediction = np.asarray(prediction, dtype=np.int64)
+    if labels is None:
+        labels = np.union1d(truth, prediction)
+    labels = np.asarray(labels, dtype=np.int64)
+
+    size = int(max(np.max(truth, initial=0), np.max(prediction, initial=0), np.max(labels, initial=0))) + 1
+    confusion = np.bincount(truth * size + prediction, minlength=size * size).reshape((size, size))
+
+    true_positives = np.diag(confusion)
+    # 2tp + fp + fn
+    denominator = confusion.sum(axis=0) + confusion.sum(axis=1)
+    scores = np.zeros(size)
+    np.divide(2 * true_positives, denominator, out=scores, where=denominator > 0)
+    return scores[labels]
+
+
+class PairEvaluator:
+    """
+    Scores of the predictions on the pairs of a split, as computed by the validation loop of perform_training.
+    Everything that does not depend on the predictions is computed once: the propositions are mapped to integer
+    codes, their true class is found and the reflexive pairs are marked, so that each evaluation is a handful of
+    vector operations. The predictions of each evaluation are aggregated in buffers of fixed size, overwritten by the
+    next evaluation, so that the memory does not grow with the number of epochs.
+    """
+
+    def __init__(self, s_ids, t_ids, truth, positive_link_labels, pruned_links=(), pruned_relations=(),
+                 not_a_relation_label=None):
+        """
+        :param s_ids: the ID of the source of each pair
+        :param t_ids: the ID of the target of each pair
+        :param truth: list with the class ids of the links, relations, sources and targets of the pairs
+        :param positive_link_labels: the relation classes that are scored
+        :param pruned_links: the true link class of the pairs dropped by the candidate pruning
+        :param pruned_relations: the true relation class of the pairs dropped by the candidate pruning
+        :param not_a_relation_label: the relation class of the lack of relation
+        """
+        self.positive_link_labels = list(positive_link_labels)
+        self.pruned_links = np.asarray(pruned_links, dtype=np.int64)
+        self.pruned_relations = np.asarray(pruned_relations, dtype=np.int64)
+        self.not_a_relation_label = not_a_relation_label
+
+        # the propositions are numbered in order of appearance as targets, those that are never targets are not scored
+        codes, uniques = pandas.factorize(np.concatenate([np.asarray(t_ids, dtype=object),
+                                                          np.asarray(s_ids, dtype=object)]))
+        self.t_codes = codes[:len(t_ids)]
+        self.s_codes = codes[len(t_ids):]
+        self.n_propositions = int(np.max(self.t_codes, initial=-1)) + 1
+        self.n_codes = len(uniques)
+
+        # the class of each proposition is the most frequent among its pairs (they all have the same one)
+        n_classes = int(max(np.max(truth[2], initial=0), np.max(truth[3], initial=0))) + 1
+        counts = np.zeros((self.n_codes, n_classes), dtype=np.int64)
+        np.add.at(counts, (self.s_codes, np.asarray(truth[2], dtype=np.int64)), 1)
+        np.add.at(counts, (self.t_codes, np.asarray(truth[3], dtype=np.int64)), 1)
+        self.prop_truth = np.argmax(counts[:self.n_propositions], axis=-1)
+
+        # the reflexive pairs are not scored as links nor relations
+        self.kept = self.s_codes != self.t_codes
+        self.link_truth = np.concatenate([np.asarray(truth[0], dtype=np.int64)[self.kept], self.pruned_links])
+        self.relation_truth = np.concatenate([np.asarray(truth[1], dtype=np.int64)[self.kept], self.pruned_relations])
+        self.n_kept = int(np.sum(self.kept))
+
+        # buffers overwritten by each evaluation, so that the memory does not grow with the epochs
+        # the pairs dropped by the candidate pruning are predicted as non-links
+        self.link_prediction = np.ones(len(self.link_truth), dtype=np.int64)
+        self.relation_prediction = np.zeros(len(self.relation_truth), dtype=np.int64)
+        if len(self.pruned_relations) > 0:
+            self.relation_prediction[self.n_kept:] = not_a_relation_label
+        self.prop_scores = None
+
+    def evaluate(self, predictions):
+        """
+        :param predictions: list with the scores of the links, relations, sources and targets of the pairs
+        :return: dictionary with the F1 of the link class ('link'), of each scored relation class ('relations') and
+                 their average ('relations_AVG'), of each proposition class ('props') and their average ('props_AVG'),
+                 the average of link and propositions ('AVG_LP') and of link, propositions and relations ('AVG_all')
+        """
+        # the scores of each proposition are summed over its pairs
+        n_classes = np.shape(predictions[2])[-1]
+        if self.prop_scores is None or self.prop_scores.shape[-1] != n_classes:
+            self.prop_scores = np.zeros((self.n_codes, n_classes))
+        else:
+            self.prop_scores.fill(0)
+        np.add.at(self.prop_scores, self.s_codes, predictions[2])
+        np.add.at(self.prop_scores, self.t_codes, predictions[3])
+        prop_prediction = np.argmax(self.prop_scores[:self.n_propositions], axis=-1)
+
+        self.link_prediction[:self.n_kept] = np.argmax(predictions[0], axis=-1)[self.kept]
+        self.relation_prediction[:self.n_kept] = np.argmax(predictions[1], axis=-1)[self.kept]
+
+        scores = {}
+        scores['link'] = f1_scores(self.link_truth, self.link_prediction, labels=[0])[0]
+        scores['relations'] = f1_scores(self.relation_truth, self.relation_prediction,
+                                        labels=self.positive_link_labels)
+        scores['relations_AVG'] = np.mean(scores['relations'])
+        scores['props'] = f1_scores(self.prop_truth, prop_prediction)
+        scores['props_AVG'] = np.mean(scores['props'])
+        scores['AVG_LP'] = np.mean([scores['link'], scores['props_AVG']])
+        scores['AVG_all'] = np.mean([scores['link'], scores['props_AVG'], scores['relations_AVG']])
+        return scores
+
+
 """
 def wrong_lr_annealing_function(epoch, initial_lr=0.001, k=0.001, fixed_epoch=-1):
 
@@ -208,13 +837,19 @@ def fmeasure(y_true, y_pred):
     return fbeta_score(y_true, y_pred, beta=1)
 
 
-def get_avgF1(indexes):
+def get_avgF1(indexes, sparse=False):
     """
     Create the average f1-measure for the classes indicated by indexes
     :param indexes: iterable object of ints that represent classes
+    :param sparse: whether the true labels are class ids instead of one-hot vectors
     :return: the average f1-measure
     """
 
+    def true_classes(y_true):
+        if sparse:
+            return K.cast(K.flatten(y_true), 'int64')
+        return K.argmax(y_true, axis=-1)
+
     def some_class_precision(index, y_true, y_pred):
         """
         Based on https://stackoverflow.com/a/41717938/5464787
@@ -223,7 +858,7 @@ def get_avgF1(indexes):
         :return:
         """
         # true classes
-        class_id_true = K.argmax(y_true, axis=-1)
+        class_id_true = true_classes(y_true)
         # predicted classes
         class_id_preds = K.argmax(y_pred, axis=-1)
 
@@ -245,7 +880,7 @@ def get_avgF1(indexes):
         :return:
         """
         # true classes
-        class_id_true = K.argmax(y_true, axis=-1)
+        class_id_true = true_classes(y_true)
         # predicted classes
         class_id_preds = K.argmax(y_pred, axis=-1)
 